@@ -1,25 +1,38 @@
 import os
+import fcntl
 import json
-import uuid
+import base64
+import hashlib
 import time
 import threading
 import traceback
-from queue import SimpleQueue, Empty
 from pathlib import Path
-from typing import Dict, List, Tuple
-from werkzeug.security import check_password_hash, generate_password_hash
+from typing import List, Tuple
+from werkzeug.security import check_password_hash
+from werkzeug.exceptions import RequestEntityTooLarge
 
 import mimetypes
 mimetypes.init()
 
 from flask import (
     Flask, request, jsonify, Response,
-    send_from_directory, abort, session, make_response
+    abort, session, make_response, g
 )
-from pywebpush import webpush, WebPushException
 
 from db import DB                         # your DB wrapper (sqlite/json)
-from settings import load_or_create_vapid_keys  # returns (private, public)
+from pubsub import make_backend
+from sse import SSEHub, sse_frame, tagged_frame
+from push import PushDispatcher, PushRejected, PushSender, VapidSigner
+from retention import run_retention
+from ingest import IngestDuplicate, IngestTimeout, MessageWriter
+from forksafe import PerProcess
+from presence import Presence
+from metrics import SIZE_BUCKETS, Metrics, SamplingProfiler, query_label
+from fastjson import FastJSONProvider
+from messages import envelope
+from media import (SIZE_LIMITS, OffloadPool, UploadRequest, is_compressible, make_image_variants, persist_upload,
+                   process_voice, send_blob, unlink_unreferenced)
+from settings import load_or_create_password_hashes, load_or_create_vapid_keys
 from flask_compress import Compress
 
 # ------------------- config -------------------
@@ -32,208 +45,285 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 PUBLIC_CHANNEL_KEY = "public-1"
 PUBLIC_CHANNEL_TITLE = "모두의 방"
+FAMILY = ["아빠", "엄마", "첫째", "둘째"]
 
 app = Flask(__name__, static_folder="static", static_url_path="/")
+app.request_class = UploadRequest  # multipart files stream to storage/tmp, hashed and size-capped
+app.json = FastJSONProvider(app)  # jsonify() via orjson when available
 app.config.update(
+    MAX_CONTENT_LENGTH=max(SIZE_LIMITS.values()) + 1024 * 1024,  # reject oversized bodies up front
     SESSION_COOKIE_SAMESITE="Lax",
     SESSION_COOKIE_SECURE=True,  # Set to True only if using HTTPS
     SESSION_COOKIE_HTTPONLY=True,
+    COMPRESS_REGISTER=False,  # hooked up below so media responses can opt out
 )
-Compress(app) 
+compress = Compress(app)
+
+@app.after_request
+def compress_response(resp):
+    return compress.after_request(resp) if is_compressible(resp) else resp
+
+
 db = DB(os.environ.get("DB_BACKEND", "sqlite"))
-VAPID_PRIVATE, VAPID_PUBLIC = load_or_create_vapid_keys()
-VAPID_PRIVATE_PATH = Path("storage/keys/vapid_private.pem")
 
-# Initialize public channel with consistent title
-try:
-    db.upsert_channel(PUBLIC_CHANNEL_KEY, PUBLIC_CHANNEL_TITLE, ["아빠","엄마","첫째","둘째"])
-except Exception as e:
-    print(f"[INIT] Failed to create public channel: {e}", flush=True)
+@app.teardown_appcontext
+def release_db_connection(exc):
+    db.release()  # back to the pool; the next request's greenlet reuses it
+
+# ------------------- metrics -------------------
+# Counters and histograms for the hot paths, served on /metrics (see metrics.py)
+metrics = Metrics()
+metrics.describe("db_query_seconds", "Time spent in DB._sql, by statement verb and table")
+metrics.describe("http_request_seconds", "Time to produce the response (for streams: until the body starts)")
+metrics.describe("events_published_total", "Events handed to the pub/sub bus by this worker")
+metrics.describe("sse_fanout", "SSE connections in this worker that received each event")
+metrics.describe("push_seconds", "Web Push request latency, by outcome")
+metrics.describe("cleanup_seconds", "Background cleanup duration, by phase")
+db.on_query = lambda sql, dt: metrics.observe("db_query_seconds", dt, {"query": query_label(sql)})
+
+# Optional sampling profiler: PROFILE_HZ=100 and read /metrics/profile
+PROFILE_HZ = float(os.environ.get("PROFILE_HZ", 0))
+profiler = SamplingProfiler(PROFILE_HZ) if PROFILE_HZ > 0 else None
 
-app.secret_key = os.environ.get("SECRET_KEY", "dev-only-change-me")
+@app.before_request
+def start_request_timer():
+    g.request_t0 = time.perf_counter()
+    _startup()  # no-op once this worker has started (see create_app)
+    if profiler is not None:
+        profiler.start()  # per worker; timers don't survive the fork
+
+@app.after_request
+def observe_request(resp):
+    t0 = g.get("request_t0")
+    if t0 is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe("http_request_seconds", time.perf_counter() - t0, {"route": route, "method": request.method})
+        metrics.inc("http_requests_total", {"route": route, "method": request.method, "status": resp.status_code})
+    return resp
 
-USERS = {
-    "아빠": generate_password_hash("peace81!"),
-    "엄마": generate_password_hash("peace81!"),
-    "첫째": generate_password_hash("peace81!"),
-    "둘째": generate_password_hash("peace81!"),
-}
 
+VAPID_SUB = os.environ.get("VAPID_SUB", "mailto:admin@example.com")
+# Loaded by _start_process (see startup at the bottom), not at import
+VAPID_PUBLIC = None
+push_sender = None
+USERS = {}
 
-# ------------------- in-proc pub/sub for SSE (Corrected & Thread-Safe) -------------------
-# ------------------- in-proc pub/sub for SSE (Final Corrected Version) -------------------
-_realtime_lock = threading.Lock()
+app.secret_key = os.environ.get("SECRET_KEY", "dev-only-change-me")
 
-_subscribers: Dict[str, List[SimpleQueue]] = {}
-_active_users = set()
 
-def _subscribe(channel: str) -> SimpleQueue:
-    q = SimpleQueue()
-    with _realtime_lock:
-        _subscribers.setdefault(channel, []).append(q)
-    return q
+# ------------------- pub/sub for SSE -------------------
+# The backend is pluggable (see pubsub.py): "local" keeps everything in this
+# process, "socket" relays events between gunicorn workers over a Unix socket.
+_bus = make_backend(os.environ.get("PUBSUB_BACKEND", "local"))
+# Every /stream connection lives in the hub: frames are serialized once per
+# event and one timer thread sends keepalives for all of them.
+sse_hub = SSEHub(
+    _bus,
+    keepalive=float(os.environ.get("SSE_KEEPALIVE", 15)),
+    max_queue=int(os.environ.get("SSE_MAX_QUEUE", 256)),
+)
 
-def _unsubscribe(channel: str, q: SimpleQueue):
-    with _realtime_lock:
-        if channel in _subscribers and q in _subscribers[channel]:
-            # Add a try-except here for robustness, as the queue might already be gone
-            try:
-                _subscribers[channel].remove(q)
-            except ValueError:
-                pass # Queue was already removed, which is fine.
+sse_hub.on_dispatch = lambda channel, event, n: metrics.observe(
+    "sse_fanout", n, {"scope": "meta" if channel.startswith("meta:") else "channel"}, buckets=SIZE_BUCKETS)
 
 def _publish(channel: str, event: dict):
-    sub_list = []
-    # Use the lock to safely get a copy of the subscriber list
-    with _realtime_lock:
-        sub_list = list(_subscribers.get(channel, []))
-
-    # Iterate over the copy outside the lock to avoid holding it for too long
-    for q in sub_list:
+    meta = channel.startswith("meta:")
+    if not meta and event.get("seq") is None:
+        # Sequence channel events so a reconnecting client can catch up (see _events_since)
         try:
-            q.put_nowait(event)
-        except Exception:
-            # If a queue is broken, schedule it for removal
-            _unsubscribe(channel, q)
+            event = dict(event, seq=db.append_event(channel, event.get("event", "message"), event.get("data")))
+        except Exception as e:
+            print("[REALTIME] event log failed:", e, flush=True)
+    metrics.inc("events_published_total", {"scope": "meta" if meta else "channel", "event": event.get("event", "message")})
+    _bus.publish(channel, event)
+
+# Message inserts go through a single writer that commits them in batches;
+# it sequences the "message" event in the same transaction
+ingest = MessageWriter(
+    db,
+    publish=_publish,
+    max_batch=int(os.environ.get("INGEST_MAX_BATCH", 128)),
+)
+
+def _presence_changed(alias: str, online: bool, last_active):
+    # Everyone who shares a channel with the user hears about it on their meta topic
+    data = {"alias": alias, "online": online, "last_active": last_active}
+    for m in db.co_members(alias):
+        if m != alias:
+            _publish(f"meta:{m}", {"event": "presence", "data": data})
+
+# Open streams per user, shared between workers over the bus (see presence.py).
+# Push targeting asks it who is online; offline lags the last stream by PRESENCE_GRACE.
+presence = Presence(
+    _bus,
+    grace=float(os.environ.get("PRESENCE_GRACE", 20)),
+    heartbeat=float(os.environ.get("PRESENCE_HEARTBEAT", 10)),
+    on_change=_presence_changed,
+)
+
+REPLAY_DB_LIMIT = 500
+
+def _events_since(channel: str, seq: int):
+    """Channel events after seq, oldest first; None when the client is too far behind to catch up."""
+    events = _bus.replay.since(channel, seq)
+    if events is not None:
+        return events
+    events = db.list_events_since(channel, seq, limit=REPLAY_DB_LIMIT + 1)
+    if len(events) > REPLAY_DB_LIMIT:
+        return None
+    return events
+
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Connection": "keep-alive"}
+
+def _json_body(body: bytes, status: int = 200) -> Response:
+    """A response for JSON already encoded, e.g. by messages.envelope()."""
+    return Response(body, status=status, mimetype="application/json")
 
 def now_ts() -> int:
     return int(time.time())
 
 # ------------------- background cleanup -------------------
+CLEANUP_INTERVAL = 3600
+CLEANUP_DELAY = float(os.environ.get("CLEANUP_DELAY", 60))  # first pass stays out of the way of startup
+CLEANUP_LOCK_PATH = "storage/cleanup.lock"
+CLEANUP_LOCK_RETRY = 60
+
+def _wait_for_cleanup_lock() -> bool:
+    """
+    Block until this process holds the cleanup lock; it is released when the
+    process exits. False if another process held it first (a takeover).
+    """
+    fd = os.open(CLEANUP_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    first = True
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return first
+        except OSError:
+            first = False
+            time.sleep(CLEANUP_LOCK_RETRY)
+
 def background_cleanup():
-    """Hourly: delete messages older than 24h; prune stale subs; remove orphan audio files."""
+    """
+    Hourly: retention pass (see retention.py) and stale push subscriptions.
+
+    Every worker starts this thread and they race for a flock. The winner does
+    the work. In each other worker the thread stays parked, retrying the lock
+    every CLEANUP_LOCK_RETRY seconds, only so that cleanup goes on when the
+    holder exits (gunicorn restarting or replacing it). That is one idle
+    thread (a greenlet under gevent) per worker, traded for not needing a
+    gunicorn hook or a separate process in the deployment.
+    """
+    if _wait_for_cleanup_lock():
+        time.sleep(CLEANUP_DELAY)  # fresh start; a takeover has waited long enough already
     while True:
         try:
-            cutoff = now_ts() - 24 * 3600
-            old_audio = db.prune_messages_and_return_audio_paths(cutoff=cutoff)
-            for ap in old_audio or []:
-                try:
-                    p = Path(ap)
-                    if p.is_file():
-                        p.unlink(missing_ok=True)
-                except Exception as e:
-                    print("[CLEANUP] rm audio failed:", ap, e, flush=True)
-            db.prune_subscriptions_stale(days=90)
+            with metrics.timer("cleanup_seconds", {"phase": "retention"}):
+                stats = run_retention(db, [MEDIA_DIR, UPLOAD_DIR])
+            for kind in ("messages", "files", "events", "keys", "orphans"):
+                metrics.inc("retention_removed_total", {"kind": kind}, stats[kind])
+            if stats["messages"] or stats["orphans"] or stats["vacuumed_pages"]:
+                print("[CLEANUP]", stats, flush=True)
+            with metrics.timer("cleanup_seconds", {"phase": "subscriptions"}):
+                db.prune_subscriptions_stale(days=90)
         except Exception as e:
             print("[CLEANUP] error:", e, flush=True)
-        time.sleep(3600)
-
-threading.Thread(target=background_cleanup, daemon=True).start()
+        time.sleep(CLEANUP_INTERVAL)
 
 # ------------------- push helper -------------------
 def push_notify(subscription: dict, payload_dict: dict):
     if not PUSH_ENABLED:
+        metrics.inc("push_total", {"outcome": "disabled"})
         return False, "push disabled"
+    t0 = time.perf_counter()
     try:
-        webpush(
-            subscription_info=subscription,
-            data=json.dumps(payload_dict),
-            vapid_private_key=str(VAPID_PRIVATE_PATH),
-            vapid_claims={"sub": "mailto:admin@example.com"},
-            ttl=60,
-        )
-        return True, None
-    except WebPushException as e:
+        push_sender.send(subscription, json.dumps(payload_dict), ttl=60)
+        outcome, result = "ok", (True, None)
+    except PushRejected as e:
         msg = str(e)
         
-        if e.response and e.response.status_code in (404, 410):
-            return False, "gone"
-        return False, msg
+        if e.response.status_code in (404, 410):
+            outcome, result = "gone", (False, "gone")
+        else:
+            outcome, result = "error", (False, msg)
     except Exception as e:
         msg = str(e)
         
-        return False, msg
+        outcome, result = "error", (False, msg)
+    metrics.observe("push_seconds", time.perf_counter() - t0, {"outcome": outcome})
+    metrics.inc("push_total", {"outcome": outcome})
+    return result
+
+PUSH_KIND_LABELS = {"voice": "음성 메시지", "image": "사진", "file": "파일"}
+
+def render_notification(msg_out: dict) -> dict:
+    """Push title/body for a message, using the cached channel metadata (no extra query)."""
+    title = f"KoalaTalk 새 메시지"
+    channel_key = msg_out.get("channel", "")
+    channel_info = db.channel_meta(channel_key)
+    chan_title = channel_info["title"] if channel_info else ""
+    is_dm = channel_info["dm"] if channel_info else channel_key.startswith("dm:")
+    alias = msg_out.get("alias", "")
+    mtype = msg_out.get("type", "text")
+    raw_text = (msg_out.get("text") or "").strip()
+
+    if mtype == "text" and raw_text:
+        snippet = raw_text[:100]  # Shorter snippet for push notifications
+        body = f'{alias}: {snippet}' if is_dm else f'{alias} ({chan_title}): {snippet}'
+    else:
+        kind = PUSH_KIND_LABELS.get(mtype, "메시지")
+        if is_dm:
+            body = f'{alias} 님이 {kind}를 보냈어요'
+        else:
+            body = f'{alias} 님이 {chan_title}에 {kind}를 보냈어요'
+    return {"title": title, "body": body}
 
-def send_pushes_background(payload_dict: dict, msg_out: dict):
-    """Runs in a background thread to avoid blocking the API response."""
-    
-    try:
-        delivered = failures = 0
-        all_subs = db.list_subscriptions() or []
-        channel_key = msg_out.get("channel", "")
-        channel_info = db.get_channel(channel_key)
-        channel_members = channel_info.get("members", []) if channel_info else []
-        sender_alias = msg_out.get("alias")
-        sender_user_id = msg_out.get("user_id")
-        
-        # Track which users we've already notified (to prevent duplicates)
-        notified_users = set()
-        
-        for s in all_subs:
-            # Skip if we've already notified this user
-            sub_user_alias = s.get("alias")
-            # If the subscriber is currently active in the app, skip the push
-            is_active = False
-            if sub_user_alias:
-                with _realtime_lock: # Use the unified lock
-                    is_active = sub_user_alias in _active_users
-
-            if is_active:
-                print(f"[PUSH] Skipping active user: {sub_user_alias}", flush=True)
-                continue
-
-            sub_user_id = s.get("user_id")
-            
-            # Create a unique identifier for this subscription
-            sub_identifier = sub_user_alias or sub_user_id
-            if sub_identifier in notified_users:
-                continue
-                
-            # Don't notify the sender (check both user_id and alias)
-            if sender_user_id and sub_user_id == sender_user_id:
-                continue
-            if sender_alias and sub_user_alias == sender_alias:
-                continue
-            
-            # For DM channels (format: "dm:user1:user2"), only notify the OTHER member
-            if channel_key.startswith("dm:"):
-                # DM channel - only notify if this subscriber is one of the two members
-                if not sub_user_alias or sub_user_alias not in channel_members:
-                    continue
-                # Double-check: don't notify the sender in DM
-                if sub_user_alias == sender_alias:
-                    continue
-                    
-            # For public channels, notify all members except sender
-            elif channel_members:
-                # Only notify members of this channel
-                if not sub_user_alias or sub_user_alias not in channel_members:
-                    continue
-                # Skip the sender
-                if sub_user_alias == sender_alias:
-                    continue
-            
-            # Mark this user as notified
-            if sub_identifier:
-                notified_users.add(sub_identifier)
-            
-            # Send the push notification
-            ok, err = push_notify(
-                {"endpoint": s["endpoint"], "keys": {"p256dh": s["p256dh"], "auth": s["auth"]}},
-                payload_dict
-            )
-            
-            if ok:
-                delivered += 1
-                try: 
-                    db.bump_subscription_seen(s["id"])
-                except Exception: 
-                    pass
-            else:
-                failures += 1
-                try:
-                    if err == "gone":
-                        db._sql("DELETE FROM subscriptions WHERE id=?", (s["id"],))
-                    else:
-                        db.bump_subscription_fail(s["id"])
-                except Exception: 
-                    pass
-                    
-        
+def push_targets(msg_out: dict) -> List[dict]:
+    """Subscriptions that should get a push for this message (runs on the dispatcher's planner thread)."""
+    channel_key = msg_out.get("channel", "")
+    sender_alias = msg_out.get("alias")
+    sender_user_id = msg_out.get("user_id")
+
+    # Only the channel's members, sender excluded, straight from the alias index
+    subs = db.list_push_subscriptions(channel_key, exclude_alias=sender_alias)
+
+    active = presence.online({s["alias"] for s in subs if s.get("alias")})
+
+    # Track which users we've already notified (to prevent duplicates)
+    notified_users = set()
+    targets = []
+
+    for s in subs:
+        sub_user_alias = s.get("alias")
+        # If the subscriber is currently active in the app, skip the push
+        if sub_user_alias and sub_user_alias in active:
+            metrics.inc("push_skipped_active_total")
+            continue
+
+        sub_user_id = s.get("user_id")
+
+        # Create a unique identifier for this subscription
+        sub_identifier = sub_user_alias or sub_user_id
+        if sub_identifier in notified_users:
+            continue
+
+        # Don't notify the sender by user_id either
+        if sender_user_id and sub_user_id == sender_user_id:
+            continue
+
+        # Mark this user as notified
+        if sub_identifier:
+            notified_users.add(sub_identifier)
+        targets.append(s)
+
+    return targets
+
+push_dispatcher = PushDispatcher(
+    db, send=push_notify, targets=push_targets,
+    workers=int(os.environ.get("PUSH_WORKERS", 4)),
+    max_queue=int(os.environ.get("PUSH_QUEUE_SIZE", 1000)),
+)
 
-    except Exception as e:
-        traceback.print_exc()
-        
 # ------------------- routes -------------------
 @app.get("/")
 def index():
@@ -305,13 +395,60 @@ def list_my_channels():
     u = session.get("user")
     if not u: return jsonify({"error": "auth required"}), 401
     try:
-        chans = db.list_channels_for_user(u)
-        return jsonify({"ok": True, "channels": chans})
+        # Weak so Flask-Compress leaves it alone; per user since the URL is shared
+        etag = hashlib.sha1(f"{u}:{db.channel_list_version(u)}".encode("utf-8")).hexdigest()[:20]
+        if request.if_none_match.contains_weak(etag):
+            resp = Response(status=304)
+        else:
+            resp = jsonify({"ok": True, "channels": db.list_channels_for_user(u)})
+        resp.set_etag(etag, weak=True)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
     except Exception as e:
         print("[ERROR] /api/channels GET:", e, flush=True)
         traceback.print_exc()
         return jsonify({"error": "internal"}), 500
 
+@app.post("/api/channels/<path:key>/read")
+def mark_channel_read(key: str):
+    u = session.get("user")
+    if not u: return jsonify({"error": "auth required"}), 401
+    data = request.get_json(silent=True) or {}
+    try:
+        upto = data.get("message_id")
+        cursor = db.mark_read(key, u, int(upto) if upto is not None else None)
+        if cursor is None:
+            return jsonify({"error": "not a member"}), 404
+        _publish(f"meta:{u}", {"event": "read", "data": cursor})  # the user's other devices
+        presence.touch(u)
+        return jsonify({"ok": True, **cursor})
+    except (TypeError, ValueError):
+        return jsonify({"error": "bad message_id"}), 400
+    except Exception as e:
+        print("[ERROR] /api/channels read:", e, flush=True)
+        return jsonify({"error": "internal"}), 500
+
+@app.put("/api/channels/<path:key>/retention")
+def set_channel_retention(key: str):
+    """{"hours": N} keeps messages N hours (0 = forever); {"hours": null} goes back to the default."""
+    u = session.get("user")
+    if not u: return jsonify({"error": "auth required"}), 401
+    ch = db.channel_meta(key)
+    if not ch or u not in ch["members"]:
+        return jsonify({"error": "not a member"}), 404
+    hours = (request.get_json(silent=True) or {}).get("hours")
+    try:
+        seconds = None if hours is None else int(float(hours) * 3600)
+    except (TypeError, ValueError):
+        return jsonify({"error": "bad hours"}), 400
+    if seconds is not None and seconds < 0:
+        return jsonify({"error": "bad hours"}), 400
+    db.set_channel_retention(key, seconds)
+    ch = db.get_channel(key)
+    for m in ch["members"]:
+        _publish(f"meta:{m}", {"event": "channel", "data": ch})
+    return jsonify({"ok": True, "channel": ch})
+
 @app.post("/api/channels")
 def create_dm_channel():
     u = session.get("user")
@@ -328,6 +465,7 @@ def create_dm_channel():
         ch = db.get_or_create_dm(members[0], members[1])
         other_user = members[0] if members[1] == u else members[1]
         _publish(f"meta:{other_user}", {"event": "channel", "data": ch})
+        _publish(f"meta:{u}", {"event": "channel", "data": ch})  # lets our own /stream/me join it
         return jsonify({"ok": True, "channel": ch})
     except Exception as e:
         print("[ERROR] /api/channels POST:", e, flush=True)
@@ -373,15 +511,11 @@ def delete_message_route(msg_id: int):
         if not is_admin and row.get("alias") != user:
              return jsonify({"error": "forbidden"}), 403
 
-        ok = db.delete_message(msg_id, alias=row.get("alias"), admin=is_admin)
-        if not ok: return jsonify({"error":"forbidden or already deleted"}), 403
+        freed = db.delete_message(msg_id, alias=row.get("alias"), admin=is_admin)
+        if freed is None: return jsonify({"error":"forbidden or already deleted"}), 403
 
-        # Delete associated files
-        for col, base in (("audio_path", MEDIA_DIR), ("image_path", UPLOAD_DIR), ("file_path", UPLOAD_DIR)):
-            p_str = row.get(col)
-            if p_str:
-                try: Path(p_str).unlink(missing_ok=True)
-                except Exception: pass
+        # Delete associated files, unless another message shares the same blob
+        unlink_unreferenced(db, freed)
         if channel:
             _publish(channel, {"event":"delete", "data":{"id": msg_id}})
         return jsonify({"ok": True})
@@ -419,11 +553,53 @@ def end_call_message(msg_id: int):
         return jsonify({"error": "internal"}), 500
 
 
+# ------------------- media processing -------------------
+media_pool = OffloadPool(workers=int(os.environ.get("MEDIA_WORKERS", 2)))
+
+def _schedule_image_variants(msg_out: dict):
+    """Render thumbnails off the request path; clients get them via message_update."""
+    msg_id, channel = msg_out["id"], msg_out["channel"]
+
+    def done(variants):
+        if not variants:
+            return
+        db.merge_message_payload(msg_id, {"variants": variants})
+        updated = db.get_message(msg_id)
+        if updated:
+            _publish(channel, {"event": "message_update", "data": updated})
+
+    media_pool.submit(lambda: make_image_variants(msg_out["image_path"]), done)
+
+# ffmpeg does the heavy lifting in a child process, so greenlets are enough here
+voice_pool = OffloadPool(workers=int(os.environ.get("VOICE_WORKERS", 2)), real_threads=False)
+
+def _schedule_voice_processing(msg_out: dict):
+    """Transcode a voice note and store duration + waveform in its payload."""
+    msg_id, channel, path = msg_out["id"], msg_out["channel"], msg_out["audio_path"]
+
+    def done(info):
+        if not info:
+            return
+        new = info.pop("transcoded", None)
+        if new:
+            freed = db.replace_message_audio(msg_id, path, *new)
+            unlink_unreferenced(db, [new[0]] if freed is None else freed)
+        db.merge_message_payload(msg_id, info)
+        updated = db.get_message(msg_id)
+        if updated:
+            _publish(channel, {"event": "message_update", "data": updated})
+
+    voice_pool.submit(lambda: process_voice(path), done)
+
 @app.post("/api/messages")
 def create_message():
     try:
         ctype = (request.content_type or "").lower()
         msg_out = None
+        blob = None
+        # Optional, unique per sender: a retry with the same key can't store the message twice
+        idem_key = request.headers.get("Idempotency-Key") or None
+        if idem_key and len(idem_key) > 200: return jsonify({"error": "bad Idempotency-Key"}), 400
 
         if ctype.startswith("multipart/form-data"):
             channel = request.form.get("channel")
@@ -444,18 +620,17 @@ def create_message():
                 else:
                     ext = ".bin"
             
-            safe_name = f"{uuid.uuid4().hex}{ext}"
-            
             is_audio = "audio" in request.files
             save_dir = MEDIA_DIR if is_audio else UPLOAD_DIR
-            save_path = save_dir / safe_name
-            f.save(save_path)
-            
+
             # Check mime type for image detection
-            mime, _ = mimetypes.guess_type(str(save_path))
-            if not mime and f.mimetype:
-                mime = f.mimetype
+            mime = mimetypes.guess_type(orig)[0] or f.mimetype
             is_image = not is_audio and (mime or "").startswith("image/")
+
+            # Already streamed to storage/tmp while hashing; stored as <sha256><ext>
+            kind = "audio" if is_audio else ("image" if is_image else "file")
+            blob = persist_upload(f, save_dir, ext, kind)  # referenced in the message's own transaction
+            save_path = Path(blob[0])
             
             msg = {
                 "channel": channel,
@@ -466,10 +641,7 @@ def create_message():
                 "image_path": str(save_path) if is_image else None,
                 "file_path": str(save_path) if not is_audio and not is_image else None,
                 "file_name": orig if not is_audio and not is_image else None,
-                "created_at": now_ts(),
             }
-            msg_id = db.save_message(msg)
-            msg_out = db.get_message(msg_id)
             
         elif "application/json" in ctype or request.is_json:
             data = request.get_json(silent=True) or {}
@@ -487,52 +659,49 @@ def create_message():
                 "channel": channel, "alias": alias, "user_id": user_id, 
                 "type": mtype, "text": text, 
                 "payload": json.dumps(payload) if payload else None,
-                "created_at": now_ts()
             }
             # --- END REPLACEMENT ---
 
-            msg_id  = db.save_message(msg)
-            msg_out = db.get_message(msg_id)
-
         else:
             return jsonify({"error": "unsupported content-type"}), 415
 
-        if not msg_out: raise Exception("Failed to create and retrieve message")
+        # Rendered once; the same text goes out as push and on the SSE event
+        notification = render_notification(msg)
 
-        # Generate push notification body
-        title = f"KoalaTalk 새 메시지"
-        channel_key = msg_out.get("channel", "")  # FIX: Define channel_key
-        channel_info = db.get_channel(channel_key)
-        chan_title = channel_info.get("title", "") if channel_info else ""
-        alias = msg_out.get("alias", "")
+        # Stored by the ingest writer in a group commit and published to SSE
+        # subscribers as soon as that batch is committed
+        try:
+            msg_out = ingest.submit(msg, event_extra={"notification": notification}, blob=blob, key=idem_key)
+        except IngestTimeout:
+            # Queued, not failed: it may still commit (the orphan sweep handles the blob if not).
+            # The client learns the outcome over SSE, or retries with the same Idempotency-Key.
+            return jsonify({"ok": True, "pending": True}), 202
+        except IngestDuplicate as e:
+            if blob:
+                unlink_unreferenced(db, [blob[0]])  # the original message holds its own reference
+            original = db.get_message(e.message_id)
+            if not original: return jsonify({"error": "already sent and deleted"}), 409
+            return _json_body(envelope({"ok": True, "duplicate": True}, message=original))
+        except Exception:
+            if blob:
+                unlink_unreferenced(db, [blob[0]])  # nothing took a reference
+            raise
+        if session.get("user"):
+            presence.touch(session["user"])
         mtype = msg_out.get("type", "text")
-        raw_text = (msg_out.get("text") or "").strip()
-        
-        body = ""
-        if mtype == "text" and raw_text:
-            snippet = raw_text[:100]  # Shorter snippet for push notifications
-            if channel_key.startswith("dm:"):
-                body = f'{alias}: {snippet}'
-            else:
-                body = f'{alias} ({chan_title}): {snippet}'
-        else:
-            kind_map = {"voice":"음성 메시지", "image":"사진", "file":"파일"}
-            kind = kind_map.get(mtype, "메시지")
-            if channel_key.startswith("dm:"):
-                body = f'{alias} 님이 {kind}를 보냈어요'
-            else:
-                body = f'{alias} 님이 {chan_title}에 {kind}를 보냈어요'
-        
-        payload = {"title": title, "body": body}
-        
-        # Send push notifications in background
-        threading.Thread(target=send_pushes_background, args=(payload, msg_out), daemon=True).start()
 
-        # Publish to SSE subscribers
-        _publish(msg_out["channel"], {"event": "message", "data": msg_out})
+        # Hand off to the push dispatcher (never blocks the request)
+        push_dispatcher.submit(notification, msg_out)
+
+        if mtype == "image" and msg_out.get("image_path"):
+            _schedule_image_variants(msg_out)
+        elif mtype == "voice" and msg_out.get("audio_path"):
+            _schedule_voice_processing(msg_out)
         
-        return jsonify({"ok": True, "message": msg_out})
+        return _json_body(envelope({"ok": True}, message=msg_out))
 
+    except RequestEntityTooLarge as e:
+        return jsonify({"error": "too large", "detail": e.description}), 413
     except Exception as e:
         print("[ERROR] /api/messages:", e, flush=True)
         traceback.print_exc()
@@ -540,78 +709,322 @@ def create_message():
 
 @app.get("/uploads/<path:fname>")
 def serve_upload(fname):
-    return send_from_directory(UPLOAD_DIR, fname)
+    return send_blob(UPLOAD_DIR, fname)
+
+HISTORY_PAGE_MAX = 200
+
+def _encode_cursor(msg: dict) -> str:
+    raw = f"{int(msg['created_at'] or 0)}:{int(msg['id'])}".encode("ascii")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(token: str) -> Tuple[int, int]:
+    raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("ascii")
+    ts, mid = raw.split(":", 1)
+    return int(ts), int(mid)
+
+def _history_response(channel: str, version: int, rows: list, fields: dict) -> Response:
+    """History body with a weak ETag from the channel's history version and what this page holds."""
+    shape = f"{channel}:{version}:{len(rows)}:{rows[0]['id'] if rows else 0}:{rows[-1]['id'] if rows else 0}:{fields}"
+    etag = hashlib.sha1(shape.encode("utf-8")).hexdigest()[:20]
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = _json_body(envelope(fields, messages=rows))
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 @app.get("/api/messages")
 def list_messages():
     try:
         channel = request.args.get("channel")
         if not channel: return jsonify({"error": "channel required"}), 400
-        
-        days = int(request.args.get("days", 3))
-        before = int(request.args.get("before", now_ts()))
+
+        # Cursor mode: ?limit=N[&cursor=...], keyset-paginated on (created_at, id)
+        if "limit" in request.args or "cursor" in request.args:
+            try:
+                limit = max(1, min(int(request.args.get("limit", 50)), HISTORY_PAGE_MAX))
+            except ValueError:
+                return jsonify({"error": "bad limit"}), 400
+            before = None
+            if request.args.get("cursor"):
+                try:
+                    before = _decode_cursor(request.args["cursor"])
+                except (ValueError, UnicodeDecodeError):
+                    return jsonify({"error": "bad cursor"}), 400
+            rows, has_more, version = db.history_page(channel, limit, before)
+            next_cursor = _encode_cursor(rows[0]) if has_more and rows else None
+            return _history_response(channel, version, rows, {"ok": True, "has_more": has_more, "next_cursor": next_cursor})
+
+        try:
+            days = int(request.args.get("days", 3))
+            before = int(request.args.get("before", now_ts()))
+        except ValueError:
+            return jsonify({"error": "bad days/before"}), 400
         start_ts = before - days * 86400
         
-        msgs = db.list_messages_between(channel=channel, start_ts=start_ts, end_ts=before) or []
-        has_more = (db.count_messages_before(channel=channel, ts=start_ts) or 0) > 0
-
-        return jsonify({"ok": True, "messages": msgs, "has_more": has_more})
+        msgs, has_more, version = db.history_window(channel, start_ts, before)
+        return _history_response(channel, version, msgs, {"ok": True, "has_more": has_more})
     except Exception as e:
         print("[ERROR] /api/messages GET:", e, flush=True)
         return jsonify({"error": "internal"}), 500
 
+SEARCH_PAGE_MAX = 50
+
+@app.get("/api/search")
+def search_messages():
+    """GET /api/search?q=...&channel=...&limit=20&offset=0 over the caller's channels, best match first."""
+    u = session.get("user")
+    if not u: return jsonify({"error": "auth required"}), 401
+    q = (request.args.get("q") or "").strip()
+    if not q: return jsonify({"error": "q required"}), 400
+    try:
+        limit = max(1, min(int(request.args.get("limit", 20)), SEARCH_PAGE_MAX))
+        offset = max(0, int(request.args.get("offset", 0)))
+    except ValueError:
+        return jsonify({"error": "bad limit/offset"}), 400
+    try:
+        results, has_more = db.search_messages(u, q[:200], channel=request.args.get("channel") or None,
+                                               limit=limit, offset=offset)
+        return _json_body(envelope({"ok": True, "has_more": has_more,
+                                    "next_offset": offset + len(results) if has_more else None}, results=results))
+    except Exception as e:
+        print("[ERROR] /api/search:", e, flush=True)
+        traceback.print_exc()
+        return jsonify({"error": "internal"}), 500
+
+@app.get("/api/sync")
+def sync_channel():
+    """Delta since a sequence number: new messages, edits of older ones, and deleted ids."""
+    u = session.get("user")
+    if not u: return jsonify({"error": "auth required"}), 401
+    try:
+        channel = request.args.get("channel")
+        if not channel: return jsonify({"error": "channel required"}), 400
+        ch = db.channel_meta(channel)
+        if not ch or u not in ch["members"]:
+            return jsonify({"error": "not a member"}), 403
+        since = int(request.args.get("since", 0))
+
+        head = db.latest_event_seq(channel)
+        events = _events_since(channel, since)
+        if events is None:
+            # Too far behind: the client should reload history
+            return jsonify({"ok": True, "reset": True, "seq": head, "messages": [], "updates": [], "deletes": []})
+
+        messages, updates, deletes = {}, {}, []
+        for ev in events:
+            name, data = ev.get("event"), ev.get("data") or {}
+            mid = data.get("id")
+            if name == "message":
+                messages[mid] = data
+            elif name == "message_update":
+                if mid in messages: messages[mid] = data
+                else: updates[mid] = data
+            elif name == "delete":
+                if mid in messages:
+                    del messages[mid]
+                else:
+                    updates.pop(mid, None)
+                    deletes.append(mid)
+            head = max(head, ev.get("seq") or 0)
+
+        return jsonify({"ok": True, "reset": False, "seq": head, "messages": list(messages.values()),
+                        "updates": list(updates.values()), "deletes": deletes})
+    except ValueError:
+        return jsonify({"error": "bad since"}), 400
+    except Exception as e:
+        print("[ERROR] /api/sync:", e, flush=True)
+        return jsonify({"error": "internal"}), 500
+
 @app.get("/stream/<channel>")
 def stream_channel(channel):
     user = session.get("user") # Get the current user
-    q = _subscribe(channel)
-    
-    def gen():
-        try:
-            if user:
-                with _realtime_lock: # Use the unified lock
-                    _active_users.add(user)
-            yield "event: hello\ndata: {}\n\n"
-            while True:
-                try:
-                    item = q.get(timeout=15)
-                    yield f"event: {item.get('event','message')}\ndata: {json.dumps(item['data'])}\n\n"
-                except Empty:
-                    yield "event: ping\ndata: {}\n\n"
-        finally:
-            _unsubscribe(channel, q)
-            if user:
-                with _realtime_lock: # Use the unified lock
-                    _active_users.discard(user)
-
-    return Response(gen(), mimetype="text/event-stream", headers={
-        "Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Connection": "keep-alive"
-    })
+    if not user: return jsonify({"error": "auth required"}), 401
+    ch = db.channel_meta(channel)
+    if not ch or user not in ch["members"]:
+        return jsonify({"error": "not a member"}), 403
+    # EventSource resends the last id it saw; our client passes it explicitly after a manual reconnect
+    try:
+        last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+        last_id = int(last_id) if last_id not in (None, "") else None
+    except ValueError:
+        last_id = None
+
+    conn = sse_hub.open([channel])  # buffers live events from here on
+    presence.connect(user)
+
+    head = db.latest_event_seq(channel)
+    initial = [(None, f"event: hello\ndata: {json.dumps({'seq': head})}\n\n".encode())]
+    replayed = set()
+    if last_id is not None:
+        missed = _events_since(channel, last_id)
+        if missed is None:
+            initial.append((None, b"event: reset\ndata: {}\n\n"))
+        else:
+            for item in missed:
+                initial.append((None, sse_frame(item)))
+                replayed.add(item.get("seq"))
+    conn.start(initial, replayed)  # replayed seqs won't be sent twice
+
+    def on_close():
+        sse_hub.close(conn)
+        presence.disconnect(user)
+
+    resp = Response(conn.frames(), mimetype="text/event-stream", headers=_SSE_HEADERS)
+    resp.call_on_close(on_close)
+    return resp
+
+@app.get("/stream/me")
+def stream_me():
+    """One connection for all of the user's channels plus their meta topic; frames are channel-tagged."""
+    user = session.get("user")
+    if not user: return jsonify({"error": "auth required"}), 401
+    try:
+        last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+        last_id = int(last_id) if last_id not in (None, "") else None
+    except ValueError:
+        last_id = None
+
+    keys = [c["key"] for c in db.list_channels_for_user(user)]
+    meta = f"meta:{user}"
+    conn = sse_hub.open(keys + [meta], tagged=True, follow=meta)
+    presence.connect(user)
+
+    head = db.latest_event_seq()  # seq is global, so one id resumes every channel
+    initial = [(None, f"event: hello\ndata: {json.dumps({'seq': head, 'channels': keys})}\n\n".encode())]
+    replayed = set()
+    if last_id is not None:
+        missed = []
+        for key in keys:
+            evs = _events_since(key, last_id)
+            if evs is None:
+                missed = None
+                break
+            missed.extend((key, ev) for ev in evs)
+        if missed is None:
+            initial.append((None, b"event: reset\ndata: {}\n\n"))
+        else:
+            missed.sort(key=lambda x: x[1].get("seq") or 0)
+            for key, ev in missed:
+                initial.append((None, tagged_frame(key, ev)))
+                replayed.add(ev.get("seq"))
+    conn.start(initial, replayed)
+
+    def on_close():
+        sse_hub.close(conn)
+        presence.disconnect(user)
+
+    resp = Response(conn.frames(), mimetype="text/event-stream", headers=_SSE_HEADERS)
+    resp.call_on_close(on_close)
+    return resp
 
 @app.get("/stream/meta/<alias>")
 def stream_meta(alias):
-    q = _subscribe(f"meta:{alias}")
-    def gen():
-        try:
-            yield "event: hello\ndata: {}\n\n"
-            while True:
-                try:
-                    item = q.get(timeout=15)
-                    yield f"event: {item.get('event','channel')}\ndata: {json.dumps(item['data'])}\n\n"
-                except Empty:
-                    yield "event: ping\ndata: {}\n\n"
-        finally:
-            _unsubscribe(f"meta:{alias}", q)
-    return Response(gen(), mimetype="text/event-stream", headers={
-        "Cache-Control": "no-cache", "X-Accel-Buffering":"no", "Connection":"keep-alive"
-    })
+    conn = sse_hub.open([f"meta:{alias}"])
+    conn.start([(None, b"event: hello\ndata: {}\n\n")])
+    resp = Response(conn.frames(), mimetype="text/event-stream", headers=_SSE_HEADERS)
+    resp.call_on_close(lambda: sse_hub.close(conn))
+    return resp
+
+@app.get("/api/presence")
+def get_presence():
+    """Online state of everyone the user shares a channel with."""
+    u = session.get("user")
+    if not u: return jsonify({"error": "auth required"}), 401
+    return jsonify({"ok": True, "presence": presence.snapshot(db.co_members(u) | {u})})
+
+@app.get("/api/realtime/stats")
+def realtime_stats():
+    return jsonify({"ok": True, **sse_hub.metrics(), "history_cache": db.history.stats,
+                    "presence": presence.stats})
 
 @app.get("/media/<path:fname>")
 def serve_media(fname):
-    return send_from_directory(MEDIA_DIR, fname)
+    return send_blob(MEDIA_DIR, fname)
 
 @app.get("/healthz")
 def healthz():
     return jsonify({"ok": True})
 
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+def _component_stats():
+    """Stats the components keep themselves, read at scrape time."""
+    sse = sse_hub.metrics()
+    for k in ("open_connections", "queued_frames", "max_queue_depth"):
+        yield f"sse_{k}", None, sse[k]
+    for k, v in sse_hub.counters.items():
+        yield "sse_connection_events", {"kind": k}, v
+    for k, v in push_dispatcher.stats.items():
+        yield "push_dispatcher", {"kind": k}, v
+    for k, v in ingest.stats.items():
+        yield "ingest", {"kind": k}, v
+    for k, v in db.history.stats.items():
+        yield "history_cache", {"kind": k}, v
+    channels, messages = db.history.size()
+    yield "history_cache_channels", None, channels
+    yield "history_cache_messages", None, messages
+    for k, v in db.pool_stats().items():
+        yield "db_connections", {"state": k}, v
+    for k, v in presence.stats.items():
+        yield "presence", {"kind": k}, v
+
+metrics.add_collector(_component_stats)
+
+def _metrics_allowed() -> bool:
+    # Scrapers send METRICS_TOKEN as a bearer token; signed-in users can look too
+    if METRICS_TOKEN and request.headers.get("Authorization", "") == f"Bearer {METRICS_TOKEN}":
+        return True
+    return bool(session.get("user"))
+
+@app.get("/metrics")
+def metrics_endpoint():
+    if not _metrics_allowed():
+        return Response("auth required\n", status=401, mimetype="text/plain")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.get("/metrics/profile")
+def profile_endpoint():
+    """Collapsed stacks from the sampling profiler (?reset=1 starts a new window)."""
+    if not _metrics_allowed():
+        return Response("auth required\n", status=401, mimetype="text/plain")
+    if profiler is None:
+        return Response("profiler disabled (set PROFILE_HZ)\n", status=404, mimetype="text/plain")
+    return Response(profiler.dump(reset=request.args.get("reset") == "1"), mimetype="text/plain")
+
+# ------------------- startup -------------------
+# Importing this module only builds the app and its objects: no files are read
+# and the database isn't opened. Keys, password hashes, the schema check and
+# the background threads come from _start_process, once in each worker after
+# gunicorn has forked it (the first request starts it if create_app() wasn't called).
+def _start_process():
+    global VAPID_PUBLIC, push_sender, USERS
+    vapid_private, VAPID_PUBLIC = load_or_create_vapid_keys()
+    # Parsed once; JWTs are cached per push-service origin, connections are pooled
+    push_sender = PushSender(
+        VapidSigner(vapid_private, VAPID_SUB),
+        pool_size=int(os.environ.get("PUSH_WORKERS", 4)),
+    )
+    # Hashed once and kept in storage/keys/users.json; later starts just read it
+    USERS = load_or_create_password_hashes(FAMILY, "peace81!")
+    try:
+        db.upsert_channel(PUBLIC_CHANNEL_KEY, PUBLIC_CHANNEL_TITLE, FAMILY)  # no write if unchanged
+    except Exception as e:
+        print(f"[INIT] Failed to create public channel: {e}", flush=True)
+    threading.Thread(target=background_cleanup, daemon=True, name="cleanup").start()
+    if PUSH_ENABLED:  # while the worker is still quiet, not on the first message
+        threading.Thread(target=push_sender.warm_up, daemon=True, name="push-warm-up").start()
+
+_startup = PerProcess(_start_process).ensure
+
+def create_app() -> Flask:
+    """
+    Start this process and return the module's app (gunicorn: "app:create_app()").
+    Not a factory: every call returns the same app, and only the first one starts anything.
+    """
+    _startup()
+    return app
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=APP_PORT, threaded=True, debug=False)
\ No newline at end of file
+    create_app().run(host="0.0.0.0", port=APP_PORT, threaded=True, debug=False)
\ No newline at end of file
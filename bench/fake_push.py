@@ -0,0 +1,96 @@
+"""
+Local stand-in for a Web Push service (FCM / Mozilla autopush).
+
+Accepts encrypted pushes on POST /push/<token>, checks that a VAPID
+Authorization header is present, and answers 201 (or 410 for tokens starting
+with "gone"). Counts requests and TCP connections so keep-alive reuse and JWT
+caching can be checked.
+
+    python bench/fake_push.py --port 8765
+"""
+import os
+import base64
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import serialization
+
+
+def make_subscription(base_url: str, token: str) -> dict:
+    """A browser-shaped subscription with real p256dh/auth keys pointing at base_url."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    pub = key.public_key().public_bytes(
+        encoding=serialization.Encoding.X962,
+        format=serialization.PublicFormat.UncompressedPoint,
+    )
+    b64 = lambda b: base64.urlsafe_b64encode(b).decode("ascii").rstrip("=")
+    return {"endpoint": f"{base_url}/push/{token}", "keys": {"p256dh": b64(pub), "auth": b64(os.urandom(16))}}
+
+
+class FakePushServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr=("127.0.0.1", 0), delay: float = 0.0):
+        super().__init__(addr, _Handler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.authorizations = set()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(n)
+        auth = self.headers.get("Authorization") or ""
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.authorizations.add(auth)
+        if self.server.delay:
+            import time
+            time.sleep(self.server.delay)
+        if not auth.startswith("vapid "):
+            code = 401
+        elif self.path.startswith("/push/gone"):
+            code = 410
+        else:
+            code = 201
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--delay", type=float, default=0.0, help="seconds to hold each push")
+    args = ap.parse_args()
+    srv = FakePushServer(("127.0.0.1", args.port), delay=args.delay)
+    print(f"fake push service on {srv.url}", flush=True)
+    srv.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
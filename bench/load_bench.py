@@ -0,0 +1,367 @@
+"""
+End-to-end load benchmark for the chat server.
+
+Starts the Flask app in a scratch directory (its own storage/, SQLite and
+VAPID keys), either in-process on the threaded werkzeug server or under
+gunicorn + gevent the way the dockerfile runs it, and a local fake push
+service (bench/fake_push.py). Then, over real HTTP:
+
+- logs the family users in through /login,
+- registers push subscriptions for the users that hold no stream (active
+  users are skipped by push_targets) pointing at the fake push service,
+- opens --streams SSE connections on /stream/<channel>,
+- posts text, voice and file messages to /api/messages from --posters threads,
+- pages the channel history through /api/messages?limit=&cursor=.
+
+Reports POST and history latency percentiles, request throughput,
+publish-to-receive latency (from the start of the POST to the frame arriving
+on each stream), server memory per open SSE connection and push deliveries.
+In inproc mode the memory figure also counts the client's reader threads.
+
+    python bench/load_bench.py --mode inproc --streams 50 --posters 4 --messages 100
+    python bench/load_bench.py --mode gunicorn --workers 2 --streams 200
+"""
+import io
+import os
+import sys
+import json
+import math
+import time
+import wave
+import random
+import shutil
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Optional
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_push import FakePushServer, make_subscription  # noqa: E402
+
+CHANNEL = "public-1"
+USERS = ["아빠", "엄마", "첫째", "둘째"]
+PASSWORD = "peace81!"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentiles(xs: List[float]) -> str:
+    if not xs:
+        return "n/a"
+    xs = sorted(xs)
+    pick = lambda p: xs[min(len(xs) - 1, int(math.ceil(p / 100.0 * len(xs))) - 1)]
+    return "  ".join(f"p{p}={pick(p) * 1000:.1f}ms" for p in (50, 90, 99)) + f"  max={xs[-1] * 1000:.1f}ms"
+
+
+# ------------------- server -------------------
+def _rss_kb(pids: List[int]) -> int:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def _children(pid: int) -> List[int]:
+    out = []
+    for d in os.listdir("/proc"):
+        if not d.isdigit():
+            continue
+        try:
+            with open(f"/proc/{d}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        if ppid == pid:
+            out.append(int(d))
+    return out
+
+
+class InProcServer:
+    """The app on werkzeug's threaded server inside this process (one thread per connection)."""
+
+    def __init__(self, workdir: str):
+        self.workdir = workdir
+        self.port = _free_port()
+
+    def start(self):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        os.chdir(self.workdir)  # the app keeps everything under ./storage
+        import app as chat
+        self.app = chat
+        self._srv = make_server("127.0.0.1", self.port, chat.create_app(), threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=self._srv.serve_forever, daemon=True).start()
+
+    def pids(self) -> List[int]:
+        return [os.getpid()]
+
+    def stop(self):
+        self._srv.shutdown()
+
+
+class GunicornServer:
+    """gunicorn --worker-class gevent, as in the dockerfile, with workers sharing the socket pub/sub."""
+
+    def __init__(self, workdir: str, workers: int):
+        self.workdir = workdir
+        self.workers = workers
+        self.port = _free_port()
+
+    def start(self):
+        env = dict(os.environ, PUBSUB_BACKEND="socket", WEB_CONCURRENCY=str(self.workers))
+        self.proc = subprocess.Popen(
+            ["gunicorn", "--worker-class", "gevent", "--workers", str(self.workers),
+             "--bind", f"127.0.0.1:{self.port}", "--chdir", self.workdir, "--pythonpath", ROOT,
+             "--log-level", "warning", "app:create_app()"],
+            env=env,
+        )
+
+    def pids(self) -> List[int]:
+        return [self.proc.pid] + _children(self.proc.pid)
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+def _wait_healthy(base: str, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base}/healthz", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server did not come up")
+
+
+# ------------------- clients -------------------
+def login(base: str, user: str) -> requests.Session:
+    s = requests.Session()
+    r = s.post(f"{base}/login", json={"id": user, "password": PASSWORD}, timeout=10)
+    r.raise_for_status()
+    # The session cookie is marked Secure; carry it by hand over plain http
+    s.headers["Cookie"] = f"session={r.cookies['session']}"
+    return s
+
+
+class StreamReader:
+    """One SSE connection; records when each message id first arrived."""
+
+    def __init__(self, base: str, cookie: str, channel: str):
+        self.url = f"{base}/stream/{channel}"
+        self.cookie = cookie
+        self.received: Dict[int, float] = {}
+        self.ready = threading.Event()
+        self.error: Optional[str] = None
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _run(self):
+        try:
+            with requests.get(self.url, headers={"Cookie": self.cookie}, stream=True, timeout=(10, None)) as r:
+                event = None
+                for line in r.iter_lines(chunk_size=None):
+                    if line.startswith(b"event:"):
+                        event = line[6:].strip()
+                        if event == b"hello":
+                            self.ready.set()
+                    elif line.startswith(b"data:") and event == b"message":
+                        self.received[json.loads(line[5:])["id"]] = time.perf_counter()
+        except Exception as e:
+            self.error = str(e)
+            self.ready.set()
+
+
+def _voice_bytes(seconds: float = 1.0, rate: int = 8000) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"".join(struct.pack("<h", int(8000 * math.sin(i / 8.0))) for i in range(int(seconds * rate))))
+    return buf.getvalue()
+
+
+class Poster:
+    def __init__(self, session: requests.Session, base: str, user: str, n: int, mix: Dict[str, int], voice: bytes):
+        self.s = session
+        self.base = base
+        self.user = user
+        self.n = n
+        self.kinds = [k for k, w in mix.items() for _ in range(w)]
+        self.voice = voice
+        self.sent: Dict[int, float] = {}  # message id -> POST start
+        self.latency: Dict[str, List[float]] = {k: [] for k in mix}
+        self.errors = 0
+
+    def run(self):
+        rnd = random.Random(self.user)
+        for i in range(self.n):
+            kind = rnd.choice(self.kinds)
+            t0 = time.perf_counter()
+            if kind == "text":
+                r = self.s.post(f"{self.base}/api/messages", timeout=30,
+                                json={"channel": CHANNEL, "alias": self.user, "text": f"bench {i} " + "x" * 80})
+            elif kind == "voice":
+                r = self.s.post(f"{self.base}/api/messages", timeout=30,
+                                data={"channel": CHANNEL, "alias": self.user},
+                                files={"audio": ("voice.wav", self.voice, "audio/wav")})
+            else:
+                r = self.s.post(f"{self.base}/api/messages", timeout=30,
+                                data={"channel": CHANNEL, "alias": self.user},
+                                files={"upload": (f"bench-{i}.bin", os.urandom(4096), "application/octet-stream")})
+            dt = time.perf_counter() - t0
+            if r.status_code != 200:
+                self.errors += 1
+                continue
+            self.latency[kind].append(dt)
+            self.sent[r.json()["message"]["id"]] = t0
+
+
+def page_history(s: requests.Session, base: str, limit: int, max_pages: int) -> List[float]:
+    times, cursor = [], None
+    for _ in range(max_pages):
+        params = {"channel": CHANNEL, "limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+        t0 = time.perf_counter()
+        r = s.get(f"{base}/api/messages", params=params, timeout=30)
+        times.append(time.perf_counter() - t0)
+        cursor = r.json().get("next_cursor")
+        if not cursor:
+            break
+    return times
+
+
+# ------------------- run -------------------
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="koala-bench-")
+    push = FakePushServer(delay=args.push_delay).start()
+    os.environ.setdefault("PUSH_ENABLED", "true")
+    server = InProcServer(workdir) if args.mode == "inproc" else GunicornServer(workdir, args.workers)
+    server.start()
+    base = f"http://127.0.0.1:{server.port}"
+    try:
+        _wait_healthy(base)
+        sessions = {u: login(base, u) for u in USERS}
+
+        # Users holding streams are "active" and skipped for push; the rest get pushes
+        stream_users, push_users = USERS[:2], USERS[2:]
+        for u in push_users:
+            sub = make_subscription(push.url, f"bench-{u.encode('utf-8').hex()}")
+            sessions[u].post(f"{base}/subscribe", json={"subscription": sub, "alias": u}, timeout=10).raise_for_status()
+
+        rss_before = _rss_kb(server.pids())
+        readers = [StreamReader(base, sessions[stream_users[i % len(stream_users)]].headers["Cookie"], CHANNEL).start()
+                   for i in range(args.streams)]
+        for r in readers:
+            r.ready.wait(30)
+        time.sleep(0.5)
+        rss_after = _rss_kb(server.pids())
+        failed_streams = sum(1 for r in readers if r.error)
+
+        mix = dict(kv.split(":") for kv in args.mix.split(","))
+        mix = {k: int(v) for k, v in mix.items() if int(v) > 0}
+        voice = _voice_bytes()
+        posters = [Poster(login(base, stream_users[i % len(stream_users)]), base, stream_users[i % len(stream_users)],
+                          args.messages, mix, voice) for i in range(args.posters)]
+        threads = [threading.Thread(target=p.run) for p in posters]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        post_elapsed = time.perf_counter() - t0
+
+        sent = {mid: ts for p in posters for mid, ts in p.sent.items()}
+        deadline = time.time() + args.drain
+        while time.time() < deadline and not all(len(r.received) >= len(sent) for r in readers if not r.error):
+            time.sleep(0.05)
+
+        e2e, missing = [], 0
+        for r in readers:
+            if r.error:
+                continue
+            for mid, ts in sent.items():
+                got = r.received.get(mid)
+                if got is None:
+                    missing += 1
+                else:
+                    e2e.append(got - ts)
+
+        t0 = time.perf_counter()
+        history = page_history(sessions[USERS[0]], base, args.page_size, args.pages)
+        history_elapsed = time.perf_counter() - t0
+        time.sleep(args.push_wait)
+
+        posts = sum(len(v) for p in posters for v in p.latency.values())
+        errors = sum(p.errors for p in posters)
+        print(f"mode={args.mode} workers={args.workers if args.mode == 'gunicorn' else 1} "
+              f"streams={args.streams} posters={args.posters} messages={posts} errors={errors}")
+        for kind in mix:
+            lat = [x for p in posters for x in p.latency[kind]]
+            print(f"  POST {kind:<6} n={len(lat):<5} {_percentiles(lat)}")
+        print(f"  POST throughput      {posts / post_elapsed:.1f} req/s over {post_elapsed:.2f}s")
+        print(f"  publish->receive     n={len(e2e)} missing={missing}  {_percentiles(e2e)}")
+        if e2e:
+            print(f"  deliveries           {len(e2e) / post_elapsed:.0f} frames/s")
+        print(f"  history pages        n={len(history)} {_percentiles(history)}  "
+              f"{len(history) / history_elapsed if history_elapsed else 0:.1f} req/s")
+        open_streams = args.streams - failed_streams
+        per_conn = (rss_after - rss_before) / open_streams if open_streams else 0
+        print(f"  memory               rss {rss_before / 1024:.1f} -> {rss_after / 1024:.1f} MiB, "
+              f"{per_conn:.1f} KiB per SSE connection ({failed_streams} failed to open)")
+        print(f"  push                 {push.requests} requests over {push.connections} connections, "
+              f"{len(push.authorizations)} distinct VAPID headers")
+    finally:
+        server.stop()
+        push.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mode", choices=["inproc", "gunicorn"], default="inproc")
+    ap.add_argument("--workers", type=int, default=2, help="gunicorn workers (gunicorn mode)")
+    ap.add_argument("--streams", type=int, default=50, help="SSE connections on the channel")
+    ap.add_argument("--posters", type=int, default=4, help="concurrent posting clients")
+    ap.add_argument("--messages", type=int, default=100, help="messages per poster")
+    ap.add_argument("--mix", default="text:8,voice:1,file:1", help="message kind weights")
+    ap.add_argument("--page-size", type=int, default=50)
+    ap.add_argument("--pages", type=int, default=20, help="history pages to fetch")
+    ap.add_argument("--drain", type=float, default=15.0, help="seconds to wait for streams to catch up")
+    ap.add_argument("--push-delay", type=float, default=0.0, help="fake push service latency per request")
+    ap.add_argument("--push-wait", type=float, default=1.0, help="seconds to let pushes go out before reporting")
+    run(ap.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Cross-worker pub/sub throughput benchmark for pubsub.SocketBackend.
+
+Starts W worker processes, each with a listener that fans events out to S
+SSE-style queues (as the SSE hub does) drained on their own threads, plus one
+publisher process.
+Reports aggregate deliveries/sec so you can see fan-out scale with workers.
+
+    python bench/pubsub_bench.py --workers 1 2 4 --subs 50 --events 2000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import multiprocessing as mp
+from queue import SimpleQueue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pubsub import SocketBackend  # noqa: E402
+
+CHANNEL = "bench"
+
+
+def _worker(sock_path, n_subs, n_events, ready, done_q):
+    bus = SocketBackend(sock_path)
+    queues = [SimpleQueue() for _ in range(n_subs)]
+
+    def fan_out(channel, event):
+        if channel == CHANNEL:
+            for q in queues:
+                q.put_nowait(event)
+
+    bus.add_listener(fan_out)
+    bus.start()
+    counts = [0] * n_subs
+    first = [None]
+
+    def drain(i, q):
+        while counts[i] < n_events:
+            q.get()
+            if first[0] is None:
+                first[0] = time.perf_counter()
+            counts[i] += 1
+
+    threads = [threading.Thread(target=drain, args=(i, q), daemon=True) for i, q in enumerate(queues)]
+    for t in threads:
+        t.start()
+    ready.set()
+    for t in threads:
+        t.join()
+    done_q.put((first[0], time.perf_counter(), sum(counts)))
+
+
+def _publisher(sock_path, n_events, start):
+    bus = SocketBackend(sock_path)
+    bus.start()  # connect to the broker
+    start.wait()
+    data = {"id": 0, "text": "x" * 120, "alias": "bench", "created_at": 0}
+    for i in range(n_events):
+        data["id"] = i
+        bus.publish(CHANNEL, {"event": "message", "data": data})
+    time.sleep(0.5)  # let the socket drain before exiting
+
+
+def run(n_workers, n_subs, n_events):
+    tmp = tempfile.mkdtemp(prefix="pubsub-bench-")
+    sock_path = os.path.join(tmp, "bus.sock")
+    ctx = mp.get_context("fork")
+    done_q = ctx.Queue()
+    start = ctx.Event()
+    readies = []
+    procs = []
+    for _ in range(n_workers):
+        ev = ctx.Event()
+        p = ctx.Process(target=_worker, args=(sock_path, n_subs, n_events, ev, done_q))
+        p.start()
+        procs.append(p)
+        readies.append(ev)
+    for ev in readies:
+        ev.wait()
+    time.sleep(0.3)  # all workers connected to the broker
+    pub = ctx.Process(target=_publisher, args=(sock_path, n_events, start))
+    pub.start()
+    time.sleep(0.3)
+    t0 = time.perf_counter()
+    start.set()
+    results = [done_q.get(timeout=300) for _ in range(n_workers)]
+    t1 = max(r[1] for r in results)
+    delivered = sum(r[2] for r in results)
+    for p in procs + [pub]:
+        p.join(timeout=5)
+        if p.is_alive():
+            p.terminate()
+    elapsed = t1 - t0
+    return delivered, elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--subs", type=int, default=50, help="subscriber queues per worker")
+    ap.add_argument("--events", type=int, default=2000)
+    args = ap.parse_args()
+
+    print(f"{'workers':>7} {'delivered':>10} {'seconds':>8} {'deliveries/s':>13}")
+    for w in args.workers:
+        delivered, elapsed = run(w, args.subs, args.events)
+        print(f"{w:>7} {delivered:>10} {elapsed:>8.2f} {delivered / elapsed:>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
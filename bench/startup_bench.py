@@ -0,0 +1,129 @@
+"""
+Cold-start benchmark: how long until a fresh worker can serve.
+
+Each measurement runs in a scratch directory with its own storage/. The
+first run starts from an empty storage/ (VAPID keys, password hashes and the
+schema get created); the following runs reuse it, which is what a restart
+sees. Two ways of starting:
+
+- import: `import app` and create_app() in a fresh interpreter, timed from
+  inside it, plus the wall time of the whole process (interpreter boot too),
+- gunicorn: gunicorn + gevent as in the dockerfile, from spawning it to the
+  first 200 from /healthz and then to the first successful /login.
+
+    python bench/startup_bench.py --runs 5
+    python bench/startup_bench.py --runs 5 --workers 2 --skip-import
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+from typing import Dict, List
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load_bench import PASSWORD, USERS, GunicornServer  # noqa: E402
+
+IMPORT_PROBE = """
+import json, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+app.create_app()
+t2 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "create_app": t2 - t1}))
+"""
+
+
+def _ms(x: float) -> str:
+    return f"{x * 1000:.0f}ms"
+
+
+def _summary(runs: List[Dict[str, float]], keys: List[str]) -> List[str]:
+    lines = []
+    for label, sample in (("cold", runs[:1]), ("warm", runs[1:])):
+        if not sample:
+            continue
+        parts = [f"{k}={_ms(statistics.median(r[k] for r in sample))}" for k in keys]
+        lines.append(f"  {label:<5} n={len(sample):<3} " + "  ".join(parts))
+    return lines
+
+
+def bench_import(runs: int) -> List[Dict[str, float]]:
+    workdir = tempfile.mkdtemp(prefix="koala-startup-")
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = []
+    try:
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            p = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=workdir, env=env,
+                               capture_output=True, text=True, timeout=120)
+            wall = time.perf_counter() - t0
+            if p.returncode != 0:
+                raise RuntimeError(p.stderr.strip().splitlines()[-1] if p.stderr.strip() else "import failed")
+            r = json.loads(p.stdout.strip().splitlines()[-1])
+            r["process"] = wall
+            out.append(r)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return out
+
+
+def bench_gunicorn(runs: int, workers: int) -> List[Dict[str, float]]:
+    workdir = tempfile.mkdtemp(prefix="koala-startup-")
+    out = []
+    try:
+        for _ in range(runs):
+            server = GunicornServer(workdir, workers)
+            base = f"http://127.0.0.1:{server.port}"
+            t0 = time.perf_counter()
+            server.start()
+            try:
+                deadline = t0 + 60
+                while True:
+                    try:
+                        if requests.get(f"{base}/healthz", timeout=1).ok:
+                            break
+                    except requests.RequestException:
+                        pass
+                    if time.perf_counter() > deadline:
+                        raise RuntimeError("server did not come up")
+                    time.sleep(0.01)
+                healthy = time.perf_counter() - t0
+                r = requests.post(f"{base}/login", json={"id": USERS[0], "password": PASSWORD}, timeout=10)
+                r.raise_for_status()
+                out.append({"healthz": healthy, "login": time.perf_counter() - t0})
+            finally:
+                server.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=5, help="starts per mode; the first one is cold")
+    ap.add_argument("--workers", type=int, default=1, help="gunicorn workers")
+    ap.add_argument("--skip-import", action="store_true")
+    ap.add_argument("--skip-gunicorn", action="store_true")
+    args = ap.parse_args()
+
+    if not args.skip_import:
+        print("import app + create_app() in a fresh interpreter")
+        for line in _summary(bench_import(args.runs), ["import", "create_app", "process"]):
+            print(line)
+    if not args.skip_gunicorn:
+        print(f"gunicorn --worker-class gevent --workers {args.workers}, spawn to first response")
+        for line in _summary(bench_gunicorn(args.runs, args.workers), ["healthz", "login"]):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,228 @@
 import os
 import json
+import time
 import sqlite3
+import threading
+from contextlib import contextmanager
 from threading import RLock
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+from fastjson import loads
+from forksafe import PerProcess
+from history import HistoryCache, Tail
+from messages import Message, encode
+
+# Per-connection tuning. WAL lets readers run alongside the writer, and with
+# synchronous=NORMAL a commit no longer fsyncs (only checkpoints do).
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+SQLITE_STATEMENT_CACHE = 256
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", 8))  # idle connections kept for reuse
+
+# Stored in PRAGMA user_version once _init_sqlite has run to completion; a
+# database already at this version skips the migrations. Bump it whenever
+# _init_sqlite changes.
+SCHEMA_VERSION = 2
+
+MESSAGE_COLUMNS = ("channel", "alias", "user_id", "type", "text", "audio_path", "image_path", "file_path",
+                   "image_url", "file_url", "file_name", "payload", "created_at")
+INSERT_MESSAGE_SQL = f"INSERT INTO messages({', '.join(MESSAGE_COLUMNS)}) VALUES ({', '.join('?' * len(MESSAGE_COLUMNS))})"
+
+# Hot-history cache (history.py): channels kept, newest messages per channel
+HISTORY_CACHE_CHANNELS = int(os.environ.get("HISTORY_CACHE_CHANNELS", 64))
+HISTORY_CACHE_DEPTH = int(os.environ.get("HISTORY_CACHE_DEPTH", 500))
+
+SNIPPET_LEN = 100
+# Re-derive the "last message" columns of channel_summary from messages
+SUMMARY_REFRESH_SQL = f"""
+    UPDATE channel_summary SET (last_message_id, last_alias, last_type, last_snippet, last_ts) = (
+        SELECT id, alias, type, substr(text, 1, {SNIPPET_LEN}), created_at FROM messages
+        WHERE channel = channel_summary.channel_key ORDER BY created_at DESC, id DESC LIMIT 1
+    )
+"""
+
+class _Lease:
+    """
+    The connection one thread/greenlet is using. It goes back to the pool on
+    DB.release(), or when the owner finishes and its thread-local state (and
+    with it this lease) is dropped.
+    """
+
+    __slots__ = ("db", "conn")
+
+    def __init__(self, db: "DB", conn: sqlite3.Connection):
+        self.db = db
+        self.conn = conn
+
+    def release(self):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            self.db._give_back(conn)
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass  # interpreter shutdown
+
 
 class DB:
     def __init__(self, backend="sqlite"):
         self.backend = backend
+        self.on_query = None  # optional fn(sql, seconds), called after every _sql
         os.makedirs("storage", exist_ok=True)
         if backend == "sqlite":
             self.path = "storage/data.sqlite"
-            self._init_sqlite()
+            # threading.local is greenlet-local once gevent has monkey-patched:
+            # every thread/greenlet leases its own connection from the pool
+            # and hands it back when the request ends or the owner goes away.
+            self._local = threading.local()
+            self._conns_lock = RLock()
+            self._conns: List[sqlite3.Connection] = []  # every open connection, leased or idle
+            self._idle: List[sqlite3.Connection] = []
+            # channel key -> ("channels" version, {"key", "title", "members", "dm", ...}).
+            # Every channel change bumps that version (in any worker), so a stale
+            # entry is never served. Misses aren't cached.
+            self._channel_cache: Dict[str, Tuple[int, Dict]] = {}
+            self.fts_enabled = False  # set by _init_sqlite if this SQLite has FTS5
+            self.history = HistoryCache(HISTORY_CACHE_CHANNELS, HISTORY_CACHE_DEPTH)
+            # Schema check/migration on first use, not at construction (i.e. app import)
+            self._schema = PerProcess(self._init_sqlite)
         else:
             raise ValueError("Unsupported DB_BACKEND")
 
+    # ------------------- connection layer -------------------
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=5.0,
+            isolation_level=None,  # autocommit; explicit BEGIN in transaction()
+            cached_statements=SQLITE_STATEMENT_CACHE,
+            check_same_thread=False,  # pooled: the next lease may be another thread's
+        )
+        conn.row_factory = sqlite3.Row
+        for p in SQLITE_PRAGMAS:
+            conn.execute(p)
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+    def _conn(self) -> sqlite3.Connection:
+        lease = getattr(self._local, "lease", None)
+        if lease is None:
+            self._schema.ensure()
+            with self._conns_lock:
+                conn = self._idle.pop() if self._idle else None
+            lease = self._local.lease = _Lease(self, conn or self._connect())
+            self._local.depth = 0
+            self._local.after_commit = []
+        return lease.conn
+
+    def _give_back(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()  # owner died mid-transaction
+        with self._conns_lock:
+            if conn in self._conns and len(self._idle) < SQLITE_POOL_SIZE:
+                self._idle.append(conn)
+                return
+            if conn in self._conns:
+                self._conns.remove(conn)
+        conn.close()
+
+    def release(self):
+        """Return this thread's connection to the pool (e.g. at the end of a request)."""
+        lease = getattr(self._local, "lease", None)
+        if lease is None or self._local.depth:
+            return
+        self._local.lease = None
+        lease.release()
+
+    def pool_stats(self) -> Dict[str, int]:
+        with self._conns_lock:
+            return {"open": len(self._conns), "idle": len(self._idle)}
+
+    @contextmanager
+    def transaction(self):
+        """Group several statements into one commit. Nested use joins the outer one."""
+        conn = self._conn()
+        if self._local.depth == 0:
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.after_commit = []
+        self._local.depth += 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute("ROLLBACK")
+                self._local.after_commit = []
+            raise
+        else:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute("COMMIT")
+                hooks, self._local.after_commit = self._local.after_commit, []
+                for fn in hooks:
+                    try:
+                        fn()
+                    except Exception as e:
+                        print("[DB] after-commit hook failed:", e, flush=True)
+
+    def _after_commit(self, fn):
+        """Run fn once the current transaction commits (dropped on rollback)."""
+        self._conn()
+        if self._local.depth == 0:
+            fn()
+        else:
+            self._local.after_commit.append(fn)
+
+    @contextmanager
+    def savepoint(self, name: str = "sp"):
+        """Inside a transaction: undo just this block if it raises, keep the rest."""
+        conn = self._conn()
+        conn.execute(f"SAVEPOINT {name}")
+        mark = len(self._local.after_commit)
+        try:
+            yield conn
+        except BaseException:
+            conn.execute(f"ROLLBACK TO {name}")
+            conn.execute(f"RELEASE {name}")
+            del self._local.after_commit[mark:]
+            raise
+        else:
+            conn.execute(f"RELEASE {name}")
+
+    def close(self):
+        """Close every connection opened by this DB (all threads)."""
+        with self._conns_lock:
+            conns, self._conns, self._idle = self._conns, [], []
+        for c in conns:
+            try: c.close()
+            except Exception: pass
+        self._local = threading.local()
+
     def _init_sqlite(self):
         with sqlite3.connect(self.path) as conn:
             cur = conn.cursor()
+            if cur.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                self.fts_enabled = cur.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'").fetchone() is not None
+                return
+            complete = True
+            # journal_mode is persistent in the database file, set it once here
+            cur.execute("PRAGMA journal_mode=WAL")
+            # Let the retention job hand free pages back in small steps (incremental_vacuum)
+            if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                try:
+                    cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                    cur.execute("VACUUM")  # one-off rebuild for existing files; instant on a new one
+                except sqlite3.OperationalError as e:
+                    print("[DB] auto_vacuum switch postponed:", e, flush=True)  # another worker is on it
+                    complete = False  # retried on the next start
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS subscriptions (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -31,6 +237,8 @@ class DB:
                     fail_count INTEGER DEFAULT 0
                 )
             """)
+            # alias -> subscription lookup for push targeting
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_alias ON subscriptions (alias);")
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS messages (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -50,6 +258,9 @@ class DB:
                 )
             """)
             cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_channel_created ON messages (channel, created_at);")
+            # keyset pagination: WHERE channel=? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_channel_created_id ON messages (channel, created_at, id);")
+            self.fts_enabled = self._init_fts(cur)
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS channels (
                     key TEXT PRIMARY KEY,
@@ -57,25 +268,160 @@ class DB:
                     members TEXT
                 )
             """)
+            # Normalized membership (channels.members JSON is kept as the cached copy)
+            has_members = cur.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='channel_members'").fetchone()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS channel_members (
+                    channel_key TEXT NOT NULL,
+                    alias TEXT NOT NULL,
+                    PRIMARY KEY (channel_key, alias)
+                ) WITHOUT ROWID
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_channel_members_alias ON channel_members (alias, channel_key);")
+            if not has_members:
+                cur.execute("""
+                    INSERT OR IGNORE INTO channel_members(channel_key, alias)
+                    SELECT c.key, j.value FROM channels c, json_each(c.members) j
+                """)
+            # Change counters for cheap ETags (e.g. "channels" bumps on every membership change)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS versions (
+                    name TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            # Per-channel event log: seq orders message/edit/delete events for SSE replay and /api/sync
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS channel_events (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    channel TEXT,
+                    event TEXT,
+                    data TEXT,
+                    created_at INTEGER
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_channel_events_channel_seq ON channel_events (channel, seq);")
+            # Content-addressed upload blobs and how many messages point at each
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    path TEXT PRIMARY KEY,
+                    sha256 TEXT,
+                    size INTEGER,
+                    refcount INTEGER DEFAULT 0,
+                    created_at INTEGER
+                )
+            """)
+            # Client idempotency keys for POST /api/messages: a retried send maps to the message it created
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS message_keys (
+                    alias TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    message_id INTEGER,
+                    created_at INTEGER,
+                    PRIMARY KEY (alias, key)
+                ) WITHOUT ROWID
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_message_keys_created ON message_keys (created_at);")
+            # Per-channel summary, maintained by save/delete/update/prune (no scans on read)
+            has_summary = cur.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='channel_summary'").fetchone()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS channel_summary (
+                    channel_key TEXT PRIMARY KEY,
+                    last_message_id INTEGER,
+                    last_alias TEXT,
+                    last_type TEXT,
+                    last_snippet TEXT,
+                    last_ts INTEGER,
+                    message_count INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            if not has_summary:
+                cur.execute("INSERT INTO channel_summary(channel_key, message_count) SELECT channel, COUNT(*) FROM messages GROUP BY channel")
+                cur.execute(SUMMARY_REFRESH_SQL)
+            # Per-user read position and unread count (existing history counts as read)
+            has_cursors = cur.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='read_cursors'").fetchone()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS read_cursors (
+                    channel_key TEXT NOT NULL,
+                    alias TEXT NOT NULL,
+                    last_read_id INTEGER NOT NULL DEFAULT 0,
+                    unread INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (channel_key, alias)
+                ) WITHOUT ROWID
+            """)
+            if not has_cursors:
+                cur.execute("""
+                    INSERT OR IGNORE INTO read_cursors(channel_key, alias, last_read_id)
+                    SELECT m.channel_key, m.alias, COALESCE(s.last_message_id, 0)
+                    FROM channel_members m LEFT JOIN channel_summary s ON s.channel_key = m.channel_key
+                """)
             cur.execute("PRAGMA table_info(messages)")
             cols = {row[1] for row in cur.fetchall()}
             wanted = {"audio_path": "TEXT", "image_path": "TEXT", "file_path": "TEXT", "image_url": "TEXT", "file_url": "TEXT", "file_name": "TEXT", "payload": "TEXT"}
             for name, typ in wanted.items():
                 if name not in cols:
                     cur.execute(f"ALTER TABLE messages ADD COLUMN {name} {typ}")
+            # Per-channel retention in seconds: NULL = server default, 0 = keep forever
+            cur.execute("PRAGMA table_info(channels)")
+            if "retention_seconds" not in {row[1] for row in cur.fetchall()}:
+                cur.execute("ALTER TABLE channels ADD COLUMN retention_seconds INTEGER")
+            if complete:
+                cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
             conn.commit()
 
+    def _init_fts(self, cur) -> bool:
+        """
+        Full-text index over messages.text/file_name (external content, kept in
+        sync by triggers). The trigram tokenizer needs no word segmentation,
+        so Korean works as well as anything else. False if FTS5 isn't available.
+        """
+        exists = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'").fetchone()
+        try:
+            cur.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    text, file_name, content='messages', content_rowid='id', tokenize='trigram'
+                )
+            """)
+        except sqlite3.OperationalError as e:
+            print("[DB] FTS5 unavailable, search falls back to LIKE:", e, flush=True)
+            return False
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, text, file_name) VALUES (new.id, new.text, new.file_name);
+            END
+        """)
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, text, file_name) VALUES ('delete', old.id, old.text, old.file_name);
+            END
+        """)
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text, file_name ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, text, file_name) VALUES ('delete', old.id, old.text, old.file_name);
+                INSERT INTO messages_fts(rowid, text, file_name) VALUES (new.id, new.text, new.file_name);
+            END
+        """)
+        if not exists:
+            cur.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        return True
+
     def _sql(self, q, args=(), fetch=None):
-        with sqlite3.connect(self.path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute(q, args)
-            res = None
-            if fetch == "one": res = cur.fetchone()
-            elif fetch == "all": res = cur.fetchall()
-            conn.commit()
-            if fetch: return res
-            return cur.lastrowid
+        if self.on_query is not None:
+            t0 = time.perf_counter()
+            try:
+                return self._run_sql(q, args, fetch)
+            finally:
+                self.on_query(q, time.perf_counter() - t0)
+        return self._run_sql(q, args, fetch)
+
+    def _run_sql(self, q, args, fetch):
+        cur = self._conn().execute(q, args)
+        if fetch == "one": return cur.fetchone()
+        if fetch == "all": return cur.fetchall()
+        return cur.lastrowid
 
     def save_subscription(self, sub, alias="unknown", user_id=None, channels=None):
             endpoint = sub["endpoint"]
@@ -83,30 +429,58 @@ class DB:
             chs = json.dumps(channels or [])
             ts = self._now()
             
-            # CRITICAL FIX: Before adding the new subscription, delete any old ones
-            # for the same user. This prevents stale/duplicate subscriptions.
-            if alias and alias != "unknown":
-                self._sql("DELETE FROM subscriptions WHERE alias=?", (alias,))
-            
-            # Now, insert the new, single subscription for this user.
-            self._sql("""
-                INSERT INTO subscriptions(endpoint, p256dh, auth, alias, user_id, channels, created_at, last_seen, fail_count)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
-            """, (endpoint, p256dh, auth, alias, user_id, chs, ts, ts))
-            
-            row = self._sql("SELECT id FROM subscriptions WHERE endpoint=?", (endpoint,), fetch="one")
+            with self.transaction():
+                # CRITICAL FIX: Before adding the new subscription, delete any old ones
+                # for the same user. This prevents stale/duplicate subscriptions.
+                if alias and alias != "unknown":
+                    self._sql("DELETE FROM subscriptions WHERE alias=?", (alias,))
+
+                # Now, insert the new, single subscription for this user.
+                self._sql("""
+                    INSERT INTO subscriptions(endpoint, p256dh, auth, alias, user_id, channels, created_at, last_seen, fail_count)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+                """, (endpoint, p256dh, auth, alias, user_id, chs, ts, ts))
+
+                row = self._sql("SELECT id FROM subscriptions WHERE endpoint=?", (endpoint,), fetch="one")
             return row["id"]
 
     def list_subscriptions(self) -> List[Dict]:
         rows = self._sql("SELECT * FROM subscriptions", fetch="all")
         return [dict(r) for r in rows]
 
+    def list_push_subscriptions(self, channel_key: str, exclude_alias: Optional[str] = None) -> List[Dict]:
+        """Subscriptions of the channel's members (minus the sender), via the alias index."""
+        members = self.get_channel_members(channel_key)
+        if not members:
+            if channel_key.startswith("dm:"):
+                return []
+            # Unknown non-DM channel: everybody but the sender, as before
+            rows = self._sql("SELECT * FROM subscriptions WHERE alias IS NOT ? ORDER BY id", (exclude_alias,), fetch="all")
+            return [dict(r) for r in rows]
+        aliases = [m for m in members if m != exclude_alias]
+        if not aliases:
+            return []
+        marks = ",".join("?" * len(aliases))
+        rows = self._sql(f"SELECT * FROM subscriptions WHERE alias IN ({marks}) ORDER BY id", tuple(aliases), fetch="all")
+        return [dict(r) for r in rows]
+
     def bump_subscription_seen(self, sub_id: int):
         self._sql("UPDATE subscriptions SET last_seen=?, fail_count=0 WHERE id=?", (self._now(), sub_id))
 
     def bump_subscription_fail(self, sub_id: int):
         self._sql("UPDATE subscriptions SET fail_count=fail_count+1 WHERE id=?", (sub_id,))
 
+    def record_push_results(self, seen_ids: List[int], failed_ids: List[int], gone_ids: List[int]):
+        """Apply a batch of push outcomes in one transaction."""
+        now = self._now()
+        with self.transaction() as conn:
+            if seen_ids:
+                conn.executemany("UPDATE subscriptions SET last_seen=?, fail_count=0 WHERE id=?", [(now, i) for i in seen_ids])
+            if failed_ids:
+                conn.executemany("UPDATE subscriptions SET fail_count=fail_count+1 WHERE id=?", [(i,) for i in failed_ids])
+            if gone_ids:
+                conn.executemany("DELETE FROM subscriptions WHERE id=?", [(i,) for i in gone_ids])
+
     def prune_subscriptions_stale(self, days=90):
         if days is None: return
         cutoff = self._now() - int(days * 86400)
@@ -115,42 +489,156 @@ class DB:
     # Add this function to the DB class in db.py
 
     def update_message_text(self, msg_id: int, new_text: str):
-        self._sql("UPDATE messages SET type='text', text=? WHERE id=?", (new_text, msg_id))
+        with self.transaction():
+            r = self._sql("UPDATE messages SET type='text', text=? WHERE id=? RETURNING channel", (new_text, msg_id), fetch="all")
+            self._sql("UPDATE channel_summary SET last_type='text', last_snippet=? WHERE last_message_id=?",
+                      ((new_text or "")[:SNIPPET_LEN], msg_id))
+            self._bump_version("messages")
+            if r:
+                self._bump_history(r[0]["channel"], lambda t: t.replace(msg_id, {"type": "text", "text": new_text}))
+
+    def merge_message_payload(self, msg_id: int, extra: Dict):
+        """Shallow-merge extra keys into a message's JSON payload (media pipeline results)."""
+        with self.transaction():
+            r = self._sql("SELECT channel, payload FROM messages WHERE id=?", (msg_id,), fetch="one")
+            if not r: return
+            try:
+                payload = json.loads(r["payload"]) if r["payload"] else {}
+            except (json.JSONDecodeError, TypeError):
+                payload = {}
+            if not isinstance(payload, dict): payload = {"value": payload}
+            payload.update(extra)
+            raw = json.dumps(payload)
+            self._sql("UPDATE messages SET payload=? WHERE id=?", (raw, msg_id))
+            self._bump_history(r["channel"], lambda t: t.replace(msg_id, {"payload": raw}))
+
+    def replace_message_audio(self, msg_id: int, old_path: str, new_path: str, sha256: str, size: int) -> Optional[List[str]]:
+        """
+        Point a voice message at its transcoded blob. Returns the blob paths that
+        became unreferenced, or None if the message is gone or was changed meanwhile.
+        """
+        with self.transaction():
+            r = self._sql("UPDATE messages SET audio_path=? WHERE id=? AND audio_path=? RETURNING channel",
+                          (new_path, msg_id, old_path), fetch="all")
+            if not r:
+                return None
+            self._bump_history(r[0]["channel"], lambda t: t.replace(msg_id, {"audio_path": new_path}))
+            self.acquire_blob(new_path, sha256, size)
+            return self.release_blobs([old_path])
 
     def save_message(self, msg: Dict) -> int:
-        return self._sql("""
-            INSERT INTO messages(channel, alias, user_id, type, text, audio_path, image_path, file_path, image_url, file_url, file_name, payload, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (msg.get("channel"), msg.get("alias"), msg.get("user_id"), msg.get("type"), msg.get("text"),
-            msg.get("audio_path"), msg.get("image_path"), msg.get("file_path"), msg.get("image_url"),
-            msg.get("file_url"), msg.get("file_name"), msg.get("payload"), msg.get("created_at")))
-
-    def get_message(self, msg_id: int) -> Optional[Dict]:
+        channel, alias = msg.get("channel"), msg.get("alias")
+        with self.transaction():
+            msg_id = self._sql(INSERT_MESSAGE_SQL, tuple(msg.get(c) for c in MESSAGE_COLUMNS))
+            self._sql("""
+                INSERT INTO channel_summary(channel_key, last_message_id, last_alias, last_type, last_snippet, last_ts, message_count)
+                VALUES (?,?,?,?,?,?,1)
+                ON CONFLICT(channel_key) DO UPDATE SET
+                    last_message_id=excluded.last_message_id, last_alias=excluded.last_alias, last_type=excluded.last_type,
+                    last_snippet=excluded.last_snippet, last_ts=excluded.last_ts, message_count=message_count+1
+            """, (channel, msg_id, alias, msg.get("type"), (msg.get("text") or "")[:SNIPPET_LEN], msg.get("created_at")))
+            # Everyone else has one more unread; the sender has obviously read the channel
+            self._sql("UPDATE read_cursors SET unread=unread+1 WHERE channel_key=? AND alias IS NOT ?", (channel, alias))
+            self._sql("UPDATE read_cursors SET last_read_id=?, unread=0 WHERE channel_key=? AND alias=?", (msg_id, channel, alias))
+            self._bump_version("messages")
+            self._bump_history(channel, lambda t: t.append(self.message_from_insert(msg_id, msg), self.history.depth))
+        return msg_id
+
+    def message_from_insert(self, msg_id: int, msg: Dict) -> Message:
+        """What get_message(msg_id) would return right after save_message(msg), without the SELECT."""
+        return self._row_to_msg({"id": msg_id, **{c: msg.get(c) for c in MESSAGE_COLUMNS}})
+
+    def get_message(self, msg_id: int) -> Optional[Message]:
         r = self._sql("SELECT * FROM messages WHERE id=?", (msg_id,), fetch="one")
         return self._row_to_msg(r)
 
     def list_messages(self, channel: str, since_ts: int) -> List[Dict]:
         rows = self._sql("SELECT * FROM messages WHERE channel=? AND created_at>=? ORDER BY created_at ASC", (channel, since_ts), fetch="all")
-        return [self._row_to_msg(r) for r in rows]
+        return Message.from_rows(rows)
     
-    def delete_message(self, msg_id: int, alias: str, admin: bool = False) -> bool:
-        if admin:
+    def delete_message(self, msg_id: int, alias: str, admin: bool = False) -> Optional[List[str]]:
+        """
+        Delete a message and drop its blob references in the same transaction.
+        Returns the blob paths that became unreferenced (to unlink once this
+        returns), or None if the message is gone or isn't `alias`'s.
+        """
+        with self.transaction():
+            cols = "channel, alias, audio_path, image_path, file_path"
+            if admin:
+                r = self._sql(f"SELECT {cols} FROM messages WHERE id=?", (msg_id,), fetch="one")
+            else:
+                r = self._sql(f"SELECT {cols} FROM messages WHERE id=? AND alias=?", (msg_id, alias), fetch="one")
+            if not r:
+                return None
             self._sql("DELETE FROM messages WHERE id=?", (msg_id,))
-        else:
-            self._sql("DELETE FROM messages WHERE id=? AND alias=?", (msg_id, alias))
-        row = self._sql("SELECT changes() AS n", fetch="one")
-        return bool(row and row["n"])
+            channel = r["channel"]
+            self._sql("UPDATE channel_summary SET message_count=MAX(message_count-1, 0) WHERE channel_key=?", (channel,))
+            self._sql(SUMMARY_REFRESH_SQL + " WHERE channel_key=? AND last_message_id=?", (channel, msg_id))
+            self._sql("UPDATE read_cursors SET unread=MAX(unread-1, 0) WHERE channel_key=? AND alias IS NOT ? AND last_read_id < ?",
+                      (channel, r["alias"], msg_id))
+            self._bump_version("messages")
+            self._bump_history(channel, lambda t: t.remove([msg_id]))
+            paths = [p for p in (r["audio_path"], r["image_path"], r["file_path"]) if p]
+            return self.release_blobs(paths) if paths else []
 
     def upsert_channel(self, key: str, title: str, members: list[str]):
-        self._sql("""
-            INSERT INTO channels(key, title, members) VALUES (?,?,?)
-            ON CONFLICT(key) DO UPDATE SET title=excluded.title, members=excluded.members
-        """, (key, title, json.dumps(sorted(list(set(members))))))
+        members = sorted(set(members))
+        ch = self.channel_meta(key)
+        if ch and ch["title"] == title and ch["members"] == members:
+            return  # e.g. every worker re-asserting the public channel at startup
+        with self.transaction() as conn:
+            self._sql("""
+                INSERT INTO channels(key, title, members) VALUES (?,?,?)
+                ON CONFLICT(key) DO UPDATE SET title=excluded.title, members=excluded.members
+            """, (key, title, json.dumps(members)))
+            self._sql("DELETE FROM channel_members WHERE channel_key=?", (key,))
+            conn.executemany("INSERT INTO channel_members(channel_key, alias) VALUES (?,?)", [(key, m) for m in members])
+            # New members start caught up
+            conn.executemany("""
+                INSERT OR IGNORE INTO read_cursors(channel_key, alias, last_read_id)
+                VALUES (?, ?, COALESCE((SELECT last_message_id FROM channel_summary WHERE channel_key=?), 0))
+            """, [(key, m, key) for m in members])
+            self._bump_version("channels")
 
-    def get_channel(self, key: str) -> Optional[Dict]:
+    def _bump_version(self, name: str):
+        self._sql("INSERT INTO versions(name, version) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET version=version+1", (name,))
+
+    def _bump_history(self, channel: str, patch=None):
+        """A channel's messages changed: bump its history version; the cached tail follows on commit."""
+        r = self._sql("""
+            INSERT INTO versions(name, version) VALUES (?, 1)
+            ON CONFLICT(name) DO UPDATE SET version=version+1 RETURNING version
+        """, (f"messages:{channel}",), fetch="all")
+        version = r[0]["version"]
+        self._after_commit(lambda: self.history.patch(channel, version, patch))
+
+    def get_version(self, name: str) -> int:
+        r = self._sql("SELECT version FROM versions WHERE name=?", (name,), fetch="one")
+        return int(r["version"]) if r else 0
+
+    def _cache_channel(self, r, version: int) -> Dict:
+        """Cache a channels row, read at (or after) `version` of "channels"."""
+        ch = {"key": r["key"], "title": r["title"], "members": json.loads(r["members"] or "[]"),
+              "dm": r["key"].startswith("dm:"), "retention_seconds": r["retention_seconds"]}
+        self._channel_cache[ch["key"]] = (version, ch)
+        return ch
+
+    def channel_meta(self, key: str) -> Optional[Dict]:
+        """
+        Cached title/members/DM flag; callers must not mutate the result. A hit
+        costs one versions lookup, which is how changes from other workers show up.
+        """
+        version = self.get_version("channels")
+        hit = self._channel_cache.get(key)
+        if hit is not None and hit[0] == version:
+            return hit[1]
         r = self._sql("SELECT * FROM channels WHERE key=?", (key,), fetch="one")
         if not r: return None
-        return {"key": r["key"], "title": r["title"], "members": json.loads(r["members"] or "[]")}
+        return self._cache_channel(r, version)
+
+    def get_channel(self, key: str) -> Optional[Dict]:
+        ch = self.channel_meta(key)
+        return {**ch, "members": list(ch["members"])} if ch else None
 
     def get_or_create_public(self):
         ch = self.get_channel("public-1")
@@ -172,61 +660,326 @@ class DB:
         return ch
 
     def list_channels_for_user(self, alias: str):
-        # First ensure the public channel exists
+        # First ensure the public channel exists (a cache hit once it does)
         self.get_or_create_public()
-        
-        # Find all channels where this user is a member
+
+        # One indexed query: membership + channel + summary + this user's read cursor
         rows = self._sql("""
-            SELECT c.* FROM channels c, json_each(c.members) j
-            WHERE j.value = ?
+            SELECT c.key, c.title, c.members, c.retention_seconds,
+                   (SELECT version FROM versions WHERE name='channels') AS channels_version,
+                   s.last_message_id, s.last_alias, s.last_type, s.last_snippet, s.last_ts, s.message_count,
+                   r.last_read_id, r.unread
+            FROM channel_members m
+            JOIN channels c ON c.key = m.channel_key
+            LEFT JOIN channel_summary s ON s.channel_key = c.key
+            LEFT JOIN read_cursors r ON r.channel_key = c.key AND r.alias = m.alias
+            WHERE m.alias = ?
         """, (alias,), fetch="all")
         channels = []
         for r in rows:
-            ch = self.get_channel(r['key'])
-            if ch:
-                channels.append(ch)
+            ch = self._cache_channel(r, r["channels_version"] or 0)  # fresh row anyway: refresh the cache
+            summary = None
+            if r["last_message_id"] is not None:
+                summary = {"last_message_id": r["last_message_id"], "last_alias": r["last_alias"], "last_type": r["last_type"],
+                           "last_snippet": r["last_snippet"], "last_ts": r["last_ts"], "message_count": r["message_count"]}
+            channels.append({**ch, "members": list(ch["members"]), "summary": summary,
+                             "last_read_id": r["last_read_id"] or 0, "unread": r["unread"] or 0})
         # Sort: public channel first, then DM channels
         channels.sort(key=lambda c: (0 if c['key'].startswith('public') else 1, c['key']))
         return channels
 
+    def channel_list_version(self, alias: str) -> str:
+        """Changes whenever list_channels_for_user(alias) could: membership, messages or this user's reads."""
+        r = self._sql("""
+            SELECT (SELECT version FROM versions WHERE name='channels') AS c,
+                   (SELECT version FROM versions WHERE name='messages') AS m,
+                   (SELECT version FROM versions WHERE name=?) AS r
+        """, (f"reads:{alias}",), fetch="one")
+        return f"{r['c'] or 0}.{r['m'] or 0}.{r['r'] or 0}"
+
+    def mark_read(self, channel_key: str, alias: str, upto_id: Optional[int] = None) -> Optional[Dict]:
+        """Move a member's read cursor forward (to the newest message by default). None if not a member."""
+        with self.transaction():
+            cur = self._sql("SELECT last_read_id FROM read_cursors WHERE channel_key=? AND alias=?", (channel_key, alias), fetch="one")
+            if cur is None:
+                return None
+            s = self._sql("SELECT last_message_id FROM channel_summary WHERE channel_key=?", (channel_key,), fetch="one")
+            last = (s["last_message_id"] if s else None) or 0
+            upto = max(cur["last_read_id"], last if upto_id is None else min(int(upto_id), last))
+            if upto >= last:
+                unread = 0
+            else:
+                unread = self._sql("SELECT COUNT(*) AS n FROM messages WHERE channel=? AND id>? AND alias IS NOT ?",
+                                   (channel_key, upto, alias), fetch="one")["n"]
+            self._sql("UPDATE read_cursors SET last_read_id=?, unread=? WHERE channel_key=? AND alias=?",
+                      (upto, unread, channel_key, alias))
+            self._bump_version(f"reads:{alias}")
+        return {"channel": channel_key, "last_read_id": upto, "unread": unread}
+
+    def set_channel_retention(self, key: str, seconds: Optional[int]) -> bool:
+        with self.transaction():
+            self._sql("UPDATE channels SET retention_seconds=? WHERE key=?", (seconds, key))
+            row = self._sql("SELECT changes() AS n", fetch="one")
+            if not (row and row["n"]):
+                return False
+            self._bump_version("channels")
+        return True
+
     def get_channel_members(self, key: str) -> list[str]:
-        ch = self.get_channel(key)
-        return ch["members"] if ch else []
-    
+        ch = self.channel_meta(key)
+        return list(ch["members"]) if ch else []
+
+    def co_members(self, alias: str) -> set:
+        """Everyone who shares a channel with `alias` (alias included if they are in any)."""
+        rows = self._sql("""
+            SELECT DISTINCT m2.alias FROM channel_members m1
+            JOIN channel_members m2 ON m2.channel_key = m1.channel_key
+            WHERE m1.alias = ?
+        """, (alias,), fetch="all")
+        return {r["alias"] for r in rows}
+
+    def search_messages(self, alias: str, query: str, channel: Optional[str] = None,
+                        limit: int = 20, offset: int = 0) -> Tuple[List[Dict], bool]:
+        """
+        Messages in `alias`'s channels matching every word of `query`, best
+        match first (bm25). Returns (page, has_more).
+
+        Words of 3+ characters go through the trigram index; shorter ones
+        (common in Korean) are applied as LIKE filters. A query with only
+        short words is a LIKE scan, newest first.
+        """
+        words = [w for w in query.split() if w]
+        if not words:
+            return [], False
+        self._schema.ensure()  # sets fts_enabled
+        long_words = [w for w in words if len(w) >= 3] if self.fts_enabled else []
+        short_words = [w for w in words if w not in long_words]
+
+        where = ["m.channel IN (SELECT channel_key FROM channel_members WHERE alias=?)"]
+        args: list = [alias]
+        if channel:
+            where.append("m.channel=?")
+            args.append(channel)
+        for w in short_words:
+            pat = "%" + w.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            where.append("(m.text LIKE ? ESCAPE '\\' OR m.file_name LIKE ? ESCAPE '\\')")
+            args += [pat, pat]
+
+        if long_words:
+            match = " AND ".join('"' + w.replace('"', '""') + '"' for w in long_words)
+            sql = f"""
+                SELECT m.* FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH ? AND {" AND ".join(where)}
+                ORDER BY bm25(messages_fts), m.id DESC LIMIT ? OFFSET ?
+            """
+            args = [match] + args
+        else:
+            sql = f"""
+                SELECT m.* FROM messages m WHERE {" AND ".join(where)}
+                ORDER BY m.created_at DESC, m.id DESC LIMIT ? OFFSET ?
+            """
+        rows = self._sql(sql, (*args, limit + 1, offset), fetch="all")
+        return Message.from_rows(rows[:limit]), len(rows) > limit
+
     def list_messages_between(self, channel: str, start_ts: int, end_ts: int) -> List[Dict]:
         rows = self._sql("SELECT * FROM messages WHERE channel=? AND created_at>=? AND created_at<=? ORDER BY created_at ASC", (channel, start_ts, end_ts), fetch="all")
-        return [self._row_to_msg(r) for r in rows]
+        return Message.from_rows(rows)
+
+    def list_messages_page(self, channel: str, limit: int, before: Optional[tuple] = None) -> List[Dict]:
+        """
+        Newest-first keyset page: up to `limit` messages strictly older than
+        `before` = (created_at, id), or the newest ones if before is None.
+        """
+        if before is None:
+            rows = self._sql("SELECT * FROM messages WHERE channel=? ORDER BY created_at DESC, id DESC LIMIT ?", (channel, limit), fetch="all")
+        else:
+            rows = self._sql("""
+                SELECT * FROM messages WHERE channel=? AND (created_at, id) < (?, ?)
+                ORDER BY created_at DESC, id DESC LIMIT ?
+            """, (channel, before[0], before[1], limit), fetch="all")
+        return Message.from_rows(rows)
+
+    # ------------------- hot history -------------------
+    def _history_tail(self, channel: str) -> Tuple[Tail, int, bool]:
+        """The channel's cached tail, its version, and whether it had to be (re)filled."""
+        # Version first: rows read after it can only be newer, which the next read catches
+        version = self.get_version(f"messages:{channel}")
+        tail = self.history.get(channel, version)
+        if tail is not None:
+            return tail, version, False
+        depth = self.history.depth
+        rows = self.list_messages_page(channel, depth + 1)
+        rows.reverse()
+        tail = Tail(rows[-depth:], len(rows) <= depth, version)
+        self.history.put(channel, tail)
+        return tail, version, True
+
+    def history_page(self, channel: str, limit: int, before: Optional[tuple] = None) -> Tuple[List[Message], bool, int]:
+        """
+        Cursor page, oldest first: (messages, has_more, version). Served from the
+        hot-history cache when it covers the page, else from SQLite.
+        """
+        tail, version, filled = self._history_tail(channel)
+        hit = tail.page(limit, before)
+        self.history.count(hit is not None and not filled)
+        if hit is not None:
+            return hit[0], hit[1], version
+        rows = self.list_messages_page(channel, limit + 1, before)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_more, version
+
+    def history_window(self, channel: str, start_ts: int, end_ts: int) -> Tuple[List[Message], bool, int]:
+        """Time-window history: (messages, has_more, version), from the cache when it reaches back far enough."""
+        tail, version, filled = self._history_tail(channel)
+        hit = tail.window(start_ts, end_ts)
+        self.history.count(hit is not None and not filled)
+        if hit is not None:
+            return hit[0], hit[1], version
+        rows = self.list_messages_between(channel, start_ts, end_ts)
+        return rows, self.count_messages_before(channel, start_ts) > 0, version
 
     def count_messages_before(self, channel: str, ts: int) -> int:
         r = self._sql("SELECT COUNT(1) AS c FROM messages WHERE channel=? AND created_at<?", (channel, ts), fetch="one")
         return int(r["c"] if r else 0)
 
-    def prune_messages_and_return_audio_paths(self, cutoff: int) -> List[str]:
-        rows = self._sql("SELECT audio_path, image_path, file_path FROM messages WHERE created_at < ?", (cutoff,), fetch="all")
-        paths = []
-        for r in rows:
-            if r["audio_path"]: paths.append(r["audio_path"])
-            if r["image_path"]: paths.append(r["image_path"])
-            if r["file_path"]: paths.append(r["file_path"])
-        self._sql("DELETE FROM messages WHERE created_at < ?", (cutoff,))
-        return paths
+    def acquire_blob(self, path: str, sha256: str, size: int):
+        self._sql("""
+            INSERT INTO blobs(path, sha256, size, refcount, created_at) VALUES (?,?,?,1,?)
+            ON CONFLICT(path) DO UPDATE SET refcount=refcount+1
+        """, (path, sha256, size, self._now()))
 
-    def _row_to_msg(self, r) -> Optional[Dict]:
-        if not r: return None
-        out = dict(r)
-        if out.get("payload"):
-            try:
-                out["payload"] = json.loads(out["payload"])
-            except (json.JSONDecodeError, TypeError):
-                out["payload"] = None # Or handle error appropriately
-        # Generate URLs for files
-        if out.get("audio_path"):
-            out["audio_url"] = f"/media/{os.path.basename(out['audio_path'])}"
-        if out.get("image_path"):
-            out["image_url"] = f"/uploads/{os.path.basename(out['image_path'])}"
-        if out.get("file_path"):
-            out["file_url"] = f"/uploads/{os.path.basename(out['file_path'])}"
-        return out
+    def release_blobs(self, paths: List[str]) -> List[str]:
+        """Drop one reference per path; returns the paths nothing references any more."""
+        freed = []
+        with self.transaction():
+            for p in paths:
+                if not p: continue
+                r = self._sql("SELECT refcount FROM blobs WHERE path=?", (p,), fetch="one")
+                if r is None:
+                    freed.append(p)  # pre-dedup upload: it was only ever this message's
+                elif r["refcount"] <= 1:
+                    self._sql("DELETE FROM blobs WHERE path=?", (p,))
+                    freed.append(p)
+                else:
+                    self._sql("UPDATE blobs SET refcount=refcount-1 WHERE path=?", (p,))
+        return freed
+
+    def message_for_key(self, alias: str, key: str) -> Optional[int]:
+        r = self._sql("SELECT message_id FROM message_keys WHERE alias=? AND key=?", (alias, key), fetch="one")
+        return r["message_id"] if r else None
+
+    def remember_message_key(self, alias: str, key: str, msg_id: int):
+        self._sql("INSERT INTO message_keys(alias, key, message_id, created_at) VALUES (?,?,?,?)",
+                  (alias, key, msg_id, self._now()))
+
+    def prune_message_keys(self, cutoff: int, limit: int = 500) -> int:
+        """Delete up to `limit` idempotency keys older than cutoff; returns how many went."""
+        self._sql("""
+            DELETE FROM message_keys WHERE (alias, key) IN (
+                SELECT alias, key FROM message_keys WHERE created_at < ? ORDER BY created_at LIMIT ?
+            )
+        """, (cutoff, limit))
+        row = self._sql("SELECT changes() AS n", fetch="one")
+        return int(row["n"]) if row else 0
+
+    def blob_refcount(self, path: str) -> int:
+        r = self._sql("SELECT refcount FROM blobs WHERE path=?", (path,), fetch="one")
+        return int(r["refcount"]) if r else 0
+
+    def blob_sha_in_use(self, sha256: str) -> bool:
+        return self._sql("SELECT 1 FROM blobs WHERE sha256=? LIMIT 1", (sha256,), fetch="one") is not None
+
+    def append_event(self, channel: str, event: str, data) -> int:
+        """Log a channel event and return its sequence number (monotonic per channel)."""
+        return self._sql("INSERT INTO channel_events(channel, event, data, created_at) VALUES (?,?,?,?)",
+                         (channel, event, encode(data).decode("utf-8"), self._now()))
+
+    def list_events_since(self, channel: str, seq: int, limit: int = 1000) -> List[Dict]:
+        rows = self._sql("SELECT seq, event, data FROM channel_events WHERE channel=? AND seq>? ORDER BY seq ASC LIMIT ?",
+                         (channel, seq, limit), fetch="all")
+        return [{"seq": r["seq"], "event": r["event"], "data": loads(r["data"])} for r in rows]
+
+    def latest_event_seq(self, channel: Optional[str] = None) -> int:
+        """Newest seq for a channel, or across all channels (seq is one global sequence)."""
+        if channel is None:
+            r = self._sql("SELECT MAX(seq) AS s FROM channel_events", fetch="one")
+        else:
+            r = self._sql("SELECT MAX(seq) AS s FROM channel_events WHERE channel=?", (channel,), fetch="one")
+        return int(r["s"] or 0) if r else 0
+
+    def prune_events(self, cutoff: int, limit: int = 500) -> int:
+        """Delete up to `limit` of the oldest events before cutoff; returns how many went."""
+        self._sql("""
+            DELETE FROM channel_events WHERE seq IN (
+                SELECT seq FROM channel_events WHERE created_at < ? ORDER BY seq LIMIT ?
+            )
+        """, (cutoff, limit))
+        row = self._sql("SELECT changes() AS n", fetch="one")
+        return int(row["n"]) if row else 0
+
+    def retention_targets(self) -> List[Tuple[str, Optional[int]]]:
+        """(channel, retention_seconds or None) for every channel that has messages."""
+        rows = self._sql("""
+            SELECT s.channel_key, c.retention_seconds FROM channel_summary s
+            LEFT JOIN channels c ON c.key = s.channel_key
+            WHERE s.message_count > 0
+        """, fetch="all")
+        return [(r["channel_key"], r["retention_seconds"]) for r in rows]
+
+    def prune_channel_batch(self, channel: str, cutoff: int, limit: int = 200) -> Tuple[int, List[str]]:
+        """
+        Delete up to `limit` of a channel's oldest messages created before cutoff,
+        in one short transaction. Returns (deleted, blob paths nothing references any more).
+        Summary and unread counters are adjusted by what was actually deleted.
+        """
+        with self.transaction():
+            rows = self._sql("""
+                SELECT id, alias, audio_path, image_path, file_path FROM messages
+                WHERE channel=? AND created_at < ? ORDER BY created_at, id LIMIT ?
+            """, (channel, cutoff, limit), fetch="all")
+            if not rows:
+                return 0, []
+            ids = [r["id"] for r in rows]
+            marks = ",".join("?" * len(ids))
+            self._sql(f"DELETE FROM messages WHERE id IN ({marks})", tuple(ids))
+            self._sql("UPDATE channel_summary SET message_count=MAX(message_count-?, 0) WHERE channel_key=?", (len(ids), channel))
+            self._sql(SUMMARY_REFRESH_SQL + f" WHERE channel_key=? AND last_message_id IN ({marks})", (channel, *ids))
+            for c in self._sql("SELECT alias, last_read_id FROM read_cursors WHERE channel_key=?", (channel,), fetch="all"):
+                n = sum(1 for r in rows if r["id"] > c["last_read_id"] and r["alias"] != c["alias"])
+                if n:
+                    self._sql("UPDATE read_cursors SET unread=MAX(unread-?, 0) WHERE channel_key=? AND alias=?",
+                              (n, channel, c["alias"]))
+            self._bump_version("messages")
+            self._bump_history(channel, lambda t: t.remove(ids))
+            paths = [p for r in rows for p in (r["audio_path"], r["image_path"], r["file_path"]) if p]
+            # only hand back files no surviving message still references
+            freed = self.release_blobs(paths)
+        return len(ids), freed
+
+    def referenced_media_names(self) -> set:
+        """Base names of every file a message or blob row still points at (orphan sweep)."""
+        rows = self._sql("""
+            SELECT audio_path AS p FROM messages WHERE audio_path IS NOT NULL
+            UNION SELECT image_path FROM messages WHERE image_path IS NOT NULL
+            UNION SELECT file_path FROM messages WHERE file_path IS NOT NULL
+            UNION SELECT path FROM blobs WHERE refcount > 0
+        """, fetch="all")
+        return {os.path.basename(r["p"]) for r in rows}
+
+    def freelist_count(self) -> int:
+        r = self._sql("PRAGMA freelist_count", fetch="one")
+        return int(r[0]) if r else 0
+
+    def incremental_vacuum(self, pages: int = 128) -> int:
+        """Return up to `pages` free pages to the filesystem; returns how many are still free."""
+        # pages <= 0 would mean "all of them"; the pragma also runs one step per row fetched
+        self._sql(f"PRAGMA incremental_vacuum({max(int(pages), 1)})", fetch="all")
+        return self.freelist_count()
+
+    def _row_to_msg(self, r) -> Optional[Message]:
+        return Message.from_row(r)
     
     def _now(self) -> int:
         import time
@@ -0,0 +1,58 @@
+# fastjson.py
+"""
+JSON encoding for the hot paths (message bodies, SSE frames, pub/sub relay).
+
+Uses orjson when it is installed and JSON_BACKEND isn't "json"; otherwise
+the stdlib with compact separators. dumps() always returns UTF-8 bytes.
+
+FastJSONProvider plugs the same encoder into Flask's jsonify().
+"""
+import os
+import json
+from typing import Any
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if os.environ.get("JSON_BACKEND", "auto").lower() == "json":
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def _std_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+if orjson is not None:
+    _OPTS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj, option=_OPTS)
+        except TypeError:
+            return _std_dumps(obj)  # e.g. ints beyond 64 bits
+
+    loads = orjson.loads
+else:
+    dumps = _std_dumps
+    loads = json.loads
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify() through dumps() above; anything it can't encode goes the Flask way."""
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            body = dumps(obj)
+        except TypeError:
+            return super().response(obj)
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+    def loads(self, s, **kwargs):
+        return super().loads(s, **kwargs) if kwargs else loads(s)
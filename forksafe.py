@@ -0,0 +1,42 @@
+# forksafe.py
+"""
+Per-process lazy start for objects built at import time.
+
+gunicorn may import the app once and fork workers from it; threads, sockets
+and timers created before the fork don't carry over into the children. Such
+objects hold a PerProcess(start) and call .ensure() before use: start() then
+runs once in each process, the first time that process needs it.
+
+gevent_patched() tells whether this process runs under gevent's
+monkey-patching, where threads are greenlets on one OS thread.
+"""
+import os
+import threading
+from typing import Callable
+
+
+def gevent_patched() -> bool:
+    try:
+        from gevent import monkey
+        return monkey.is_module_patched("threading")
+    except ImportError:
+        return False
+
+
+class PerProcess:
+    __slots__ = ("_start", "_pid", "_lock")
+
+    def __init__(self, start: Callable[[], None]):
+        self._start = start
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure(self):
+        """Run start() unless it already ran in this process; concurrent callers wait for it."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._start()
+            self._pid = os.getpid()  # only once it worked: a failed start is retried
@@ -0,0 +1,136 @@
+# history.py
+"""
+In-memory hot-history cache: the newest messages of recently opened channels.
+
+Each cached tail is tagged with the channel's "messages:<channel>" version
+from the versions table, which every write to that channel's messages bumps
+(in any worker). A read only trusts a tail whose version matches the
+database, so writes from other processes invalidate it for free.
+
+Writes in this process patch the tail after their transaction commits
+(DB._after_commit): a patch for version v applies only to the tail at v-1,
+anything else drops the tail and the next read refills it.
+
+Tails hold Message objects, so their JSON is encoded once and reused by every
+response that serves them. Patches replace a tail's list rather than mutating
+it and get() hands out a snapshot, so readers slice without holding the lock.
+"""
+import bisect
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from messages import Message
+
+
+def _key(m: Message) -> Tuple[int, int]:
+    return (m.get("created_at") or 0, m["id"])
+
+
+class Tail:
+    """The newest messages of one channel, oldest first. complete: nothing older exists."""
+
+    __slots__ = ("msgs", "complete", "version")
+
+    def __init__(self, msgs: List[Message], complete: bool, version: int):
+        self.msgs = msgs
+        self.complete = complete
+        self.version = version
+
+    def page(self, limit: int, before: Optional[Tuple[int, int]] = None) -> Optional[Tuple[List[Message], bool]]:
+        """Up to `limit` messages older than `before`, oldest first, and has_more; None if not covered."""
+        msgs = self.msgs
+        i = len(msgs) if before is None else bisect.bisect_left(msgs, tuple(before), key=_key)
+        if i >= limit:
+            return msgs[i - limit:i], i > limit or not self.complete
+        if self.complete:
+            return msgs[:i], False
+        return None
+
+    def window(self, start_ts: int, end_ts: int) -> Optional[Tuple[List[Message], bool]]:
+        """Messages with start_ts <= created_at <= end_ts and whether older ones exist; None if not covered."""
+        msgs = self.msgs
+        reaches_back = bool(msgs) and (msgs[0].get("created_at") or 0) < start_ts
+        if not (reaches_back or self.complete):
+            return None
+        lo = bisect.bisect_left(msgs, start_ts, key=lambda m: m.get("created_at") or 0)
+        hi = bisect.bisect_right(msgs, end_ts, key=lambda m: m.get("created_at") or 0)
+        return msgs[lo:hi], reaches_back
+
+    # Patches: each returns nothing and replaces self.msgs (copy-on-write)
+    def append(self, msg: Message, depth: int):
+        if self.msgs and _key(msg) < _key(self.msgs[-1]):
+            raise ValueError("out of order")  # let the next read refill instead
+        msgs = self.msgs + [msg]
+        if len(msgs) > depth:
+            msgs = msgs[len(msgs) - depth:]
+            self.complete = False
+        self.msgs = msgs
+
+    def replace(self, msg_id: int, changes: Dict):
+        msgs = list(self.msgs)
+        for i, m in enumerate(msgs):
+            if m["id"] == msg_id:
+                row = {k: v for k, v in m.items() if k != "image_variants"}
+                row.update(changes)
+                msgs[i] = Message.from_row(row)
+                self.msgs = msgs
+                return
+
+    def remove(self, ids: Iterable[int]):
+        ids = set(ids)
+        self.msgs = [m for m in self.msgs if m["id"] not in ids]
+
+
+class HistoryCache:
+    def __init__(self, channels: int = 64, depth: int = 500):
+        self.channels = channels
+        self.depth = depth
+        self._lock = threading.Lock()
+        self._tails: "OrderedDict[str, Tail]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "fills": 0, "patches": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, channel: str, version: int) -> Optional[Tail]:
+        """A snapshot of the channel's tail if it is at `version`."""
+        with self._lock:
+            t = self._tails.get(channel)
+            if t is None or t.version != version:
+                return None
+            self._tails.move_to_end(channel)
+            return Tail(t.msgs, t.complete, t.version)
+
+    def put(self, channel: str, tail: Tail):
+        with self._lock:
+            self._tails[channel] = tail
+            self._tails.move_to_end(channel)
+            self.stats["fills"] += 1
+            while len(self._tails) > self.channels:
+                self._tails.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def patch(self, channel: str, version: int, fn: Optional[Callable[[Tail], None]]):
+        """Apply a committed write that moved the channel to `version`; drop the tail if it can't follow."""
+        with self._lock:
+            t = self._tails.get(channel)
+            if t is None:
+                return
+            if fn is None or t.version != version - 1:
+                del self._tails[channel]
+                self.stats["invalidations"] += 1
+                return
+            try:
+                fn(t)
+            except Exception:
+                del self._tails[channel]
+                self.stats["invalidations"] += 1
+                return
+            t.version = version
+            self.stats["patches"] += 1
+
+    def count(self, hit: bool):
+        self.stats["hits" if hit else "misses"] += 1
+
+    def size(self) -> Tuple[int, int]:
+        """(cached channels, cached messages)"""
+        with self._lock:
+            return len(self._tails), sum(len(t.msgs) for t in self._tails.values())
@@ -0,0 +1,156 @@
+# ingest.py
+"""
+Write-behind message ingestion.
+
+POST /api/messages hands the message to MessageWriter.submit() and waits.
+A single writer thread drains the queue and stores everything it found in
+one transaction (group commit):
+
+- created_at is assigned here, ids come from the INSERT,
+- an uploaded blob is acquired together with the message that references it,
+  and re-linked from the upload's spare copy if it was unlinked meanwhile,
+- a client idempotency key is checked and recorded in the same savepoint, so
+  a retry can't store the message twice (even while the first is queued),
+- the "message" channel event is appended (its seq) in the same transaction,
+- the stored message is built from what was inserted (no read-back SELECT),
+- right after COMMIT every event is published and every waiter released.
+
+One bad message only rolls back its own savepoint, not the batch.
+"""
+import os
+import time
+import threading
+from queue import Queue, Empty, Full
+from typing import Callable, List, Optional, Tuple
+
+from forksafe import PerProcess
+
+
+class IngestError(RuntimeError):
+    pass
+
+
+class IngestTimeout(IngestError):
+    """The writer hasn't answered yet; the message may still be stored."""
+
+
+class IngestDuplicate(IngestError):
+    """The idempotency key was already used; message_id is the message it created."""
+
+    def __init__(self, message_id: int):
+        super().__init__(f"duplicate of message {message_id}")
+        self.message_id = message_id
+
+
+class _Job:
+    __slots__ = ("msg", "extra", "blob", "key", "done", "result", "error")
+
+    def __init__(self, msg: dict, extra: Optional[dict], blob: Optional[Tuple[str, str, int, Optional[str]]],
+                 key: Optional[str]):
+        self.msg = msg
+        self.extra = extra
+        self.blob = blob
+        self.key = key
+        self.done = threading.Event()
+        self.result: Optional[dict] = None
+        self.error: Optional[BaseException] = None
+
+
+class MessageWriter:
+    def __init__(self, db, publish: Callable[[str, dict], None], max_batch: int = 128, max_queue: int = 10000):
+        self.db = db
+        self._publish = publish
+        self.max_batch = max_batch
+        self._q: Queue = Queue(maxsize=max_queue)
+        self._started = PerProcess(self._start)
+        self.stats = {"messages": 0, "batches": 0, "failed": 0, "duplicates": 0, "max_batch": 0}
+
+    def _start(self):
+        threading.Thread(target=self._run, daemon=True, name="ingest-writer").start()
+
+    def submit(self, msg: dict, event_extra: Optional[dict] = None,
+               blob: Optional[Tuple[str, str, int, Optional[str]]] = None, key: Optional[str] = None,
+               timeout: float = 10.0) -> dict:
+        """
+        Store a message and publish its "message" event; returns the stored
+        message (as get_message would). event_extra is merged into the event's
+        data only (e.g. the rendered notification). blob=(path, sha256, size,
+        spare) takes a reference on the upload in the same savepoint as the
+        insert (spare: see media.persist_upload).
+        With a key (unique per sender), a message already stored under it
+        raises IngestDuplicate instead of being stored again.
+        """
+        self._started.ensure()
+        job = _Job(msg, event_extra, blob, key)
+        try:
+            self._q.put(job, timeout=timeout)
+        except Full:
+            raise IngestError("ingest queue full")
+        if not job.done.wait(timeout):
+            raise IngestTimeout("ingest timed out")
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run(self):
+        while True:
+            batch = [self._q.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._q.get_nowait())
+                except Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print("[INGEST] batch failed:", e, flush=True)
+                for job in batch:
+                    if not job.done.is_set():
+                        job.error = job.error or e
+                        job.done.set()
+
+    def _write(self, batch: List[_Job]):
+        events = []
+        with self.db.transaction():
+            now = int(time.time())
+            for job in batch:
+                msg = dict(job.msg)
+                msg.setdefault("created_at", now)
+                try:
+                    with self.db.savepoint("ingest"):
+                        if job.key:
+                            dup = self.db.message_for_key(msg.get("alias"), job.key)
+                            if dup is not None:
+                                raise IngestDuplicate(dup)
+                        if job.blob:
+                            path, sha256, size, spare = job.blob
+                            self.db.acquire_blob(path, sha256, size)
+                            if spare and not os.path.exists(path):
+                                os.link(spare, path)  # deduplicated against a blob that was unlinked since
+                        msg_id = self.db.save_message(msg)
+                        if job.key:
+                            self.db.remember_message_key(msg.get("alias"), job.key, msg_id)
+                        out = self.db.message_from_insert(msg_id, msg)
+                        data = out.with_extra(job.extra) if job.extra else out
+                        seq = self.db.append_event(out["channel"], "message", data)
+                except IngestDuplicate as e:
+                    job.error = e
+                    self.stats["duplicates"] += 1
+                    continue
+                except Exception as e:
+                    job.error = e
+                    self.stats["failed"] += 1
+                    continue
+                job.result = out
+                events.append((out["channel"], {"event": "message", "data": data, "seq": seq}))
+        self.stats["batches"] += 1
+        self.stats["messages"] += len(events)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        # Committed: fan out first, then let the requests answer
+        for channel, event in events:
+            try:
+                self._publish(channel, event)
+            except Exception as e:
+                print("[INGEST] publish failed:", e, flush=True)
+        for job in batch:
+            job.done.set()
@@ -0,0 +1,444 @@
+# media.py
+"""
+Upload pipeline for voice notes, images and files.
+
+Multipart file parts are streamed by Werkzeug straight into a BlobWriter
+(via UploadRequest._get_file_stream) instead of a spooled temp file. The
+writer hashes the bytes as they arrive and aborts with 413 as soon as the
+per-type size limit is crossed. persist_upload() then moves the temp file to
+its content-addressed name (<sha256><ext>) in MEDIA_DIR/UPLOAD_DIR; if that
+blob already exists the new copy stays in storage/tmp as a spare until the
+request ends, in case the existing file is unlinked before the message takes
+its reference (the ingest writer re-links it from the spare).
+
+Blob reference counts live in the `blobs` table (see DB.acquire_blob /
+DB.release_blobs), so a file is only unlinked once no message uses it.
+
+Images then get resized variants (<sha256>.<variant>.webp next to the
+original) rendered on an OffloadPool. That pool uses real OS threads, so
+Pillow doesn't stall the gevent loop. Pillow is optional: without it
+messages simply have no variants.
+
+send_blob() serves these files. Names never change content, so responses
+are immutable for a year, carry a strong ETag and honour Range requests.
+With MEDIA_SENDFILE set, the bytes are handed off to the front server
+(X-Sendfile or nginx X-Accel-Redirect).
+
+Voice notes go through ffmpeg when it is installed. They are re-encoded to
+small mono AAC (another content-addressed blob), and the duration and a
+peak waveform are measured so the client can draw the bubble without
+downloading the audio.
+"""
+import os
+import re
+import sys
+import shutil
+import hashlib
+import mimetypes
+import time
+import tempfile
+import traceback
+import subprocess
+from array import array
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from flask import Request, Response, abort, current_app, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+
+from forksafe import PerProcess, gevent_patched
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # variants are an optimization, not a requirement
+    Image = ImageOps = None
+
+MB = 1024 * 1024
+TMP_DIR = Path("storage/tmp")  # same filesystem as storage/audio and storage/uploads
+TMP_DIR.mkdir(parents=True, exist_ok=True)
+
+SIZE_LIMITS = {
+    "audio": int(float(os.environ.get("UPLOAD_MAX_AUDIO_MB", 20)) * MB),
+    "image": int(float(os.environ.get("UPLOAD_MAX_IMAGE_MB", 25)) * MB),
+    "file": int(float(os.environ.get("UPLOAD_MAX_FILE_MB", 100)) * MB),
+}
+CHUNK = 64 * 1024
+
+# name -> longest edge in px. thumb covers the 260px chat bubble at 2x DPR.
+IMAGE_VARIANTS = (("thumb", 520), ("screen", 1280))
+_BLOB_NAME = re.compile(r"^[0-9a-f]{64}\.")
+
+MEDIA_MAX_AGE = 365 * 24 * 3600
+# "" (serve from Python), "x-sendfile" (Apache/lighttpd) or "x-accel" (nginx)
+MEDIA_SENDFILE = os.environ.get("MEDIA_SENDFILE", "").lower()
+# nginx: `location /_media/ { internal; alias /app/storage/; }`
+MEDIA_ACCEL_PREFIX = os.environ.get("MEDIA_ACCEL_PREFIX", "/_media").rstrip("/")
+# Already-compressed payloads; gzipping them burns CPU for nothing and breaks Range
+INCOMPRESSIBLE = ("audio/", "video/", "image/jpeg", "image/png", "image/gif", "image/webp", "image/avif",
+                  "application/zip", "application/gzip", "application/pdf", "application/octet-stream")
+
+FFMPEG = shutil.which(os.environ.get("FFMPEG_BIN", "ffmpeg"))
+# AAC-LC in MP4 plays in every browser we care about, iOS Safari included
+VOICE_EXT = ".m4a"
+VOICE_ENCODE = ["-c:a", "aac", "-b:a", os.environ.get("VOICE_BITRATE", "32k"), "-ac", "1", "-ar", "24000",
+                "-movflags", "+faststart"]
+WAVEFORM_BARS = 32
+WAVEFORM_RATE = 4000  # Hz of the PCM we measure peaks on; plenty for a few dozen bars
+
+
+def is_content_addressed(name: str) -> bool:
+    """True for <sha256>... names, whose bytes never change."""
+    return bool(_BLOB_NAME.match(os.path.basename(name)))
+
+
+def kind_for(content_type: Optional[str]) -> str:
+    ct = (content_type or "").lower()
+    if ct.startswith("audio/"):
+        return "audio"
+    if ct.startswith("image/"):
+        return "image"
+    return "file"
+
+
+def limit_for(content_type: Optional[str]) -> int:
+    return SIZE_LIMITS[kind_for(content_type)]
+
+
+class BlobWriter:
+    """Writable/readable temp file that hashes what is written and enforces a size cap."""
+
+    def __init__(self, limit: int, content_type: Optional[str] = None):
+        self.limit = limit
+        self.content_type = content_type
+        self.size = 0
+        self._sha = hashlib.sha256()
+        self._f = tempfile.NamedTemporaryFile(dir=TMP_DIR, prefix="up-", delete=False)
+        self.path = self._f.name
+        self.persisted = False
+
+    def write(self, b) -> int:
+        self.size += len(b)
+        if self.size > self.limit:
+            self.close()  # nobody gets a handle on a rejected part: drop the partial file now
+            raise RequestEntityTooLarge(f"{kind_for(self.content_type)} uploads are limited to {self.limit // MB} MB")
+        self._sha.update(b)
+        return self._f.write(b)
+
+    def hexdigest(self) -> str:
+        return self._sha.hexdigest()
+
+    # what Werkzeug/FileStorage need from a file stream
+    def read(self, *a):
+        return self._f.read(*a)
+
+    def readline(self, *a):
+        return self._f.readline(*a)
+
+    def seek(self, *a):
+        return self._f.seek(*a)
+
+    def tell(self):
+        return self._f.tell()
+
+    def flush(self):
+        self._f.flush()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        try:
+            self._f.close()
+        finally:
+            if not self.persisted:
+                try: os.unlink(self.path)
+                except FileNotFoundError: pass
+
+    def __iter__(self):
+        return iter(self._f)
+
+
+class UploadRequest(Request):
+    """Streams multipart file parts into BlobWriters sized by the part's content type."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        limit = limit_for(content_type)
+        if total_content_length is not None and total_content_length > limit + 64 * 1024:
+            # The whole body is bigger than this part may ever be: fail before reading it
+            raise RequestEntityTooLarge()
+        return BlobWriter(limit, content_type)
+
+
+def persist_upload(file_storage, save_dir: Path, ext: str, kind: str) -> Tuple[str, str, int, Optional[str]]:
+    """
+    Move an uploaded file to its content-addressed path. Returns (path,
+    sha256, size, spare): spare is an identical temp copy, kept until the
+    request closes the upload, when the blob already existed; else None.
+    Falls back to copying the stream when it isn't a BlobWriter (e.g. non-multipart callers).
+    """
+    w = file_storage.stream
+    owned = not isinstance(w, BlobWriter)  # ours to close; the request closes its own streams
+    if owned:
+        src = w
+        w = BlobWriter(SIZE_LIMITS[kind], file_storage.mimetype)
+        while True:
+            chunk = src.read(CHUNK)
+            if not chunk:
+                break
+            w.write(chunk)
+    elif w.size > SIZE_LIMITS[kind]:
+        # The part's declared type was lax (e.g. octet-stream voice note); apply the real limit
+        w.close()
+        raise RequestEntityTooLarge(f"{kind} uploads are limited to {SIZE_LIMITS[kind] // MB} MB")
+
+    w.flush()
+    sha = w.hexdigest()
+    final = Path(save_dir) / f"{sha}{ext}"
+    spare = None
+    if not final.exists():
+        os.replace(w.path, final)
+        w.persisted = True
+        w.close()
+    elif owned:
+        w.close()  # same bytes already stored: drop this copy
+    else:
+        spare = w.path  # same bytes already stored; unlinked when the request closes the stream
+    return str(final), sha, w.size, spare
+
+
+def send_blob(directory: Path, fname: str) -> Response:
+    """Serve an immutable media file: strong ETag, Range, far-future caching, optional sendfile."""
+    path = safe_join(str(directory), fname)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    etag = os.path.basename(path)  # unique (sha256/uuid) and never reused for other bytes
+    if MEDIA_SENDFILE in ("x-sendfile", "x-accel"):
+        resp = current_app.response_class(mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream")
+        if MEDIA_SENDFILE == "x-accel":
+            rel = os.path.relpath(path, "storage")
+            resp.headers["X-Accel-Redirect"] = f"{MEDIA_ACCEL_PREFIX}/{rel}"
+        else:
+            resp.headers["X-Sendfile"] = os.path.abspath(path)
+        resp.set_etag(etag)
+        resp.make_conditional(request)  # 304 here; Range is the front server's job
+    else:
+        resp = send_file(path, request.environ, conditional=True, etag=etag, max_age=MEDIA_MAX_AGE,
+                         response_class=current_app.response_class)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = MEDIA_MAX_AGE
+    resp.cache_control.immutable = True
+    resp.compressible = False
+    return resp
+
+
+def is_compressible(resp: Response) -> bool:
+    return getattr(resp, "compressible", True) and not (resp.mimetype or "").startswith(INCOMPRESSIBLE)
+
+
+def variant_path(original: str, name: str) -> Path:
+    p = Path(original)
+    return p.with_name(f"{p.name.split('.', 1)[0]}.{name}.webp")
+
+
+def make_image_variants(path: str) -> Dict[str, str]:
+    """Render the IMAGE_VARIANTS of an image (once per blob). Returns {variant: file name}."""
+    if Image is None:
+        return {}
+    out = {}
+    with Image.open(path) as im:
+        if getattr(im, "is_animated", False):
+            return {}  # keep GIF/APNG animations as they are
+        im = ImageOps.exif_transpose(im)
+        has_alpha = im.mode in ("RGBA", "LA", "PA") or (im.mode == "P" and "transparency" in im.info)
+        base = im.convert("RGBA" if has_alpha else "RGB")
+        for name, edge in IMAGE_VARIANTS:
+            dst = variant_path(path, name)
+            if not dst.exists():
+                v = base.copy()
+                v.thumbnail((edge, edge), Image.LANCZOS)
+                # own temp file: two messages sharing a blob may render it concurrently
+                fd, tmp = tempfile.mkstemp(dir=dst.parent, prefix="vt-", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        v.save(f, "WEBP", quality=80, method=4)
+                    os.replace(tmp, dst)
+                finally:
+                    try: os.unlink(tmp)
+                    except FileNotFoundError: pass
+            out[name] = dst.name
+    return out
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def voice_waveform(path: str) -> Tuple[float, List[int]]:
+    """(duration in seconds, WAVEFORM_BARS peak levels 0..100) from ffmpeg-decoded mono PCM."""
+    pcm = subprocess.run(
+        [FFMPEG, "-v", "error", "-nostdin", "-i", path, "-vn", "-f", "s16le", "-ac", "1", "-ar", str(WAVEFORM_RATE), "-"],
+        capture_output=True, check=True, timeout=120,
+    ).stdout
+    samples = array("h")
+    samples.frombytes(pcm[: len(pcm) // 2 * 2])
+    if sys.byteorder == "big":
+        samples.byteswap()
+    n = len(samples)
+    if not n:
+        return 0.0, []
+    peaks = []
+    for i in range(WAVEFORM_BARS):
+        chunk = samples[i * n // WAVEFORM_BARS:(i + 1) * n // WAVEFORM_BARS]
+        peaks.append(max(max(chunk), -min(chunk)) if chunk else 0)
+    top = max(peaks) or 1
+    return round(n / WAVEFORM_RATE, 2), [round(p * 100 / top) for p in peaks]
+
+
+def transcode_voice(path: str) -> Optional[Tuple[str, str, int]]:
+    """
+    Re-encode a voice note next to the original as <sha256>.m4a. Returns
+    (path, sha256, size), or None when the result wouldn't be smaller.
+    """
+    fd, tmp = tempfile.mkstemp(dir=TMP_DIR, prefix="vo-", suffix=VOICE_EXT)
+    os.close(fd)
+    try:
+        # bitexact + no metadata: identical input gives an identical (deduplicated) blob
+        subprocess.run(
+            [FFMPEG, "-v", "error", "-nostdin", "-y", "-i", path, "-vn", "-map_metadata", "-1",
+             "-fflags", "+bitexact", "-flags:a", "+bitexact", *VOICE_ENCODE, tmp],
+            capture_output=True, check=True, timeout=300,
+        )
+        size = os.path.getsize(tmp)
+        if not size or size >= os.path.getsize(path):
+            return None
+        sha = _sha256_file(tmp)
+        final = Path(path).with_name(f"{sha}{VOICE_EXT}")
+        if not final.exists():
+            os.replace(tmp, final)
+        return str(final), sha, size
+    finally:
+        try: os.unlink(tmp)
+        except FileNotFoundError: pass
+
+
+def process_voice(path: str) -> Dict:
+    """Everything the voice pipeline learns about a note; {} without ffmpeg."""
+    if not FFMPEG:
+        return {}
+    out = {"transcoded": None}
+    if not path.endswith(VOICE_EXT):
+        out["transcoded"] = transcode_voice(path)
+    out["duration"], out["waveform"] = voice_waveform(out["transcoded"][0] if out["transcoded"] else path)
+    return out
+
+
+class OffloadPool:
+    """
+    Fixed-size pool for media work. done(result) runs back on our side: in a
+    greenlet under gevent, else on the pool thread.
+
+    real_threads=True is for CPU-bound Python work (Pillow) and uses real OS
+    threads even under gevent. Work that mostly waits on a child process
+    (ffmpeg) should pass False: a bounded set of greenlets is enough, and
+    gevent's subprocess support only works in the hub's own thread.
+    """
+
+    def __init__(self, workers: int = 2, real_threads: bool = True):
+        self.workers = workers
+        self.real_threads = real_threads
+        self._executor = None
+        self._hub_callback = False
+        self._started = PerProcess(self._start)
+
+    def _start(self):
+        if self.real_threads and gevent_patched():
+            from gevent.threadpool import ThreadPoolExecutor
+            self._hub_callback = True
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            self._hub_callback = False
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def submit(self, work: Callable, done: Optional[Callable] = None):
+        self._started.ensure()
+        fut = self._executor.submit(work)
+        if done is not None:
+            if self._hub_callback:
+                import gevent
+                gevent.spawn(self._finish, fut, done)
+            else:
+                fut.add_done_callback(lambda f: self._finish(f, done))
+        return fut
+
+    @staticmethod
+    def _finish(fut, done):
+        try:
+            result = fut.result()
+        except Exception:
+            traceback.print_exc()
+            return
+        try:
+            done(result)
+        except Exception:
+            traceback.print_exc()
+
+
+def unlink_unreferenced(db, paths):
+    """
+    Remove files whose blob refcount dropped to zero. The check and the unlink
+    share one write transaction, so no message can acquire the blob in between.
+    """
+    for p in paths or []:
+        try:
+            with db.transaction():
+                if db.blob_refcount(p) == 0:
+                    Path(p).unlink(missing_ok=True)
+                    sha = os.path.basename(p).split(".", 1)[0]
+                    if is_content_addressed(p) and not db.blob_sha_in_use(sha):
+                        for name, _ in IMAGE_VARIANTS:
+                            variant_path(p, name).unlink(missing_ok=True)
+        except Exception as e:
+            print("[MEDIA] rm failed:", p, e, flush=True)
+
+
+def sweep_orphans(db, dirs, grace: int = 3600) -> int:
+    """
+    Delete files in `dirs` that no message or blob references, plus stale
+    temp files. Anything younger than `grace` seconds is left alone (it may
+    belong to an upload that hasn't been saved yet).
+    """
+    referenced = db.referenced_media_names()
+    live_shas = {n.split(".", 1)[0] for n in referenced if is_content_addressed(n)}
+    cutoff = time.time() - grace
+    removed = 0
+    for d in [*dirs, TMP_DIR]:
+        try:
+            entries = list(os.scandir(d))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            name = entry.name
+            if name in referenced or not entry.is_file():
+                continue
+            if Path(d) != TMP_DIR and is_content_addressed(name) and name.split(".", 1)[0] in live_shas:
+                continue  # image variant of a live blob
+            try:
+                if entry.stat().st_mtime > cutoff:
+                    continue
+                os.unlink(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
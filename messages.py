@@ -0,0 +1,117 @@
+# messages.py
+"""
+Message objects as handed around by db.py, ingest.py and app.py.
+
+A Message is a dict (so every existing caller keeps working) that also
+carries its own JSON encoding, computed once on first use and then reused
+for the HTTP response, the SSE frame and the event log. with_extra() and
+envelope() splice those cached bytes instead of re-encoding the message.
+
+Treat a Message as read-only once built; assigning a key drops the cached
+bytes, but nested values (payload) are not tracked.
+"""
+from typing import Dict, List, Optional
+
+from fastjson import dumps, loads
+
+
+def _basename(path: str) -> str:
+    return path.rpartition("/")[2]
+
+
+class Message(dict):
+    __slots__ = ("_json",)  # left unset until first encoded, so construction stays at C speed
+
+    @classmethod
+    def from_row(cls, r) -> Optional["Message"]:
+        """Build from a messages row (sqlite3.Row or dict): payload parsed, media URLs added."""
+        if not r:
+            return None
+        return cls._finish(cls(r) if isinstance(r, dict) else cls(zip(r.keys(), r)))
+
+    @classmethod
+    def from_rows(cls, rows) -> List["Message"]:
+        """from_row for a result set; the column names are looked up once."""
+        if not rows:
+            return []
+        keys = rows[0].keys()
+        return [cls._finish(cls(zip(keys, r))) for r in rows]
+
+    @staticmethod
+    def _finish(out: "Message") -> "Message":
+        put = dict.__setitem__  # nothing cached yet, skip the invalidating override
+        payload = out.get("payload")
+        if payload and isinstance(payload, (str, bytes)):  # a dict is already parsed (cache patches)
+            try:
+                payload = loads(payload)
+            except (ValueError, TypeError):
+                payload = None
+            put(out, "payload", payload)
+        if out.get("audio_path"):
+            put(out, "audio_url", "/media/" + _basename(out["audio_path"]))
+        if out.get("image_path"):
+            put(out, "image_url", "/uploads/" + _basename(out["image_path"]))
+            if isinstance(payload, dict) and payload.get("variants"):
+                put(out, "image_variants", {k: "/uploads/" + v for k, v in payload["variants"].items()})
+        if out.get("file_path"):
+            put(out, "file_url", "/uploads/" + _basename(out["file_path"]))
+        return out
+
+    @property
+    def json(self) -> bytes:
+        data = getattr(self, "_json", None)
+        if data is None:
+            data = self._json = dumps(self)
+        return data
+
+    def with_extra(self, extra: Dict) -> "Message":
+        """A copy with extra keys (e.g. the notification), its JSON spliced from ours."""
+        out = Message(self)
+        out.update(extra)
+        if self and extra and not any(k in self for k in extra):
+            out._json = self.json[:-1] + b"," + dumps(extra)[1:]
+        return out
+
+    # Writes invalidate the cached encoding
+    def __setitem__(self, key, value):
+        self._json = None
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._json = None
+        super().__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self._json = None
+        super().update(*args, **kwargs)
+
+    def pop(self, *args):
+        self._json = None
+        return super().pop(*args)
+
+    def setdefault(self, key, default=None):
+        self._json = None
+        return super().setdefault(key, default)
+
+
+def encode(obj) -> bytes:
+    """JSON bytes for obj, reusing a Message's cached encoding."""
+    return obj.json if isinstance(obj, Message) else dumps(obj)
+
+
+def envelope(fields: Dict, **parts) -> bytes:
+    """
+    dumps({**fields, **parts}) where each part is a Message or a list of them,
+    spliced from their cached bytes: envelope({"ok": True}, messages=rows).
+    """
+    out = [dumps(fields)[:-1]]
+    sep = b"," if fields else b""
+    for key, value in parts.items():
+        if isinstance(value, (list, tuple)):
+            body = b"[" + b",".join(encode(m) for m in value) + b"]"
+        else:
+            body = encode(value)
+        out.append(sep + dumps(key) + b":" + body)
+        sep = b","
+    out.append(b"}")
+    return b"".join(out)
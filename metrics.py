@@ -0,0 +1,223 @@
+# metrics.py
+"""
+In-process instrumentation, exposed in the Prometheus text format on /metrics.
+
+- Metrics holds counters and fixed-bucket histograms keyed by name + labels,
+  plus collectors that are asked for their current values at scrape time
+  (the SSE hub, push dispatcher and ingest writer keep their own stats).
+- query_label() turns an SQL string into a low-cardinality label such as
+  "SELECT messages" or "UPDATE read_cursors" (cached per statement).
+- SamplingProfiler is an optional stack sampler producing collapsed stacks
+  ("a;b;c count", the flamegraph.pl input format).
+
+Every gunicorn worker has its own numbers; a scrape answers for the worker
+that served it (the pid label tells them apart).
+"""
+import os
+import re
+import sys
+import time
+import signal
+import bisect
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from forksafe import PerProcess, gevent_patched
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+_SQL_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+([A-Za-z_][A-Za-z0-9_]*)", re.I)
+
+
+@lru_cache(maxsize=1024)
+def query_label(sql: str) -> str:
+    words = sql.split(None, 1)
+    verb = words[0].upper() if words else "?"
+    if verb == "WITH":
+        verb = "SELECT"
+    m = _SQL_TABLE.search(sql)
+    return f"{verb} {m.group(1)}" if m else verb
+
+
+def _labels(labels: Optional[Dict[str, object]]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items())) if labels else ()
+
+
+def _fmt_labels(key: LabelKey, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, prefix: str = "koalatalk"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._hists: Dict[str, Dict[LabelKey, _Histogram]] = {}
+        self._help: Dict[str, str] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, Dict, float]]]] = []
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def inc(self, name: str, labels: Optional[Dict[str, object]] = None, n: float = 1):
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + n
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, object]] = None,
+                buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        key = _labels(labels)
+        with self._lock:
+            series = self._hists.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = _Histogram(buckets)
+            h.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, labels: Optional[Dict[str, object]] = None):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, labels)
+
+    def add_collector(self, fn: Callable[[], Iterable[Tuple[str, Dict, float]]]):
+        """fn() -> [(name, labels, value), ...], read as gauges at scrape time."""
+        self._collectors.append(fn)
+
+    def render(self) -> str:
+        p = self.prefix
+        pid = (("pid", str(os.getpid())),)
+        out = [f"# TYPE {p}_process_info gauge", f"{p}_process_info{_fmt_labels((), pid)} 1"]
+        with self._lock:
+            counters = {n: dict(s) for n, s in self._counters.items()}
+            hists = {n: {k: (list(h.counts), h.sum, h.count, h.buckets) for k, h in s.items()}
+                     for n, s in self._hists.items()}
+        for name, series in sorted(counters.items()):
+            full = f"{p}_{name}"
+            if name in self._help:
+                out.append(f"# HELP {full} {self._help[name]}")
+            out.append(f"# TYPE {full} counter")
+            for key, v in series.items():
+                out.append(f"{full}{_fmt_labels(key)} {v:g}")
+        for name, series in sorted(hists.items()):
+            full = f"{p}_{name}"
+            if name in self._help:
+                out.append(f"# HELP {full} {self._help[name]}")
+            out.append(f"# TYPE {full} histogram")
+            for key, (counts, total, count, buckets) in series.items():
+                acc = 0
+                for le, c in zip(buckets, counts):
+                    acc += c
+                    out.append(f"{full}_bucket{_fmt_labels(key, (('le', f'{le:g}'),))} {acc}")
+                out.append(f"{full}_bucket{_fmt_labels(key, (('le', '+Inf'),))} {count}")
+                out.append(f"{full}_sum{_fmt_labels(key)} {total:.6f}")
+                out.append(f"{full}_count{_fmt_labels(key)} {count}")
+        gauges: Dict[str, List[str]] = {}
+        for fn in self._collectors:
+            try:
+                for name, labels, value in fn():
+                    gauges.setdefault(name, []).append(f"{p}_{name}{_fmt_labels(_labels(labels))} {value:g}")
+            except Exception as e:
+                print("[METRICS] collector failed:", e, flush=True)
+        for name, lines in sorted(gauges.items()):
+            if name in self._help:
+                out.append(f"# HELP {p}_{name} {self._help[name]}")
+            out.append(f"# TYPE {p}_{name} gauge")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+class SamplingProfiler:
+    """
+    Samples Python stacks `hz` times a second into collapsed-stack counts.
+
+    Under gevent every greenlet runs on the main OS thread, so samples are
+    taken from a SIGPROF timer (the handler sees whatever greenlet is
+    running). Otherwise a sampler thread walks sys._current_frames().
+    """
+
+    def __init__(self, hz: float = 100.0, max_depth: int = 40, use_signal: Optional[bool] = None):
+        self.hz = hz
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._stacks: Counter = Counter()
+        self.samples = 0
+        self.running = False
+        self.use_signal = use_signal  # None: SIGPROF under gevent, else a thread
+        self._started = PerProcess(self._start)
+
+    def start(self):
+        """Start sampling in this process (idempotent)."""
+        self._started.ensure()
+
+    def _start(self):
+        self.running = True
+        interval = 1.0 / self.hz
+        use_signal = self.use_signal
+        if use_signal is None:
+            use_signal = gevent_patched()
+        if use_signal:
+            signal.signal(signal.SIGPROF, self._on_signal)
+            signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        else:
+            threading.Thread(target=self._thread_loop, args=(interval,), daemon=True, name="profiler").start()
+
+    def _collapse(self, frame) -> str:
+        parts = []
+        while frame is not None and len(parts) < self.max_depth:
+            code = frame.f_code
+            parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def _record(self, stacks: List[str]):
+        with self._lock:
+            self._stacks.update(stacks)
+            self.samples += 1
+
+    def _on_signal(self, signum, frame):
+        self._stacks[self._collapse(frame)] += 1  # no lock: runs between bytecodes of the main thread
+        self.samples += 1
+
+    def _thread_loop(self, interval: float):
+        me = threading.get_ident()
+        while True:
+            time.sleep(interval)
+            self._record([self._collapse(f) for tid, f in sys._current_frames().items() if tid != me])
+
+    def dump(self, reset: bool = False, limit: int = 500) -> str:
+        with self._lock:
+            snapshot = Counter(dict(self._stacks))  # the C-level copy can't be interleaved with _on_signal
+            if reset:
+                self._stacks = Counter()
+                self.samples = 0
+        stacks = snapshot.most_common(limit)
+        return "".join(f"{s} {n}\n" for s, n in stacks)
@@ -0,0 +1,179 @@
+# presence.py
+"""
+Who is online, across every gunicorn worker.
+
+Each worker counts its own open streams per user (two tabs = two references)
+and broadcasts those counts on an internal pub/sub topic whenever they change,
+plus a heartbeat every `heartbeat` seconds. Every worker therefore holds the
+whole picture; a worker that stops heart-beating is forgotten after
+3 * heartbeat.
+
+A user is online while any live worker has a stream for them, and for
+`grace` seconds after the last one closes (page reloads and flaky mobile
+connections don't flap). Last activity (stream opened, message sent, channel
+read) travels with the counts.
+
+Transitions are reported through on_change(alias, online, last_active) by a
+single worker: the lowest live pid holding one of the user's streams for
+"online", the lowest live pid for "offline".
+"""
+import os
+import time
+import threading
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+from forksafe import PerProcess
+
+PRESENCE_TOPIC = "_presence"
+
+
+class Presence:
+    def __init__(self, bus, grace: float = 20.0, heartbeat: float = 10.0,
+                 on_change: Optional[Callable[[str, bool, Optional[float]], None]] = None):
+        self.bus = bus
+        self.grace = grace
+        self.heartbeat = heartbeat
+        self.ttl = heartbeat * 3
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._local: Dict[str, int] = {}
+        self._remote: Dict[int, Tuple[float, Dict[str, int]]] = {}  # pid -> (last heard, counts)
+        self._last_active: Dict[str, float] = {}  # wall-clock seconds
+        self._offline_at: Dict[str, float] = {}  # monotonic time the last stream closed
+        self._state: Dict[str, bool] = {}  # last derived online/offline per alias
+        self._started = PerProcess(self._start)
+        self.stats = {"connects": 0, "disconnects": 0, "changes": 0, "broadcasts": 0}
+        bus.add_listener(self._on_event)
+
+    def _start(self):
+        with self._lock:
+            self._local, self._remote = {}, {}  # whatever the parent had isn't ours
+        self.bus.start()
+        threading.Thread(target=self._loop, daemon=True, name="presence").start()
+
+    # ------------------- local connections -------------------
+    def connect(self, alias: str):
+        """A stream for `alias` opened in this worker; pair with disconnect()."""
+        self._started.ensure()
+        with self._lock:
+            self._local[alias] = self._local.get(alias, 0) + 1
+            self._last_active[alias] = time.time()
+            self.stats["connects"] += 1
+        self._broadcast()
+        self._reconcile()
+
+    def disconnect(self, alias: str):
+        with self._lock:
+            n = self._local.get(alias, 0) - 1
+            if n > 0:
+                self._local[alias] = n
+            else:
+                self._local.pop(alias, None)
+            self.stats["disconnects"] += 1
+        self._broadcast()
+        self._reconcile()
+
+    def touch(self, alias: str):
+        """Record activity; other workers learn it with the next broadcast."""
+        self._last_active[alias] = time.time()
+
+    # ------------------- queries -------------------
+    def _totals(self, now: float) -> Dict[str, int]:
+        totals = dict(self._local)
+        for seen, counts in self._remote.values():
+            if now - seen <= self.ttl:
+                for a, n in counts.items():
+                    totals[a] = totals.get(a, 0) + n
+        return totals
+
+    def _online(self, alias: str, totals: Dict[str, int], now: float) -> bool:
+        if totals.get(alias):
+            return True
+        t = self._offline_at.get(alias)
+        return t is not None and now - t < self.grace
+
+    def online(self, aliases: Iterable[str]) -> Set[str]:
+        """The subset of `aliases` that is online right now (one lock for the whole set)."""
+        now = time.monotonic()
+        with self._lock:
+            totals = self._totals(now)
+            return {a for a in aliases if self._online(a, totals, now)}
+
+    def snapshot(self, aliases: Iterable[str]) -> Dict[str, Dict]:
+        now = time.monotonic()
+        with self._lock:
+            totals = self._totals(now)
+            return {a: {"online": self._online(a, totals, now), "connections": totals.get(a, 0),
+                        "last_active": self._last_active.get(a)} for a in aliases}
+
+    # ------------------- cross-worker state -------------------
+    def _broadcast(self):
+        with self._lock:
+            data = {"pid": os.getpid(), "counts": dict(self._local),
+                    "active": {a: self._last_active[a] for a in self._local if a in self._last_active}}
+            self.stats["broadcasts"] += 1
+        try:
+            self.bus.publish(PRESENCE_TOPIC, {"event": "presence_state", "data": data})
+        except Exception as e:
+            print("[PRESENCE] broadcast failed:", e, flush=True)
+
+    def _on_event(self, channel: str, event: dict):
+        if channel != PRESENCE_TOPIC:
+            return
+        data = event.get("data") or {}
+        pid = data.get("pid")
+        if pid is None or pid == os.getpid():
+            return
+        with self._lock:
+            self._remote[pid] = (time.monotonic(), dict(data.get("counts") or {}))
+            for a, ts in (data.get("active") or {}).items():
+                if ts and ts > self._last_active.get(a, 0):
+                    self._last_active[a] = ts
+        self._reconcile()
+
+    def _reconcile(self):
+        """Derive online/offline transitions; report the ones this worker is responsible for."""
+        now = time.monotonic()
+        me = os.getpid()
+        changes = []
+        with self._lock:
+            live = {pid: counts for pid, (seen, counts) in self._remote.items() if now - seen <= self.ttl}
+            for pid in [p for p in self._remote if p not in live]:
+                del self._remote[pid]
+            totals = self._totals(now)
+            for a in set(totals) | set(self._state) | set(self._offline_at):
+                if totals.get(a):
+                    self._offline_at.pop(a, None)
+                elif self._state.get(a) and a not in self._offline_at:
+                    self._offline_at[a] = now  # last stream just closed: grace starts
+                online = self._online(a, totals, now)
+                if online == self._state.get(a, False):
+                    continue
+                self._state[a] = online
+                if not online:
+                    self._offline_at.pop(a, None)
+                if online:
+                    holders = [pid for pid, counts in live.items() if counts.get(a)] + ([me] if self._local.get(a) else [])
+                    mine = bool(holders) and min(holders) == me
+                else:
+                    mine = min(list(live) + [me]) == me
+                if mine:
+                    changes.append((a, online, self._last_active.get(a)))
+            self.stats["changes"] += len(changes)
+        if self.on_change:
+            for a, online, last_active in changes:
+                try:
+                    self.on_change(a, online, last_active)
+                except Exception as e:
+                    print("[PRESENCE] on_change failed:", e, flush=True)
+
+    def _loop(self):
+        tick = min(1.0, self.grace / 4.0 or 1.0)
+        last_beat = 0.0
+        while True:
+            time.sleep(tick)
+            now = time.monotonic()
+            if now - last_beat >= self.heartbeat:
+                last_beat = now
+                self._broadcast()
+            self._reconcile()
@@ -0,0 +1,317 @@
+# pubsub.py
+"""
+Realtime fan-out for SSE.
+
+app.py only talks to a backend through publish/add_listener (see
+PubSubBackend); the SSE hub is the listener that fans events out to streams:
+
+- LocalBackend:  calls the listeners in this process (one worker only)
+- SocketBackend: LocalBackend plus a tiny broker on a Unix socket, so an event
+                 published in one gunicorn worker reaches streams held by any
+                 other worker. Whichever worker holds the lock file runs the
+                 broker; if it dies another worker takes over.
+
+Frames on the socket are a 4-byte big-endian length followed by JSON
+{"c": channel, "e": event}.
+
+Events carrying a "seq" (assigned by app.py from the channel_events table) are
+also kept in a bounded per-channel ReplayBuffer so a reconnecting SSE client
+can be sent just the events it missed.
+"""
+import os
+import time
+import fcntl
+import socket
+import struct
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+from fastjson import dumps, loads
+from forksafe import PerProcess
+from messages import envelope
+
+_HDR = struct.Struct(">I")
+MAX_FRAME = 16 * 1024 * 1024
+
+
+def _send_frame(sock: socket.socket, body: bytes):
+    sock.sendall(_HDR.pack(len(body)) + body)
+
+
+def _recv_exact(sock: socket.socket, n: int) -> Optional[bytes]:
+    buf = bytearray()
+    while len(buf) < n:
+        try:
+            chunk = sock.recv(n - len(buf))
+        except socket.timeout:
+            continue  # the timeout only guards sends; keep what we have so far
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+
+def _recv_frame(sock: socket.socket) -> Optional[bytes]:
+    hdr = _recv_exact(sock, _HDR.size)
+    if hdr is None:
+        return None
+    (n,) = _HDR.unpack(hdr)
+    if n > MAX_FRAME:
+        raise ValueError(f"pubsub frame too large: {n}")
+    return _recv_exact(sock, n)
+
+
+class ReplayBuffer:
+    """
+    Last `size` sequenced events per channel. `floor` is the newest seq we can
+    no longer vouch for (evicted, or published before this process saw the
+    channel); since() only answers for seqs at or above it.
+    """
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self._lock = threading.Lock()
+        self._rings: Dict[str, deque] = {}
+        self._floor: Dict[str, int] = {}
+        self._head: Dict[str, int] = {}
+
+    def record(self, channel: str, event: dict):
+        seq = event.get("seq")
+        if seq is None:
+            return
+        with self._lock:
+            ring = self._rings.get(channel)
+            if ring is None:
+                ring = self._rings[channel] = deque()
+                self._floor[channel] = seq - 1
+            ring.append((seq, event))
+            if len(ring) > self.size:
+                old_seq, _ = ring.popleft()
+                self._floor[channel] = max(self._floor[channel], old_seq)
+            if seq > self._head.get(channel, 0):
+                self._head[channel] = seq
+
+    def head(self, channel: str) -> Optional[int]:
+        with self._lock:
+            return self._head.get(channel)
+
+    def since(self, channel: str, seq: int) -> Optional[List[dict]]:
+        """Events after `seq` in order, or None if the buffer can't cover the gap."""
+        with self._lock:
+            ring = self._rings.get(channel)
+            if ring is None or seq < self._floor[channel]:
+                return None
+            out = [(s, e) for s, e in ring if s > seq]
+        out.sort(key=lambda x: x[0])
+        return [e for _, e in out]
+
+
+class PubSubBackend(ABC):
+    """Interface used by app.py. Events are {"event": ..., "data": ...} dicts."""
+
+    @abstractmethod
+    def publish(self, channel: str, event: dict):
+        ...
+
+    @abstractmethod
+    def add_listener(self, fn: Callable[[str, dict], None]):
+        """fn(channel, event) is called for every event this process sees, local or relayed."""
+
+    def start(self):
+        """Make sure this process receives events (idempotent; listeners call it before holding streams)."""
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalBackend(PubSubBackend):
+    def __init__(self, replay: Optional[ReplayBuffer] = None):
+        self._listeners: List[Callable[[str, dict], None]] = []
+        self.replay = replay or ReplayBuffer()
+
+    def add_listener(self, fn: Callable[[str, dict], None]):
+        self._listeners.append(fn)
+
+    def publish(self, channel: str, event: dict):
+        self.replay.record(channel, event)
+        for fn in self._listeners:
+            try:
+                fn(channel, event)
+            except Exception as e:
+                print("[PUBSUB] listener error:", e, flush=True)
+
+
+class _Broker:
+    """Relays every frame from one connected worker to all the others."""
+
+    def __init__(self, sock_path: str):
+        self.sock_path = sock_path
+        self._lock = threading.Lock()
+        self._clients: Dict[socket.socket, threading.Lock] = {}
+        try:
+            os.unlink(sock_path)  # stale socket from a dead broker; we hold the lock
+        except FileNotFoundError:
+            pass
+        self._srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._srv.bind(sock_path)
+        self._srv.listen(64)
+        threading.Thread(target=self._accept_loop, daemon=True, name="pubsub-broker").start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._srv.accept()
+            except OSError:
+                return
+            conn.settimeout(5.0)  # a stuck worker must not stall the broker forever
+            with self._lock:
+                self._clients[conn] = threading.Lock()
+            threading.Thread(target=self._client_loop, args=(conn,), daemon=True).start()
+
+    def _drop(self, conn: socket.socket):
+        with self._lock:
+            self._clients.pop(conn, None)
+        try: conn.close()
+        except Exception: pass
+
+    def _client_loop(self, conn: socket.socket):
+        try:
+            while True:
+                body = _recv_frame(conn)
+                if body is None:
+                    break
+                with self._lock:
+                    targets = [(c, l) for c, l in self._clients.items() if c is not conn]
+                frame = _HDR.pack(len(body)) + body
+                for c, l in targets:
+                    try:
+                        with l:
+                            c.sendall(frame)
+                    except Exception:
+                        self._drop(c)
+        except Exception as e:
+            print("[PUBSUB] broker client error:", e, flush=True)
+        finally:
+            self._drop(conn)
+
+
+class SocketBackend(LocalBackend):
+    """
+    Local listeners for this worker + a connection to the shared broker.
+    Publishing delivers locally right away and forwards the event to the
+    broker, which hands it to every other worker.
+    """
+
+    def __init__(self, sock_path: str, lock_path: Optional[str] = None, replay: Optional[ReplayBuffer] = None):
+        super().__init__(replay)
+        self.sock_path = sock_path
+        self.lock_path = lock_path or sock_path + ".lock"
+        self._started = PerProcess(self._start)
+        self._conn: Optional[socket.socket] = None
+        self._send_lock = threading.Lock()
+        self._lock_fd = None
+        self._broker: Optional[_Broker] = None
+        self._closed = False
+
+    def _start(self):
+        self._conn = None
+        self._broker = None
+        self._lock_fd = None
+        self._try_become_broker()
+        self._connect()
+        threading.Thread(target=self._reader_loop, daemon=True, name="pubsub-reader").start()
+
+    def _try_become_broker(self):
+        if self._broker is not None:
+            return
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return
+        self._lock_fd = fd
+        self._broker = _Broker(self.sock_path)
+
+    def _connect(self) -> bool:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self.sock_path)
+        except OSError:
+            s.close()
+            return False
+        with self._send_lock:
+            self._conn = s
+        return True
+
+    def _reader_loop(self):
+        backoff = 0.05
+        while not self._closed:
+            conn = self._conn
+            if conn is None:
+                # Broker gone (or not up yet): maybe take over, then reconnect
+                self._try_become_broker()
+                if not self._connect():
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 2.0)
+                    continue
+                backoff = 0.05
+                conn = self._conn
+            try:
+                body = _recv_frame(conn)
+            except Exception:
+                body = None
+            if body is None:
+                with self._send_lock:
+                    if self._conn is conn:
+                        self._conn = None
+                try: conn.close()
+                except Exception: pass
+                continue
+            try:
+                msg = loads(body)
+                LocalBackend.publish(self, msg["c"], msg["e"])
+            except Exception as e:
+                print("[PUBSUB] bad frame:", e, flush=True)
+
+    def start(self):
+        self._started.ensure()
+
+    def publish(self, channel: str, event: dict):
+        self._started.ensure()
+        super().publish(channel, event)
+        # A Message in "data" goes out as its cached JSON, not re-encoded
+        head = {k: v for k, v in event.items() if k != "data"}
+        body = b'{"c":' + dumps(channel) + b',"e":' + envelope(head, data=event.get("data")) + b"}"
+        with self._send_lock:
+            conn = self._conn
+            if conn is None:
+                return  # other workers miss this one; the reader is reconnecting
+            try:
+                _send_frame(conn, body)
+            except Exception as e:
+                print("[PUBSUB] forward failed:", e, flush=True)
+                self._conn = None
+                try: conn.close()
+                except Exception: pass
+
+    def close(self):
+        self._closed = True
+        with self._send_lock:
+            if self._conn is not None:
+                try: self._conn.close()
+                except Exception: pass
+                self._conn = None
+
+
+def make_backend(kind: Optional[str] = None, replay_size: int = 256) -> PubSubBackend:
+    kind = (kind or os.environ.get("PUBSUB_BACKEND", "local")).lower()
+    replay = ReplayBuffer(replay_size)
+    if kind == "local":
+        return LocalBackend(replay)
+    if kind == "socket":
+        return SocketBackend(os.environ.get("PUBSUB_SOCKET", "storage/pubsub.sock"), replay=replay)
+    raise ValueError(f"Unsupported PUBSUB_BACKEND: {kind}")
@@ -0,0 +1,293 @@
+# push.py
+"""
+Long-lived Web Push dispatcher.
+
+create_message() hands each new message to PushDispatcher.submit(). A planner
+thread resolves the target subscriptions, a fixed pool of workers sends them
+concurrently, and result bookkeeping (last_seen / fail_count / gone) is
+written back to SQLite in batches.
+
+Per-endpoint coalescing: while an endpoint already has a notification queued
+or in flight, further messages for it are merged into a single follow-up
+notification instead of being sent one by one.
+
+PushSender does the actual HTTP work: the VAPID key is parsed once, signed
+JWTs are cached per push-service origin until shortly before they expire, and
+each origin gets its own keep-alive requests.Session. pywebpush (which pulls
+in aiohttp) is only imported for the first push, not at worker boot.
+"""
+import time
+import threading
+import traceback
+from queue import Queue, Full
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from py_vapid import Vapid
+
+from forksafe import PerProcess
+
+
+def _origin(endpoint: str) -> str:
+    u = urlparse(endpoint)
+    return f"{u.scheme}://{u.netloc}"
+
+
+class VapidSigner:
+    """Holds the parsed VAPID key and caches signed headers per push-service origin."""
+
+    def __init__(self, private_pem: str, sub: str, lifetime: int = 12 * 3600, margin: int = 600):
+        self._vapid = Vapid.from_pem(private_pem.encode("utf-8"))
+        self.sub = sub
+        self.lifetime = lifetime
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._cache: Dict[str, Tuple[int, Dict[str, str]]] = {}
+        self.signed = 0  # number of actual ECDSA signatures, for metrics/tests
+
+    def headers_for(self, endpoint: str) -> Dict[str, str]:
+        aud = _origin(endpoint)
+        now = int(time.time())
+        with self._lock:
+            hit = self._cache.get(aud)
+            if hit and hit[0] - self.margin > now:
+                return dict(hit[1])
+        exp = now + self.lifetime
+        headers = self._vapid.sign({"sub": self.sub, "aud": aud, "exp": exp})
+        with self._lock:
+            self._cache[aud] = (exp, headers)
+            self.signed += 1
+        return dict(headers)
+
+
+class PushRejected(Exception):
+    """The push service answered with a non-2xx status; .response is the reply."""
+
+    def __init__(self, message: str, response: requests.Response):
+        super().__init__(message)
+        self.response = response
+
+
+class PushSender:
+    """Sends encrypted pushes over pooled keep-alive sessions, one per origin."""
+
+    def __init__(self, signer: VapidSigner, pool_size: int = 4, timeout: float = 10.0):
+        self.signer = signer
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, requests.Session] = {}
+
+    def session_for(self, endpoint: str) -> requests.Session:
+        origin = _origin(endpoint)
+        with self._lock:
+            s = self._sessions.get(origin)
+            if s is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                s.mount(origin, adapter)
+                self._sessions[origin] = s
+            return s
+
+    def send(self, subscription: dict, data: str, ttl: int = 60):
+        """Encrypts and sends one push; raises PushRejected on a non-2xx reply."""
+        from pywebpush import WebPusher
+
+        endpoint = subscription["endpoint"]
+        resp = WebPusher(subscription, requests_session=self.session_for(endpoint)).send(
+            data,
+            self.signer.headers_for(endpoint),
+            ttl=ttl,
+            content_encoding="aes128gcm",
+            timeout=self.timeout,
+        )
+        if resp.status_code > 202:
+            raise PushRejected(f"Push failed: {resp.status_code} {resp.reason}", resp)
+        return resp
+
+    def warm_up(self):
+        """Import pywebpush ahead of the first push, off the request path."""
+        import pywebpush  # noqa: F401
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for s in sessions:
+            s.close()
+
+
+class _Pending:
+    __slots__ = ("sub", "payload", "count")
+
+    def __init__(self, sub: dict, payload: dict):
+        self.sub = sub
+        self.payload = payload
+        self.count = 1
+
+
+def coalesced_payload(payload: dict, count: int) -> dict:
+    if count <= 1:
+        return payload
+    out = dict(payload)
+    out["body"] = f"{payload.get('body', '')} (+{count - 1})"
+    out["count"] = count
+    return out
+
+
+class PushDispatcher:
+    def __init__(
+        self,
+        db,
+        send: Callable[[dict, dict], Tuple[bool, Optional[str]]],
+        targets: Callable[[dict], List[dict]],
+        workers: int = 4,
+        max_queue: int = 1000,
+        flush_interval: float = 2.0,
+        flush_batch: int = 100,
+    ):
+        self.db = db
+        self._send = send
+        self._targets = targets
+        self.n_workers = workers
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+
+        self._jobs: Queue = Queue(maxsize=max_queue)
+        self._ready: Queue = Queue()
+        self._lock = threading.Lock()
+        self._pending: Dict[str, _Pending] = {}
+        self._inflight = set()
+
+        self._results_lock = threading.Lock()
+        self._seen: List[int] = []
+        self._failed: List[int] = []
+        self._gone: List[Tuple[int, str]] = []  # (subscription id, endpoint)
+        self._gone_endpoints = set()  # skipped until their DELETE is flushed
+        self._flush_now = threading.Event()
+
+        self._started = PerProcess(self._start)
+        self.stats = {"submitted": 0, "dropped": 0, "sent": 0, "failed": 0, "coalesced": 0}
+
+    def _start(self):
+        threading.Thread(target=self._plan_loop, daemon=True, name="push-planner").start()
+        for i in range(self.n_workers):
+            threading.Thread(target=self._send_loop, daemon=True, name=f"push-worker-{i}").start()
+        threading.Thread(target=self._flush_loop, daemon=True, name="push-flush").start()
+
+    def submit(self, payload: dict, msg_out: dict) -> bool:
+        """Queue a message for push delivery. Never blocks; returns False if the queue is full."""
+        self._started.ensure()
+        try:
+            self._jobs.put_nowait((payload, msg_out))
+        except Full:
+            self.stats["dropped"] += 1
+            print("[PUSH] queue full, dropping notification", flush=True)
+            return False
+        self.stats["submitted"] += 1
+        return True
+
+    def enqueue(self, sub: dict, payload: dict):
+        endpoint = sub["endpoint"]
+        with self._lock:
+            if endpoint in self._gone_endpoints:
+                return
+            p = self._pending.get(endpoint)
+            if p is not None:
+                # Still waiting to go out: fold this message into it
+                p.payload = payload
+                p.count += 1
+                p.sub = sub
+                self.stats["coalesced"] += 1
+                return
+            self._pending[endpoint] = _Pending(sub, payload)
+            if endpoint in self._inflight:
+                return  # picked up by the worker when the current send finishes
+        self._ready.put(endpoint)
+
+    def _plan_loop(self):
+        while True:
+            payload, msg_out = self._jobs.get()
+            try:
+                for sub in self._targets(msg_out) or []:
+                    self.enqueue(sub, payload)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._jobs.task_done()
+
+    def _send_loop(self):
+        while True:
+            endpoint = self._ready.get()
+            with self._lock:
+                p = self._pending.pop(endpoint, None)
+                if p is None:
+                    continue
+                self._inflight.add(endpoint)
+            try:
+                self._deliver(p)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._inflight.discard(endpoint)
+                    requeue = endpoint in self._pending
+                if requeue:
+                    self._ready.put(endpoint)
+
+    def _deliver(self, p: _Pending):
+        sub = p.sub
+        ok, err = self._send(
+            {"endpoint": sub["endpoint"], "keys": {"p256dh": sub["p256dh"], "auth": sub["auth"]}},
+            coalesced_payload(p.payload, p.count),
+        )
+        with self._results_lock:
+            if ok:
+                self.stats["sent"] += 1
+                self._seen.append(sub["id"])
+            else:
+                self.stats["failed"] += 1
+                if err == "gone":
+                    self._gone.append((sub["id"], sub["endpoint"]))
+                    with self._lock:
+                        self._gone_endpoints.add(sub["endpoint"])
+                else:
+                    self._failed.append(sub["id"])
+            n = len(self._seen) + len(self._failed) + len(self._gone)
+        if n >= self.flush_batch:
+            self._flush_now.set()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            self.flush()
+
+    def flush(self):
+        with self._results_lock:
+            seen, failed, gone = self._seen, self._failed, self._gone
+            self._seen, self._failed, self._gone = [], [], []
+        if not (seen or failed or gone):
+            return
+        try:
+            self.db.record_push_results(seen, failed, [sid for sid, _ in gone])
+        except Exception as e:
+            print("[PUSH] failed to record results:", e, flush=True)
+            return
+        if gone:
+            with self._lock:
+                # only this batch: endpoints marked since the snapshot aren't deleted yet
+                self._gone_endpoints.difference_update(ep for _, ep in gone)
+
+    def drain(self, timeout: float = 10.0) -> bool:
+        """Wait until everything queued so far has been sent and recorded (bench/shutdown)."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:
+                busy = bool(self._pending or self._inflight)
+            if not busy and self._jobs.unfinished_tasks == 0 and self._ready.empty():
+                self.flush()
+                return True
+            time.sleep(0.01)
+        return False
@@ -0,0 +1,87 @@
+# retention.py
+"""
+Retention job: expired messages, their files, old channel events and free
+database pages.
+
+Everything is done in small steps so the SQLite write lock is only ever held
+for a few milliseconds at a time:
+
+- messages are deleted per channel in batches of RETENTION_BATCH rows (oldest
+  first, via the (channel, created_at, id) index), each in its own short
+  transaction that also fixes the channel summary and unread counters;
+- files are unlinked after the batch has committed, each under its own
+  brief write lock (see media.unlink_unreferenced);
+- channel_events are trimmed in batches the same way, and so are message
+  idempotency keys (a client only retries for a little while);
+- free pages are returned with PRAGMA incremental_vacuum, VACUUM_PAGES at a
+  time (the database runs with auto_vacuum=INCREMENTAL);
+- finally files no row references any more are swept from the media dirs.
+
+Channels can override the default retention (channels.retention_seconds:
+NULL = DEFAULT_RETENTION, 0 = keep forever).
+"""
+import os
+import time
+from typing import Dict, Iterable, Optional
+
+from media import sweep_orphans, unlink_unreferenced
+
+DEFAULT_RETENTION = int(float(os.environ.get("MESSAGE_RETENTION_HOURS", 24)) * 3600)
+EVENT_RETENTION = 24 * 3600  # replay/sync window
+RETENTION_BATCH = int(os.environ.get("RETENTION_BATCH", 200))
+VACUUM_PAGES = 128
+BATCH_PAUSE = 0.02  # seconds between batches, lets queued writers in
+ORPHAN_GRACE = 3600
+
+
+def run_retention(db, media_dirs: Iterable, now: Optional[int] = None) -> Dict:
+    """One full pass. Returns counters (and the slowest batch) for logging/metrics."""
+    now = int(now or time.time())
+    stats = {"messages": 0, "files": 0, "events": 0, "keys": 0, "orphans": 0, "vacuumed_pages": 0, "batches": 0, "max_batch_ms": 0.0}
+
+    def timed(fn, *args):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        stats["batches"] += 1
+        stats["max_batch_ms"] = max(stats["max_batch_ms"], (time.perf_counter() - t0) * 1000)
+        return out
+
+    for channel, retention in db.retention_targets():
+        keep = DEFAULT_RETENTION if retention is None else int(retention)
+        if keep <= 0:
+            continue
+        while True:
+            n, freed = timed(db.prune_channel_batch, channel, now - keep, RETENTION_BATCH)
+            stats["messages"] += n
+            if freed:
+                unlink_unreferenced(db, freed)
+                stats["files"] += len(freed)
+            if n < RETENTION_BATCH:
+                break
+            time.sleep(BATCH_PAUSE)
+
+    while True:
+        n = timed(db.prune_events, now - EVENT_RETENTION, RETENTION_BATCH)
+        stats["events"] += n
+        if n < RETENTION_BATCH:
+            break
+        time.sleep(BATCH_PAUSE)
+
+    while True:
+        n = timed(db.prune_message_keys, now - EVENT_RETENTION, RETENTION_BATCH)
+        stats["keys"] += n
+        if n < RETENTION_BATCH:
+            break
+        time.sleep(BATCH_PAUSE)
+
+    stats["orphans"] = sweep_orphans(db, media_dirs, ORPHAN_GRACE)
+
+    left = db.freelist_count()
+    while left:
+        remaining = timed(db.incremental_vacuum, VACUUM_PAGES)
+        stats["vacuumed_pages"] += max(left - remaining, 0)
+        if remaining >= left:
+            break
+        left = remaining
+        time.sleep(BATCH_PAUSE)
+    return stats
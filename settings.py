@@ -1,5 +1,7 @@
 # settings.py
 from pathlib import Path
+import os
+import json
 import base64
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives import serialization
@@ -8,6 +10,7 @@ KEYS_DIR = Path("storage/keys")
 KEYS_DIR.mkdir(parents=True, exist_ok=True)
 PRIV_PEM = KEYS_DIR / "vapid_private.pem"
 PUB_B64 = KEYS_DIR / "vapid_public.txt"
+USERS_JSON = KEYS_DIR / "users.json"
 
 def _b64url(b: bytes) -> str:
     return base64.urlsafe_b64encode(b).decode("ascii").rstrip("=")
@@ -43,3 +46,24 @@ def load_or_create_vapid_keys():
     PUB_B64.write_text(pub_b64)
 
     return priv_pem, pub_b64
+
+def load_or_create_password_hashes(aliases, default_password):
+    """
+    Returns {alias: werkzeug password hash}
+
+    Hashing is a deliberately slow KDF (~0.1 s each), so the hashes are made
+    once, for `aliases` with `default_password`, and kept in users.json.
+    Later starts only read the file; to change a password, put a new
+    generate_password_hash() value in it.
+    """
+    if USERS_JSON.exists():
+        return json.loads(USERS_JSON.read_text())
+
+    from werkzeug.security import generate_password_hash
+    users = {a: generate_password_hash(default_password) for a in aliases}
+
+    tmp = USERS_JSON.with_name(f"{USERS_JSON.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(users, ensure_ascii=False, indent=2))
+    os.replace(tmp, USERS_JSON)  # workers starting together: last one wins, any copy is valid
+
+    return users
@@ -0,0 +1,231 @@
+# sse.py
+"""
+Streaming hub for the SSE endpoints.
+
+Instead of every open stream parking on its own SimpleQueue.get(timeout=15)
+and json.dumps-ing every event itself, the hub listens to the pub/sub backend
+once and:
+
+- serializes each event exactly once into a shared SSE frame (bytes),
+  reusing a Message's cached JSON when the event carries one,
+- appends that frame to the small buffer of every connection on the channel,
+- sends keepalive pings for all connections from one shared timer thread,
+- disconnects consumers whose buffer overflows (they reconnect with
+  Last-Event-ID and get the missed events replayed).
+
+A connection can cover several channels at once (the multiplexed
+/stream/me). Such "tagged" connections get frames whose data is
+{"channel": ..., "data": ...}, and a connection following a meta topic joins
+new channels announced there with a "channel" event.
+
+Connections wait on a threading.Event, which gevent turns into a cheap
+greenlet primitive under the gunicorn gevent worker.
+"""
+import time
+import threading
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from fastjson import dumps
+from forksafe import PerProcess
+from messages import encode
+
+PING_FRAME = b"event: ping\ndata: {}\n\n"
+
+
+def _frame(seq: Optional[int], event: str, data: bytes) -> bytes:
+    head = f"id: {seq}\n" if seq is not None else ""
+    return f"{head}event: {event}\ndata: ".encode("utf-8") + data + b"\n\n"
+
+
+def sse_frame(item: dict, default_event: str = "message") -> bytes:
+    return _frame(item.get("seq"), item.get("event") or default_event, encode(item.get("data")))
+
+
+def tagged_frame(channel: str, item: dict) -> bytes:
+    """Frame for multiplexed streams: the payload says which channel it belongs to."""
+    default_event = "channel" if channel.startswith("meta:") else "message"
+    data = b'{"channel":' + dumps(channel) + b',"data":' + encode(item.get("data")) + b"}"
+    return _frame(item.get("seq"), item.get("event") or default_event, data)
+
+
+class SSEConnection:
+    __slots__ = ("hub", "channels", "tagged", "follow", "max_queue", "_lock", "_buf", "_wake", "_replayed",
+                 "closed", "overflowed", "last_write", "opened_at")
+
+    def __init__(self, hub: "SSEHub", channels: Iterable[str], max_queue: int,
+                 tagged: bool = False, follow: Optional[str] = None):
+        self.hub = hub
+        self.channels = set(channels)
+        self.tagged = tagged
+        self.follow = follow
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._buf: deque = deque()  # (seq or None, frame bytes)
+        self._wake = threading.Event()
+        self._replayed: set = set()  # seqs sent by start(); dropped when they turn up live
+        self.closed = False
+        self.overflowed = False
+        self.last_write = self.opened_at = time.monotonic()
+
+    @property
+    def depth(self) -> int:
+        return len(self._buf)
+
+    def offer(self, seq: Optional[int], frame: bytes) -> bool:
+        with self._lock:
+            if self.closed:
+                return False
+            if len(self._buf) >= self.max_queue:
+                # Slow consumer: cut it off rather than buffer without bound
+                self.overflowed = True
+                self.closed = True
+                self._buf.clear()
+            else:
+                self._buf.append((seq, frame))
+        self._wake.set()
+        return not self.overflowed
+
+    def start(self, initial: Iterable[Tuple[Optional[int], bytes]], replayed: Iterable[int] = ()):
+        """
+        Put hello/replay frames in front of anything already buffered. Live
+        events whose seq is in `replayed` are skipped. That is a set rather
+        than a high-water mark, because events from other workers can arrive
+        out of seq order.
+        """
+        with self._lock:
+            self._replayed = set(replayed)
+            live = [x for x in self._buf if x[0] is None or x[0] not in self._replayed]
+            self._buf = deque(list(initial) + live)
+        self._wake.set()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+        self._wake.set()
+
+    def frames(self) -> Iterator[bytes]:
+        """WSGI body: yields frames until the connection is closed (by us or the client)."""
+        try:
+            while True:
+                self._wake.wait()
+                with self._lock:
+                    self._wake.clear()
+                    batch, self._buf = self._buf, deque()
+                    closed = self.closed
+                for seq, frame in batch:
+                    if seq is not None and seq in self._replayed:
+                        self._replayed.discard(seq)
+                        continue  # already sent as part of the replay
+                    self.last_write = time.monotonic()
+                    yield frame
+                if closed:
+                    return
+        finally:
+            self.hub.close(self)
+
+
+class SSEHub:
+    def __init__(self, bus, keepalive: float = 15.0, max_queue: int = 256):
+        self.bus = bus
+        self.keepalive = keepalive
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._by_channel: Dict[str, set] = {}
+        self._started = PerProcess(self._start)
+        self.counters = {"opened": 0, "closed": 0, "overflowed": 0, "events": 0, "frames": 0, "pings": 0}
+        self.on_dispatch = None  # optional fn(channel, event, fanout), for metrics
+        bus.add_listener(self.dispatch)
+
+    def _start(self):
+        threading.Thread(target=self._timer_loop, daemon=True, name="sse-keepalive").start()
+
+    def open(self, channels: List[str], tagged: bool = False, follow: Optional[str] = None) -> SSEConnection:
+        """
+        Register a connection on `channels`. With tagged=True frames carry their
+        channel; with follow="meta:<alias>" the connection also joins channels
+        announced by a "channel" event on that topic.
+        """
+        self._started.ensure()
+        self.bus.start()  # a worker that only holds streams still needs the relayed events
+        conn = SSEConnection(self, channels, self.max_queue, tagged=tagged, follow=follow)
+        with self._lock:
+            for ch in conn.channels:
+                self._by_channel.setdefault(ch, set()).add(conn)
+            self.counters["opened"] += 1
+        return conn
+
+    def join(self, conn: SSEConnection, channel: str):
+        with self._lock:
+            if conn.closed or channel in conn.channels:
+                return
+            conn.channels.add(channel)
+            self._by_channel.setdefault(channel, set()).add(conn)
+
+    def close(self, conn: SSEConnection):
+        conn.close()
+        with self._lock:
+            removed = False
+            for ch in list(conn.channels):
+                subs = self._by_channel.get(ch)
+                if subs and conn in subs:
+                    subs.discard(conn)
+                    removed = True
+                    if not subs:
+                        del self._by_channel[ch]
+            if removed:
+                self.counters["closed"] += 1
+                if conn.overflowed:
+                    self.counters["overflowed"] += 1
+
+    def dispatch(self, channel: str, event: dict):
+        with self._lock:
+            conns = list(self._by_channel.get(channel, ()))
+        if self.on_dispatch is not None:
+            self.on_dispatch(channel, event, len(conns))
+        if not conns:
+            return
+        seq = event.get("seq")
+        plain = tagged = None  # each format is serialized at most once
+        for c in conns:
+            if c.tagged:
+                if tagged is None:
+                    tagged = tagged_frame(channel, event)
+                c.offer(seq, tagged)
+            else:
+                if plain is None:
+                    plain = sse_frame(event, "channel" if channel.startswith("meta:") else "message")
+                c.offer(seq, plain)
+            if c.follow == channel and event.get("event") == "channel":
+                key = (event.get("data") or {}).get("key")
+                if key:
+                    self.join(c, key)
+        self.counters["events"] += 1
+        self.counters["frames"] += len(conns)
+
+    def _timer_loop(self):
+        # One timer for every connection: ping whoever has been quiet for `keepalive` seconds
+        tick = max(self.keepalive / 3.0, 0.05)
+        while True:
+            time.sleep(tick)
+            cutoff = time.monotonic() - self.keepalive
+            with self._lock:
+                conns = {c for subs in self._by_channel.values() for c in subs}
+            for c in conns:
+                if c.last_write < cutoff and not c.depth:
+                    c.last_write = time.monotonic()
+                    c.offer(None, PING_FRAME)
+                    self.counters["pings"] += 1
+
+    def metrics(self) -> dict:
+        with self._lock:
+            conns = {c for subs in self._by_channel.values() for c in subs}
+            per_channel = {ch: len(subs) for ch, subs in self._by_channel.items()}
+        depths = [c.depth for c in conns]
+        return {
+            "open_connections": len(conns),
+            "channels": per_channel,
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths) if depths else 0,
+            **self.counters,
+        }
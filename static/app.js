@@ -245,10 +245,11 @@ const loginPw = $("loginPw");
 const loginBtn = $("loginBtn");
 const loginErr = $("loginErr");
 
-// ---------- windowed history (3-day chunks) ----------
-const WINDOW_DAYS = 3;
+// ---------- paged history (keyset cursor) ----------
+const HISTORY_PAGE = 50;
 let windowBefore = Math.floor(Date.now() / 1000);
 let hasMore = true;
+let nextCursor = null;
 let lastRenderedDayKey = null;
 let oldestTs = null;
 
@@ -260,6 +261,11 @@ function dayKeyFromTs(ts) {
   )}-${String(d.getDate()).padStart(2, "0")}`;
 }
 
+function formatDuration(sec) {
+  const s = Math.max(0, Math.round(sec));
+  return `${Math.floor(s / 60)}:${String(s % 60).padStart(2, "0")}`;
+}
+
 function makeDayHeader(key) {
   const el = document.createElement("div");
   el.className = "day-header";
@@ -285,13 +291,12 @@ async function checkSessionAndConnect() {
     if (j.user) {
       isAuthed = true;
       userAlias = j.user;
-      ensureMetaStream(userAlias);
       localStorage.setItem("userAlias", userAlias);
       if (loginModal) loginModal.style.display = "none";
       initPushNotifications();   
       await refreshChannels();
       statusLine("연결 확인 중…", "info");
-      ensureEventSource(currentChannel);
+      ensureEventSource();
       if (!chatList.childElementCount) {
         messageIdSet.clear();
         await loadHistory(currentChannel, Math.floor(Date.now() / 1000));
@@ -363,7 +368,10 @@ window.addEventListener("load", () => {
   setTimeout(() => checkSessionAndConnect(), 0);
 });
 document.addEventListener("visibilitychange", () => {
-  if (document.visibilityState === "visible") checkSessionAndConnect();
+  if (document.visibilityState === "visible") {
+    checkSessionAndConnect();
+    if (currentChannel) markRead(currentChannel);
+  }
 });
 window.addEventListener("pageshow", () => {
   checkSessionAndConnect();
@@ -514,67 +522,44 @@ async function subscribeUserToPush() {
   }
 }
 
-// ---------- history & SSE (3-day windows) ----------
+// ---------- history & SSE (cursor pages) ----------
 async function loadHistory(channel, beforeEpoch = Math.floor(Date.now() / 1000)) {
   try {
     const r = await fetch(
       `/api/messages?channel=${encodeURIComponent(
         channel
-      )}&days=${WINDOW_DAYS}&before=${beforeEpoch}`,
+      )}&limit=${HISTORY_PAGE}`,
       { credentials: "include" }
     );
     if (!r.ok) throw new Error(r.statusText);
     const j = await r.json();
     renderHistoryWindow(j.messages || [], true);
     hasMore = !!j.has_more;
+    nextCursor = j.next_cursor || null;
     windowBefore = beforeEpoch;
+    if (channel === currentChannel) markRead(channel);
   } catch (e) {
     console.error("[history]", e);
     statusLine("기록 불러오기 실패", "error");
   }
 }
 
-let metaSrc = null, metaBackoff = 1000;
-
-function ensureMetaStream(alias){
-  if (!alias) return;
-  const key = `meta:${alias}`;
-  if (metaSrc && (metaSrc.readyState===0 || metaSrc.readyState===1)) return;
-  if (metaSrc){ try{ metaSrc.close(); }catch{} metaSrc = null; }
-  const url = `/stream/meta/${encodeURIComponent(alias)}`;
-  metaSrc = new EventSource(url, { withCredentials: true });
-  metaSrc.addEventListener("hello", ()=>{ metaBackoff=1000; });
-  metaSrc.addEventListener("channel", async (e)=>{
-    try { await refreshChannels(); } catch {}
-  });
-  metaSrc.addEventListener("webrtc_signal", (e) => {
-      const signal = JSON.parse(e.data);
-      handleSignalingData(signal);
-  });
-  metaSrc.addEventListener("ping", ()=>{});
-  metaSrc.onerror = ()=>{
-    try{ metaSrc.close(); }catch{} metaSrc=null;
-    const d = Math.min(metaBackoff, 30000);
-    setTimeout(()=> ensureMetaStream(alias), d);
-    metaBackoff *= 2;
-  };
-}
-
 async function loadOlder() {
-  if (!hasMore) return;
-  const before = (oldestTs || windowBefore) - 1;
+  if (!hasMore || !nextCursor) return;
+  const channel = currentChannel;
   try {
     const r = await fetch(
       `/api/messages?channel=${encodeURIComponent(
-        currentChannel
-      )}&days=${WINDOW_DAYS}&before=${before}`,
+        channel
+      )}&limit=${HISTORY_PAGE}&cursor=${encodeURIComponent(nextCursor)}`,
       { credentials: "include" }
     );
     if (!r.ok) throw new Error(r.statusText);
     const j = await r.json();
+    if (channel !== currentChannel) return; // switched away meanwhile
     prependHistoryWindow(j.messages || []);
     hasMore = !!j.has_more;
-    windowBefore = before;
+    nextCursor = j.next_cursor || null;
   } catch (e) {
     console.error("[older]", e);
   }
@@ -644,7 +629,36 @@ function prependHistoryWindow(msgs) {
 }
 
 // ---------- SSE ----------
-function ensureEventSource(channel) {
+// One multiplexed stream (/stream/me) for every channel we're in plus our meta
+// topic. Frames look like {channel, data}. lastSeq is the id of the last event
+// we saw (ids are global), sent back on reconnect so only missed events replay.
+let lastSeq = null;
+
+function trackSeq(e) {
+  const id = Number(e.lastEventId);
+  if (id && (lastSeq == null || id > lastSeq)) lastSeq = id;
+}
+
+function applyMessageUpdate(updatedMsg) {
+  const msgLi = chatList.querySelector(`li[data-msg-id="${updatedMsg.id}"]`);
+  if (msgLi) {
+    // Re-render the message bubble with the new content
+    const newBubble = buildMsgNode(updatedMsg);
+    msgLi.parentNode.replaceChild(newBubble, msgLi);
+  }
+}
+
+function onStream(type, handler) {
+  evtSrc.addEventListener(type, (e) => {
+    trackSeq(e);
+    esBackoff = 1000;
+    let env;
+    try { env = JSON.parse(e.data); } catch { return; }
+    handler(env.channel, env.data);
+  });
+}
+
+function ensureEventSource() {
   if (evtSrc && (evtSrc.readyState === 0 || evtSrc.readyState === 1)) return;
   if (evtSrc) {
     try {
@@ -652,19 +666,38 @@ function ensureEventSource(channel) {
     } catch {}
     evtSrc = null;
   }
-  const url = `/stream/${encodeURIComponent(channel)}`;
+  let url = "/stream/me";
+  if (lastSeq != null) url += `?last_event_id=${lastSeq}`;
   evtSrc = new EventSource(url, { withCredentials: true });
 
-  evtSrc.addEventListener("hello", () => {
+  evtSrc.addEventListener("hello", (e) => {
     esBackoff = 1000;
     statusLine("연결됨", "success");
+    try {
+      const { seq } = JSON.parse(e.data || "{}");
+      if (lastSeq == null && seq != null) lastSeq = seq;
+    } catch {}
+    loadPresence();  // whatever changed while we were away
   });
   evtSrc.addEventListener("ping", () => {});
-  evtSrc.addEventListener("message", (e) => {
+  evtSrc.addEventListener("reset", async () => {
+    // Too far behind for a replay: reload the latest page instead
+    messageIdSet.clear();
+    await loadHistory(currentChannel, Math.floor(Date.now() / 1000));
+  });
+
+  onStream("message", (channel, msg) => {
+    if (channel !== currentChannel) {
+      // We're online, so no push for this one: surface the server-rendered text instead
+      if (msg.notification && msg.user_id !== userId) statusLine(msg.notification.body);
+      if (msg.alias !== userAlias) {
+        const btn = channelButtons.querySelector(`.channel-btn[data-key="${CSS.escape(channel)}"]`);
+        setUnread(channel, (parseInt(btn?.dataset.unread, 10) || 0) + 1);
+      }
+      return;
+    }
+    if (document.visibilityState === "visible") markRead(channel, msg.id);
     const wasNearBottom = isNearBottom();
-    esBackoff = 1000;
-    const msg = JSON.parse(e.data);
-    
     if (msg.id && messageIdSet.has(msg.id)) return;
     
     appendMsg(msg, wasNearBottom || (msg.user_id && msg.user_id === userId));
@@ -674,12 +707,24 @@ function ensureEventSource(channel) {
       a.play().catch(() => {});
     }
   });
-
-  evtSrc.addEventListener("delete", (e) => {
-    try {
-      const { id } = JSON.parse(e.data);
-      if (id != null) removeMsgFromDOM(id);
-    } catch {}
+  onStream("message_update", (channel, msg) => {
+    if (channel === currentChannel) applyMessageUpdate(msg);
+  });
+  onStream("delete", (channel, data) => {
+    if (channel === currentChannel && data && data.id != null) removeMsgFromDOM(data.id);
+  });
+  onStream("read", (channel, cursor) => {
+    // Read on another of our devices
+    if (cursor && cursor.channel) setUnread(cursor.channel, cursor.unread);
+  });
+  onStream("channel", async () => {
+    try { await refreshChannels(); } catch {}
+  });
+  onStream("presence", (channel, p) => {
+    if (p && p.alias) { presence[p.alias] = p; applyPresence(); }
+  });
+  onStream("webrtc_signal", (channel, signal) => {
+    handleSignalingData(signal);
   });
 
   evtSrc.onerror = () => {
@@ -688,14 +733,15 @@ function ensureEventSource(channel) {
     } catch {}
     evtSrc = null;
     const d = Math.min(esBackoff, 30000);
-    setTimeout(() => ensureEventSource(channel), d);
+    setTimeout(() => { if (isAuthed) ensureEventSource(); }, d);
     esBackoff *= 2;
   };
 }
 
 function connectStream(channel) {
+  // The multiplexed stream already covers every channel; just switch views
   currentChannel = channel;
-  ensureEventSource(channel);
+  ensureEventSource();
 }
 
 // ---------- render ----------
@@ -754,12 +800,33 @@ function buildMsgNode(msg) {
     btn.textContent = " ▶︎ 듣기 ";
     btn.className = "ml-2 inline-flex items-center justify-center w-40 h-7 rounded-full bg-black/10 text-black/80 hover:bg-black/20";
     btn.onclick = () => new Audio(msg.audio_url).play();
+    // Waveform + duration are precomputed server-side, so nothing is downloaded until played
+    const info = msg.payload || {};
+    if (Array.isArray(info.waveform) && info.waveform.length) {
+      btn.textContent = "▶︎";
+      btn.style.width = "auto";
+      btn.style.padding = "0 10px";
+      const wave = document.createElement("span");
+      wave.style.cssText = "display:inline-flex;align-items:center;gap:1px;height:18px;margin:0 6px";
+      for (const p of info.waveform) {
+        const bar = document.createElement("span");
+        bar.style.cssText = `display:inline-block;width:2px;height:${Math.max(10, p)}%;background:currentColor;border-radius:1px`;
+        wave.appendChild(bar);
+      }
+      btn.appendChild(wave);
+    }
+    if (info.duration) btn.appendChild(document.createTextNode(formatDuration(info.duration)));
     bubble.appendChild(btn);
   } else {
     const url = getFirstUrl(msg);
     if (url && (msg.type === "image" || isImageUrl(url))) {
       const img = document.createElement("img");
-      img.src = url; 
+      const variants = msg.image_variants || {};
+      img.src = variants.thumb || url;
+      if (variants.thumb && variants.screen) {
+        img.srcset = `${variants.thumb} 520w, ${variants.screen} 1280w`;
+        img.sizes = "260px";
+      }
       img.alt = "이미지";
       img.style.maxWidth = "260px"; 
       img.style.borderRadius = "12px";
@@ -804,9 +871,71 @@ function buildMsgNode(msg) {
   return li;
 }
 
+// ---------- unread badges / read cursors ----------
+function setUnread(key, n) {
+  const btn = channelButtons.querySelector(`.channel-btn[data-key="${CSS.escape(key)}"]`);
+  if (!btn) return;
+  let badge = btn.querySelector(".unread-badge");
+  if (!n) { if (badge) badge.remove(); btn.dataset.unread = "0"; return; }
+  if (!badge) {
+    badge = document.createElement("span");
+    badge.className = "unread-badge";
+    badge.style.cssText = "margin-left:6px;padding:0 6px;border-radius:9999px;background:#ef4444;color:#fff;font-size:10px";
+    btn.appendChild(badge);
+  }
+  btn.dataset.unread = String(n);
+  badge.textContent = n > 99 ? "99+" : String(n);
+}
+
+// alias -> {online, last_active}, from /api/presence and "presence" events
+const presence = {};
+
+function applyPresence() {
+  channelButtons.querySelectorAll(".channel-btn[data-partner]").forEach(btn => {
+    const p = presence[btn.dataset.partner];
+    let dot = btn.querySelector(".presence-dot");
+    if (!dot) {
+      dot = document.createElement("span");
+      dot.className = "presence-dot";
+      dot.style.cssText = "display:inline-block;width:7px;height:7px;margin-left:6px;border-radius:9999px;vertical-align:middle";
+      btn.appendChild(dot);
+    }
+    dot.style.background = p && p.online ? "#22c55e" : "#d1d5db";
+    dot.title = p && p.online ? "온라인" : "오프라인";
+  });
+}
+
+async function loadPresence() {
+  try {
+    const r = await fetch("/api/presence", { credentials: "include", cache: "no-cache" });
+    const j = await r.json();
+    if (!j.ok) return;
+    Object.assign(presence, j.presence);
+    applyPresence();
+  } catch {}
+}
+
+const readTimers = {};
+function markRead(key, messageId) {
+  // Debounced: a burst of incoming messages costs one request
+  clearTimeout(readTimers[key]);
+  readTimers[key] = setTimeout(async () => {
+    try {
+      const r = await fetch(`/api/channels/${encodeURIComponent(key)}/read`, {
+        method: "POST",
+        credentials: "include",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify(messageId != null ? { message_id: messageId } : {}),
+      });
+      const j = await r.json();
+      if (j.ok) setUnread(key, j.unread);
+    } catch {}
+  }, 300);
+}
+
 async function refreshChannels() {
   try {
-    const r = await fetch("/api/channels", { credentials: "include", cache: "no-store" });
+    const r = await fetch("/api/channels", { credentials: "include", cache: "no-cache" });
     const j = await r.json();
     if (!j.ok) return;
     
@@ -823,6 +952,11 @@ async function refreshChannels() {
         title = otherUser || title;
       }
       btn.textContent = title;
+      if (otherUser) btn.dataset.partner = otherUser;
+      if (ch.summary) {
+        const s = ch.summary;
+        btn.title = `${s.last_alias || ""}: ${s.last_snippet || s.last_type || ""}`;
+      }
       
       if (ch.key === currentChannel) btn.classList.add("active");
       
@@ -850,13 +984,16 @@ async function refreshChannels() {
         statusLine(`채널: ${title}`);
         windowBefore = Math.floor(Date.now() / 1000);
         hasMore = true; 
+        nextCursor = null;
         messageIdSet.clear();
         connectStream(currentChannel);
         await loadHistory(currentChannel, windowBefore);
       });
       
       channelButtons.appendChild(btn);
+      setUnread(ch.key, ch.key === currentChannel ? 0 : ch.unread);
     });
+    applyPresence();
 
     // --- AND THIS IS THE CORRECTED LOGIC FOR INITIAL PAGE LOAD ---
     const activeChannel = j.channels.find(c => c.key === currentChannel);
@@ -1439,16 +1576,6 @@ function closeVideoCall() {
   callTargetUser = null;
 }
 
-metaSrc.addEventListener("message_update", (e) => {
-    const updatedMsg = JSON.parse(e.data);
-    const msgLi = document.querySelector(`li[data-msg-id="${updatedMsg.id}"]`);
-    if (msgLi) {
-        // Re-render the message bubble with the new content
-        const newBubble = buildMsgNode(updatedMsg);
-        msgLi.parentNode.replaceChild(newBubble, msgLi);
-    }
-});
-
 hangupBtn.addEventListener('click', () => {
     if (callTargetUser) { sendSignal(callTargetUser, { type: 'hangup' }); }
     closeVideoCall();